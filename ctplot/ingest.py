@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys, os, json, time, glob, logging, pickle, zlib, bz2
+import os.path as path
+import numpy as np
+import tables as t
+import dateutil.parser as dp
+from locket import lock_file
+import rawdata
+from rawdata import autodetect, starttime, blockiter, create_table, write_blocks
+
+logging.basicConfig(level = logging.INFO, format = '%(asctime)s %(levelname)s %(message)s')
+
+log = logging.getLogger('ingest')
+
+try:
+    import pyinotify
+except ImportError:  # fall back to polling
+    pyinotify = None
+
+
+def walk(dirs):
+    'yield all files in dirs and their subdirectories'
+    for d in dirs:
+        for dn, dns, fns in os.walk(d):
+            for fn in fns:
+                yield path.join(dn, fn)
+
+
+class PollingWatcher(object):
+    'reports all files in the watched directories, the ingest compares them to its state'
+
+    def __init__(self, dirs):
+        self.dirs = dirs
+
+    def candidates(self):
+        return list(walk(self.dirs))
+
+
+class InotifyWatcher(object):
+    'reports the files written or moved into the watched directories since the last call (Linux only)'
+
+    def __init__(self, dirs):
+        self.paths = set()
+        paths = self.paths
+
+        class Collector(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                if not event.dir:
+                    paths.add(event.pathname)
+
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MODIFY
+        self.wm = pyinotify.WatchManager()
+        for d in dirs:
+            self.wm.add_watch(d, mask, rec = True, auto_add = True)
+        self.notifier = pyinotify.Notifier(self.wm, Collector(), timeout = 0)
+
+    def candidates(self):
+        while self.notifier.check_events(0):
+            self.notifier.read_events()
+            self.notifier.process_events()
+        files = sorted(self.paths)
+        self.paths.clear()
+        return files
+
+
+def decompressor(filename):
+    'return a new incremental decompressor for filename, None if it is not compressed, see rawdata.open_datafile'
+    ext = path.splitext(filename)[1].lower()
+    if ext == '.gz':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif ext == '.bz2':
+        return bz2.BZ2Decompressor()
+    elif ext == '.xz':
+        if rawdata.lzma is None:
+            raise RuntimeError('reading {} requires the lzma module (backports.lzma)'.format(filename))
+        return rawdata.lzma.LZMADecompressor()
+
+read_errors = (IOError, EOFError, zlib.error) + ((rawdata.lzma.LZMAError,) if rawdata.lzma else ())
+
+class Tail(object):
+    """
+    iterate over the complete lines of a file starting at offset, offset is advanced past every line yielded,
+    offsets in compressed files refer to the decompressed data,
+    compressed files are decompressed incrementally, the decompressor is kept to continue with the data appended later,
+    if the file cannot be read (corrupt data) the iteration stops and the exception is kept in error
+    """
+
+    chunk = 1 << 16  # bytes read at a time
+
+    def __init__(self, filename, offset = 0):
+        self.filename = filename
+        self.offset = offset
+        self.decompressor = decompressor(filename)
+        self.raw = 0 if self.decompressor else offset  # bytes of the file read
+        self.skip = offset if self.decompressor else 0  # decompressed bytes before offset, skipped
+        self.buffer = ''  # data read but not yielded, an incomplete line
+        self.error = None
+
+    def _decompress(self, data):
+        'decompress data, the members of concatenated files (gzip, bzip2, xz streams) one after another'
+        if not self.decompressor:
+            return data
+        out = []
+        while data:
+            try:
+                out.append(self.decompressor.decompress(data))
+            except EOFError:  # bz2 and lzma after the end of their stream
+                self.decompressor = decompressor(self.filename)
+                continue
+            data = self.decompressor.unused_data
+            if data:  # the next member
+                self.decompressor = decompressor(self.filename)
+        return ''.join(out)
+
+    def __iter__(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                f.seek(self.raw)
+                for data in iter(lambda: f.read(self.chunk), ''):
+                    self.raw += len(data)
+                    self.buffer += self._decompress(data)
+                    if self.skip:
+                        n = min(self.skip, len(self.buffer))
+                        self.buffer = self.buffer[n:]
+                        self.skip -= n
+                    lines = self.buffer.split('\n')
+                    self.buffer = lines.pop()  # incomplete line, the file is still being written
+                    for line in lines:
+                        line += '\n'
+                        self.offset += len(line)
+                        yield line
+        except read_errors as e:
+            self.error = e
+
+
+def invalidate_caches(cachedir, filename):
+    'remove the cached averaged data (see Plot._get_data) that was computed from filename'
+    if not cachedir:
+        return
+
+    filename = path.abspath(filename)
+    for cachefile in glob.glob(path.join(cachedir, 'avg*.h5')):
+        try:
+            with t.openFile(cachefile, 'r') as h5:
+                source = h5.getNode('/data').attrs.source
+        except:  # in use or corrupt, it will be rebuilt anyway
+            continue
+
+        if path.abspath(source.split(':')[0]) == filename:
+            if verbose > 0:
+                print 'removing cache', cachefile
+            os.remove(cachefile)
+
+
+def get_context(handler):
+    'the parsing state of handler (see LineHandler.context) as text for the state file'
+    return pickle.dumps(dict((k, getattr(handler, k)) for k in handler.context if hasattr(handler, k)), 0)
+
+def set_context(handler, context):
+    'restore the parsing state of handler saved by get_context'
+    handler.__dict__.update(pickle.loads(str(context)))
+
+
+class Ingest(object):
+    """
+    appends the rows of new or grown raw data files to the tables in out,
+    the state (size and mtime of each file seen, the offset of the lines ingested and the parsing context) is kept in statefile,
+    so a restarted ingest does not read unchanged files again and continues grown files after the lines ingested
+    """
+
+    def __init__(self, out, statefile = None, t0 = dp.parse('2004-01-01 00:00:00 +0000'), cachedir = None,
+                 skip_on_assert = True, ignore_errors = False):
+        self.out = out
+        self.statefile = statefile or out + '.ingest'
+        self.t0 = t0
+        self.cachedir = cachedir
+        self.skip_on_assert = skip_on_assert
+        self.ignore_errors = ignore_errors
+        self.readers = {}  # filename --> (LineHandler instance, Tail) of files read by this process, Tail keeps the decompressor
+
+        try:
+            with open(self.statefile) as f:
+                self.state = json.load(f)
+        except IOError:
+            self.state = {}
+
+    def save_state(self):
+        with open(self.statefile + '.tmp', 'w') as f:
+            json.dump(self.state, f, indent = 0)
+        os.rename(self.statefile + '.tmp', self.statefile)
+
+    def changed(self, filenames):
+        'return the files of filenames that are new or have been modified'
+        changed = []
+        for f in filenames:
+            f = path.abspath(f)
+            if f == path.abspath(self.out) or f.startswith(path.abspath(self.statefile)):
+                continue
+            try:
+                st = os.stat(f)
+            except OSError:  # removed meanwhile
+                continue
+            s = self.state.get(f)
+            if s is None or s['size'] != st.st_size or s['mtime'] != st.st_mtime:
+                changed.append(f)
+        return changed
+
+    def _remember(self, filename, table, handler = None, reader = None):
+        st = os.stat(filename)
+        self.state[filename] = {'size':st.st_size, 'mtime':st.st_mtime, 'table':table}
+        if reader:
+            self.state[filename].update(offset = reader.offset, context = get_context(handler))
+
+    def _resume(self, filename, handler_type):
+        'return (handler, Tail) continuing filename after the lines ingested before, if it has only grown since'
+        handler = handler_type()
+        s = self.state.get(filename)
+        if s and s.get('offset') and s['table'] == handler.table_name and os.stat(filename).st_size >= s['size']:
+            set_context(handler, s['context'])
+            return handler, Tail(filename, s['offset'])
+        # read from the beginning, the handler may need the context (header lines)
+        return handler, Tail(filename)
+
+    def update(self, filenames):
+        'ingest the new or grown files of filenames, return # of rows appended'
+        files = self.changed(filenames)
+        if not files:
+            return 0
+
+        # detect the handlers, files already read by this process keep theirs
+        batches = {}
+        for f in files:
+            if f in self.readers:
+                handler = self.readers[f][0].__class__
+            else:
+                try:
+                    handler = autodetect(f, open_lines = lambda: Tail(f))
+                except:  # unknown format or not enough complete lines yet, retry if it changes
+                    if verbose > 0:
+                        print 'no handler for', f
+                    self._remember(f, None)
+                    continue
+            batches.setdefault(handler, []).append(f)
+
+        n = 0
+        if batches:
+            with lock_file(self.out + '.lock'):
+                with t.openFile(self.out, 'a') as h5:
+                    for handler, files in batches.iteritems():
+                        files.sort(key = lambda x: starttime(x, handler(), Tail(x)))
+                        n += self._append(h5, handler, files)
+
+        self.save_state()
+
+        if n > 0:
+            invalidate_caches(self.cachedir, self.out)
+        return n
+
+    def _append(self, h5, handler_type, files):
+        try:
+            table = h5.getNode('/raw/' + handler_type.table_name)
+        except t.NoSuchNodeError:
+            table = create_table(h5, handler_type(), self.t0)
+
+        t0 = dp.parse(table.attrs.t0)
+
+        def newer(blocks, last, dropped):
+            'tables are time ordered, drop rows that are not newer than the last row, count them in dropped[0]'
+            for block in blocks:
+                keep = block['time'] > last
+                dropped[0] += len(keep) - np.count_nonzero(keep)
+                yield block.select(keep)
+
+        n = 0
+        for f in files:
+            if f not in self.readers:
+                self.readers[f] = self._resume(f, handler_type)
+            handler, reader = self.readers[f]
+
+            blocks = blockiter(f, handler, t0, self.skip_on_assert, verbose > 0, self.ignore_errors, lines = reader)
+            dropped = [0]
+            if table.nrows > 0:
+                blocks = newer(blocks, table.cols.time[-1], dropped)
+
+            m = write_blocks(table, blocks)
+            table.flush()
+            if dropped[0]:
+                log.warning('dropped %d rows of %s not newer than the last row of %s, rebuild the table with rawdata to backfill them',
+                            dropped[0], f, table._v_pathname)
+            self._remember(f, handler.table_name, handler, reader)
+            if reader.error:
+                log.warning('stopped reading %s: %s, retrying when it changes', f, reader.error)
+                del self.readers[f]  # resumed after the rows appended, see _resume
+            if verbose > 0:
+                print 'appended %d rows from %s to %s' % (m, f, table._v_pathname)
+            n += m
+
+        return n
+
+
+def watch(dirs, out, interval = 30, poll = False, **kwargs):
+    """
+    ingest all files in dirs and keep watching them for new or grown files,
+    changes are collected and ingested in batches every interval seconds
+    """
+    ingest = Ingest(out, **kwargs)
+
+    # catch up with everything that happened while we were not running
+    ingest.update(walk(dirs))
+
+    if poll or pyinotify is None:
+        watcher = PollingWatcher(dirs)
+    else:
+        watcher = InotifyWatcher(dirs)
+
+    if verbose > 0:
+        print 'watching', dirs, 'with', type(watcher).__name__
+
+    while True:
+        time.sleep(interval)
+        n = ingest.update(watcher.candidates())
+        if n > 0:
+            print '%s: appended %d rows' % (time.strftime('%F %T'), n)
+        sys.stdout.flush()
+
+
+verbose = 0
+
+def main():
+    from argparse import ArgumentParser
+    import ctplot
+
+    parser = ArgumentParser(description = 'watch directories for new or grown raw data files and append their rows to the tables in one HDF5 file, '
+                            'rows not newer than the last row of a table are dropped with a warning, backfills need the table rebuilt with rawdata',
+                            epilog = ctplot.__epilog__)
+
+    parser.add_argument('-V', '--version', action = 'version', version = '%(prog)s {} build {}'.format(ctplot.__version__, ctplot.__build_date__))
+    parser.add_argument('-o', '--out', metavar = 'file', default = 'out.h5', help = 'HDF5 output file (default: out.h5)')
+    parser.add_argument('-t', '--reftime', metavar = 'datetime', default = '2004-01-01T00:00:00+0000', type = dp.parse,
+                        help = 'reference time t0 of newly created tables (default: 2004-01-01T00:00:00+0000)')
+    parser.add_argument('-c', '--cache', metavar = 'dir', default = os.environ.get('CTPLOT_CACHEDIR'),
+                        help = 'cache dir of ctplot, cached data of changed tables is removed (default: $CTPLOT_CACHEDIR)')
+    parser.add_argument('-i', '--interval', metavar = 'seconds', type = float, default = 30, help = 'collect changes for this long before ingesting them (default: 30)')
+    parser.add_argument('-p', '--poll', action = 'store_true', help = 'poll the directories instead of using inotify')
+    parser.add_argument('--state', metavar = 'file', help = 'file to keep the state of the ingest in (default: <out>.ingest)')
+    parser.add_argument('-s', '--noskip', action = 'store_true', help = 'do not skip invalid lines, stop on error')
+    parser.add_argument('-k', '--keepgoing', action = 'store_true', help = 'keep going, do not stop on errors')
+    parser.add_argument('-v', '--verbose', action = 'count', help = 'show additional processing information')
+    parser.add_argument('dirs', nargs = '+', help = 'directories to watch (including subdirectories)')
+
+    args = parser.parse_args()
+
+    global verbose
+    verbose = rawdata.verbose = args.verbose or 0
+
+    out = args.out if args.out.endswith('.h5') else args.out + '.h5'
+
+    watch(args.dirs, out, args.interval, args.poll, statefile = args.state, t0 = args.reftime, cachedir = args.cache,
+          skip_on_assert = not args.noskip, ignore_errors = args.keepgoing)
+
+
+if __name__ == '__main__':
+    main()
@@ -25,6 +25,7 @@ import sys
 
 def drawmap(lat = None, lon = None, margin = 0.05, width = 1e6, height = None, boundarylat = 40,
          projection = 'cyl', drawcoastline = 1, drawcountries = 0, drawgrid = 1, drawspecgrid = 1, bluemarble = 0, nightshade = None,
+         ax = None, fontsize = None,
          places = [('Neumayer-St.'    , -70.6666      , -8.2666),
                    ('Amundsen-Scott-St.'   , -90.     , 0.),
                    ('DESY Zeuthen'  , 52.346142    , 13.633432)]):
@@ -68,7 +69,7 @@ def drawmap(lat = None, lon = None, margin = 0.05, width = 1e6, height = None, b
 
     #print map_options
 
-    m = bm.Basemap(projection = projection, **map_options)
+    m = bm.Basemap(projection = projection, ax = ax, **map_options)
 
     if bluemarble:
         m.bluemarble(scale = 0.5)
@@ -110,8 +111,8 @@ def drawmap(lat = None, lon = None, margin = 0.05, width = 1e6, height = None, b
 
     for name, la, lo in places:
         x, y = m(lo, la)
-        m.plot(x, y, 'rs', markersize = 4)
-        plt.annotate(name, (x, y), textcoords = 'offset points', xytext = (5, 2))
+        m.plot(x, y, 'rs', markersize = 4, markeredgewidth = 0)
+        (ax or plt.gca()).annotate(name, (x, y), textcoords = 'offset points', xytext = (5, 2), fontsize = fontsize)
 
     sys.stdout = sys.__stdout__
 
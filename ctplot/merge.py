@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import tables as t
+import numpy as np
 from progressbar import ProgressBar, Bar, ETA, Percentage
 from collections import OrderedDict
 from utils import set_attrs, seconds2datetime
@@ -9,21 +10,15 @@ import dateutil.parser as dp
 import sys, json, os
 
 
-def _interpolate(t, w0, w1, idx):
-    'interpolate w0 and w1 at t, using tw=w[idx]'
-    assert len(w0) == len(w1)
-
-    tw0 = w0[idx]  # time of w0
-    tw1 = w1[idx]  # time of w1
+def _interpolate(t, tw0, tw1, w0, w1):
+    'interpolate the arrays w0 (at times tw0) and w1 (at times tw1) at times t'
     dt = tw1 - tw0  # time interval length
 
-    # interpolate (if else to minimize roundoff error)
-    a = (t - tw0) / dt
-    if a > 0.5:
-        return [w0 * (1.0 - a) + w1 * a for w0, w1 in zip(w0, w1)]
-    else:
+    # interpolate (where to minimize roundoff error)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        a = (t - tw0) / dt
         b = (tw1 - t) / dt
-        return [w0 * b + w1 * (1.0 - b) for w0, w1 in zip(w0, w1)]
+        return np.where(a > 0.5, w0 * (1.0 - a) + w1 * a, w0 * b + w1 * (1.0 - b))
 
 def _printinfo(t):
     print '%s, %d rows, t0=%s, columns:' % (t.attrs['TITLE'], t.nrows, t.attrs['t0'])
@@ -33,72 +28,249 @@ def _printinfo(t):
 
 
 
-def merge(primary_file, secondary_file = None, outfile = None, primary_table = None, secondary_table = None, merge_on = 'time', max_inter = 4 * 3600, quiet = False):
+def _window_mean(t, tw, cumsum, cumcount, width):
+    'mean of the values at times tw within width/2 around t, cumsum and cumcount are the cumulative sum and # of non nan values'
+    lo = np.searchsorted(tw, t - 0.5 * width, 'left')
+    hi = np.searchsorted(tw, t + 0.5 * width, 'right')
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return (cumsum[hi] - cumsum[lo]) / (cumcount[hi] - cumcount[lo])
+
+
+join_modes = ('interpolate', 'previous', 'nearest', 'window')
+
+def parse_join(mode):
+    'return (mode, window width) of a join mode, interpolate, previous, nearest or window:<seconds>'
+    m = mode.split(':')
+    if m[0] not in join_modes or (m[0] == 'window') != (len(m) == 2) or len(m) > 2:
+        raise ValueError('unknown join mode {}, use one of interpolate, previous, nearest, window:<seconds>'.format(mode))
+    return m[0], float(m[1]) if len(m) > 1 else None
+
+
+class Secondary(object):
+    """
+    a secondary table of a merge, its columns are joined to the event times,
+    modes maps (prefixed) columns to join modes (see parse_join), the default is interpolate
+    """
+
+    def __init__(self, table, merge_on = 'time', toff = 0, max_inter = 4 * 3600, prefix = '', modes = {}):
+        self.table = table
+        self.merge_on = merge_on
+        self.toff = toff
+        self.max_inter = max_inter
+        self.prefix = prefix
+        self.colnames = [c for c in table.colnames if c != merge_on]
+        self.modes = dict((c, parse_join(modes.get(prefix + c, 'interpolate'))) for c in self.colnames)
+        self.tw = table.col(merge_on) + toff  # adjust for global t0, apply offset
+        self._cumulated = {}  # column --> cumulative sum and count of values, for window joins
+        self.reset()
+
+    def reset(self):
+        'start merging from the first event again, the times and cumulated values read are kept'
+        self.current = 0  # index of the current interval, it never moves backwards
+        self.skipped = OrderedDict([('before', 0), ('gap', 0), ('end', 0)])  # # of events skipped by reason
+
+    def end(self, te):
+        'return the # of events in te before the first event after the last row'
+        beyond = np.flatnonzero(~(te <= self.tw[-1]))
+        return beyond[0] if len(beyond) > 0 else len(te)
+
+    def locate(self, te):
+        """
+        return the index of the interval containing each event and the mask of the events that can be merged,
+        events before the current interval and events in intervals longer than max_inter are skipped,
+        te must end before the last row (see end)
+        """
+        k = np.maximum(np.searchsorted(self.tw, te, 'left') - 1, 0)
+        k = np.maximum.accumulate(np.concatenate(([self.current], k)))[1:]
+        if len(k) > 0:
+            self.current = k[-1]
+        tw0, tw1 = self.tw[k], self.tw[k + 1]
+        before = te < tw0
+        gap = ~before & ((tw1 - tw0) > self.max_inter)
+        self.skipped['before'] += np.count_nonzero(before)
+        self.skipped['gap'] += np.count_nonzero(gap)
+        return k, ~(before | gap)
+
+    def _cumulate(self, c):
+        if c not in self._cumulated:
+            x = self.table.col(c).astype(float)
+            valid = ~np.isnan(x)
+            self._cumulated[c] = (np.concatenate(([0], np.cumsum(np.where(valid, x, 0)))),
+                                  np.concatenate(([0], np.cumsum(valid))))
+        return self._cumulated[c]
+
+    def join(self, te, k, columns = None):
+        """
+        return OrderedDict (prefixed) column --> values joined to te, k are the interval indices (see locate),
+        only the (prefixed) columns given are joined if columns is not None
+        """
+        values = OrderedDict()
+        colnames = [c for c in self.colnames if columns is None or self.prefix + c in columns]
+        if len(te) == 0 or not colnames:
+            return values
+
+        # read the rows enclosing the events
+        rows = self.table.read(k[0], k[-1] + 2)
+        w0, w1 = rows[k - k[0]], rows[k - k[0] + 1]
+        tw0, tw1 = self.tw[k], self.tw[k + 1]
+        for c in colnames:
+            mode, width = self.modes[c]
+            if mode == 'interpolate':
+                v = _interpolate(te, tw0, tw1, w0[c], w1[c])
+            elif mode == 'previous':
+                v = w0[c]
+            elif mode == 'nearest':
+                v = np.where(te - tw0 <= tw1 - te, w0[c], w1[c])
+            else:
+                v = _window_mean(te, self.tw, *self._cumulate(c), width = width)
+            values[self.prefix + c] = v
+        return values
+
+
+def merged_blocks(pri_table, secondaries, dtype, merge_on = 'time', toff = 0, blocksize = 100000, start = 0, stop = None):
+    """
+    merge the rows start to stop of pri_table with the secondaries,
+    yield (# of primary rows processed, structured array of dtype with the merged rows) for each block,
+    only the columns in dtype are merged
+    """
+    stop = pri_table.nrows if stop is None else min(stop, pri_table.nrows)
+    for b in xrange(start, stop, blocksize):
+        events = pri_table.read(b, min(b + blocksize, stop))
+        te = events[merge_on] + toff  # adjust for global t0, apply offset
+
+        # stop at the first event after the last row of any secondary table
+        ends = [sec.end(te) for sec in secondaries]
+        n = min([len(te)] + ends)
+        beyond = n < len(te)
+        if beyond:
+            secondaries[ends.index(n)].skipped['end'] += stop - b - n
+        events, te = events[:n], te[:n]
+
+        use = np.ones(n, dtype = bool)
+        located = []
+        for sec in secondaries:
+            k, u = sec.locate(te)
+            located.append(k)
+            use &= u
+        events, te = events[use], te[use]
+
+        # merged data: event with secondary data interpolated to event time
+        ew = np.empty(len(events), dtype = dtype)
+        for c in pri_table.colnames:
+            if c in dtype.names:
+                ew[c] = events[c]
+        if merge_on in dtype.names:
+            ew[merge_on] = te  # update event time (because of offset)
+        for sec, k in zip(secondaries, located):
+            for c, v in sec.join(te, k[use], dtype.names).iteritems():
+                ew[c] = v
+
+        yield min(b + blocksize, stop), ew
+
+        if beyond:
+            break  # there are no more secondary rows
+
+
+def _first_after(table, column, value, toff = 0):
+    'return the index of the first row of table (ordered by column) with column + toff > value'
+    lo, hi = 0, table.nrows
+    while lo < hi:  # bisection
+        mid = (lo + hi) // 2
+        if table[mid][column] + toff > value:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+def prepare_merge(pri_table, sec_tables, specs, merge_on = 'time', joins = {}):
+    """
+    return (global t0, time offset of pri_table, Secondary of each table, column descriptor, units)
+    of the merge of pri_table with sec_tables, specs are (max_inter, column prefix) of each secondary table,
+    joins maps columns of the merged table to join modes (see parse_join)
+    """
+    t0e = dp.parse(pri_table.attrs.t0)
+    t0s = [dp.parse(sec_table.attrs.t0) for sec_table in sec_tables]
+    t0 = min([t0e] + t0s)  # global t0 is the smallest one
+
+    # build column descriptors and units for table of merged data
+    descriptor = OrderedDict()  # keep the order
+    for k in pri_table.colnames:
+        descriptor[k] = pri_table.coldescrs[k].copy()
+    units = list(json.loads(pri_table.attrs.units))
+
+    secs = []
+    for sec_table, t0w, (max_inter, prefix) in zip(sec_tables, t0s, specs):
+        # time offset for secondary table, to adjust for new global t0
+        sec = Secondary(sec_table, merge_on, (t0w - t0).total_seconds(), max_inter, prefix or '', joins)
+        secs.append(sec)
+
+        # add cols of secondary table, except 'time'
+        wunits = json.loads(sec_table.attrs.units)
+        for k in sec.colnames:
+            assert sec.prefix + k not in descriptor, 'duplicate column {}, use a prefix'.format(sec.prefix + k)
+            descriptor[sec.prefix + k] = sec_table.coldescrs[k].copy()
+            units.append(wunits[sec_table.colnames.index(k)])
+
+    for c in joins:
+        if c not in descriptor or c in pri_table.colnames:
+            raise ValueError('cannot join column {}, it is not in a secondary table'.format(c))
+
+    # adjust position fields (column order in descriptors)
+    for i, v in enumerate(descriptor.values()):
+        v._v_pos = i
+
+    return t0, (t0e - t0).total_seconds(), secs, descriptor, units
+
+
+def merge(primary_file, secondary_file = None, outfile = None, primary_table = None, secondary_table = None, merge_on = 'time', max_inter = 4 * 3600, quiet = False,
+          blocksize = 100000, secondaries = None, append = False, joins = {}):
+    """
+    merge the primary table with one or more secondary tables, secondaries is a list of
+    (file, table, max_inter, column prefix), default is [(secondary_file, secondary_table, max_inter, '')],
+    events that cannot be merged with all secondary tables are skipped,
+    if append is True only the events newer than the last merged event are merged and appended to an existing merged table,
+    joins maps columns of the merged table to join modes (see parse_join), the default is interpolate
+    """
+    if secondaries is None:
+        secondaries = [(secondary_file, secondary_table, max_inter, '')]
+
     # open data file(s)
     if outfile is None:
         h5pri = h5out = t.openFile(primary_file, 'r+')
     else:
         h5pri = t.openFile(primary_file, 'r')
-        h5out = t.openFile(outfile, 'w')
+        h5out = t.openFile(outfile, 'a' if append else 'w')
 
-    if secondary_file is None or os.path.abspath(primary_file) == os.path.abspath(secondary_file):
-        h5sec = h5pri
-    else:
-        h5sec = t.openFile(secondary_file, 'r')
-
-    with h5pri, h5sec, h5out:
+    h5files = OrderedDict([(os.path.abspath(primary_file), h5pri)])
+    for f, _, _, _ in secondaries:
+        f = os.path.abspath(f or primary_file)
+        if f not in h5files:
+            h5files[f] = t.openFile(f, 'r')
 
+    try:
         # open event table and read t0
         pri_table = h5pri.getNode(primary_table)
         _printinfo(pri_table)
-        t0e = dp.parse(pri_table.attrs.t0)
-        eunits = list(json.loads(pri_table.attrs.units))
         assert pri_table.nrows > 1
 
-        # open weather table and read t0
-        sec_table = h5sec.getNode(secondary_table)
-        _printinfo(sec_table)
-        t0w = dp.parse(sec_table.attrs.t0)
-        wunits = list(json.loads(sec_table.attrs.units))
-        assert sec_table.nrows > 1
+        # open secondary tables
+        sec_tables = []
+        for f, table, _, _ in secondaries:
+            sec_table = h5files[os.path.abspath(f or primary_file)].getNode(table)
+            _printinfo(sec_table)
+            assert sec_table.nrows > 1
+            sec_tables.append(sec_table)
 
-        # global t0 is the smaller one
-        t0 = min(t0w, t0e)
+        t0, toffe, secs, merged_descriptor, merged_units = prepare_merge(pri_table, sec_tables, [s[2:] for s in secondaries], merge_on, joins)
         print "global reference time t0 =", t0
 
-        # time offset for weather, to adjust for new global t0
-        toffw = (t0w - t0).total_seconds()
-        if toffw != 0:
-            print "weather time offset =", toffw
-
-        # time offset for events, to adjust for new global t0
-        toffe = (t0e - t0).total_seconds()
+        # time offsets, to adjust for new global t0
         if toffe != 0:
             print "  event time offset =", toffe
-
-        # get column index for 'time' in each table
-        etime = pri_table.colnames.index(merge_on)
-        wtime = sec_table.colnames.index(merge_on)
-
-        # build column descriptors for table of merged data
-        merged_descriptor = OrderedDict()  # keep the order
-        for k in pri_table.colnames:
-            merged_descriptor[k] = pri_table.coldescrs[k]
-
-        # add cols of weather table
-        weather_colnames = list(sec_table.colnames)  # work on copy
-        weather_colnames.pop(wtime)  # remove 'time' column
-        for k in weather_colnames:  # add remaining cols
-            merged_descriptor[k] = sec_table.coldescrs[k].copy()
-
-        # adjust position fields (column order in descriptors)
-        for i, v in enumerate(merged_descriptor.values()):
-            v._v_pos = i
-
-        # merge unit description
-        merged_units = eunits
-        wunits.pop(wtime)
-        merged_units.extend(wunits)
+        for sec in secs:
+            if sec.toff != 0:
+                print "%s time offset = %s" % (sec.table._v_title, sec.toff)
 
         # create table for merged data
         try:
@@ -106,21 +278,26 @@ def merge(primary_file, secondary_file = None, outfile = None, primary_table = N
         except:
             merged = h5out.createGroup(h5out .root, 'merged', 'merged data')
 
-        merged_table = h5out.createTable(merged, os.path.basename(primary_table), merged_descriptor,
-                                       pri_table._v_title + ' merged with ' + sec_table._v_title ,
-                                       expectedrows = pri_table.nrows)
-        set_attrs(merged_table, t0, tuple(merged_units))  # store new global t0 with this table
-        row = merged_table.row
+        name = os.path.basename(primary_table)
+        start = 0  # first event to merge
+        if append and name in merged:
+            merged_table = h5out.getNode(merged, name)
+            if merged_table.colnames != merged_descriptor.keys() or dp.parse(merged_table.attrs.t0) != t0:
+                raise RuntimeError('columns or t0 of {} do not match, merge without appending'.format(merged_table._v_pathname))
+
+            # events up to the last merged one are done, later ones may have been skipped
+            # because there were no secondary rows yet
+            if merged_table.nrows > 0:
+                start = _first_after(pri_table, merge_on, merged_table[-1][merge_on], toffe)
+            print "appending events from row %d on" % start
+        else:
+            merged_table = h5out.createTable(merged, name, merged_descriptor,
+                                           pri_table._v_title + ' merged with ' + ', '.join(s._v_title for s in sec_tables),
+                                           expectedrows = pri_table.nrows)
+            set_attrs(merged_table, t0, tuple(merged_units))  # store new global t0 with this table
 
         _printinfo(merged_table)
 
-        # get the first TWO weather rows, i.e. the first weather interval
-        weather_iterator = sec_table.iterrows()
-        weather_0 = weather_iterator.next()[:]
-        tw0 = weather_0[wtime] + toffw
-        weather_1 = weather_iterator.next()[:]
-        tw1 = weather_1[wtime] + toffw
-
         # start console progress bar
         print "merging data..."
         if not quiet:
@@ -128,49 +305,13 @@ def merge(primary_file, secondary_file = None, outfile = None, primary_table = N
                              widgets = [Bar(), ' ', Percentage(), ' ', ETA()], fd = sys.stdout)
             pb.start()
 
-        # loop over events
+        # loop over blocks of events
         event_counter = 0
-        for event in pri_table:
+        for n, ew in merged_blocks(pri_table, secs, merged_table.dtype, merge_on, toffe, blocksize, start):
+            merged_table.append(ew)
+            event_counter += len(ew)  # count merged events
             if not quiet:
-                pb.update(pb.currval + 1)  # update progress bar
-
-            # skip to next event if weather too new
-            te = event[etime] + toffe  # adjust for global t0, apply offset
-            if te < tw0:  # if eventime < start of weather interval...
-                continue
-
-            try:  # skip to next pair of weather data until the event is contained
-                while not (tw0 <= te <= tw1):
-                    weather_0 = weather_1  # shift 1 -> 0
-                    tw0 = weather_0[wtime] + toffw  # adjust for global t0, apply offset
-                    weather_1 = weather_iterator.next()[:]  # get next weather row as tuple (do [:])
-                    tw1 = weather_1[wtime] + toffw  # adjust for global t0, apply offset
-
-            except StopIteration:
-                break  # exit event loop if there are no more weather rows
-
-            # skip event if weather interval too long (weather regarded as invalid)
-            if (tw1 - tw0) > max_inter:
-                continue
-
-            # interpolate weather data to event time
-            winterp = _interpolate(te, weather_0, weather_1, wtime)
-            winterp.pop(wtime)  # remove 'time' col from interpolated weather
-
-            # merged data: event with weather data
-            ew = list(event[:])  # copy event data
-            ew[etime] = te;  # update event time (because of offset)
-            ew.extend(winterp)  # add interpolated weather data
-
-            assert len(merged_descriptor) == len(ew)  # length must match
-
-            # write newly merged data into row
-            for k, v in zip(merged_descriptor.keys(), ew):
-                row[k] = v
-
-            # append row
-            row.append()
-            event_counter += 1  # count merged events
+                pb.update(n)  # update progress bar
 
         if not quiet:
             pb.finish()  # finish progress bar
@@ -178,11 +319,19 @@ def merge(primary_file, secondary_file = None, outfile = None, primary_table = N
         merged_table.flush()  # force writing the table
 
         # output status information
-        print "merged %d of %d events, skipped %d" % (event_counter, pri_table.nrows, pri_table.nrows - event_counter)
-        print "first merged record", seconds2datetime(t0, merged_table[0][etime])
-        print " last merged record", seconds2datetime(t0, merged_table[-1][etime])
-
+        etime = pri_table.colnames.index(merge_on)
+        events = pri_table.nrows - start
+        print "merged %d of %d events, skipped %d" % (event_counter, events, events - event_counter)
+        for sec in secs:
+            print "%s: %d events before a row or out of order, %d in intervals longer than %gs, %d after the last row" % (
+                (sec.table._v_title,) + tuple(sec.skipped.values()[:2]) + (sec.max_inter, sec.skipped['end']))
+        if merged_table.nrows > 0:
+            print "first merged record", seconds2datetime(t0, merged_table[0][etime])
+            print " last merged record", seconds2datetime(t0, merged_table[-1][etime])
 
+    finally:
+        for h5 in set(h5files.values() + [h5out]):
+            h5.close()
 
 
 
@@ -191,19 +340,27 @@ def main():
     from argparse import ArgumentParser
     import ctplot
 
-    parser = ArgumentParser(description = 'merge two tables in a HDF5 file', epilog = ctplot.__epilog__)
+    parser = ArgumentParser(description = 'merge a table with one or more other tables in HDF5 files', epilog = ctplot.__epilog__)
 
     parser.add_argument('-V', '--version', action = 'version', version = '%(prog)s {} build {}'.format(ctplot.__version__, ctplot.__build_date__))
     parser.add_argument('-m', '--merge', metavar = 'column', default = 'time', help = 'column to merge on (default: time)')
     parser.add_argument('-x', '--maxint', metavar = 'seconds', type = float, default = 4 * 3600, help = 'max. interval length in secondary table (default: 4h)')
     parser.add_argument('-o', '--out', metavar = 'file', help = 'HDF5 output file (default: write to file_1)')
     parser.add_argument('-f', '--force', action = 'store_true', help = 'overwrite existing file')
-#    parser.add_argument('-a', '--append', action = 'store_true', help = 'append new data to existing file/table')
+    parser.add_argument('-v', '--virtual', action = 'store_true',
+                        help = 'do not write the merged data, but a definition of the merged table, the data is merged when it is plotted')
+    parser.add_argument('-a', '--append', action = 'store_true',
+                        help = 'append the events newer than the last merged event to the existing merged table')
     parser.add_argument('-q', '--quiet', action = 'store_true', help = 'do not show progressbar, just print error messages')
+    parser.add_argument('-s', '--secondary', metavar = 'file:table[:maxint[:prefix]]', action = 'append', default = [],
+                        help = 'additional secondary table with its max. interval length (default: --maxint) and a prefix for its column names, may be repeated')
+    parser.add_argument('-j', '--join', metavar = 'column=mode', action = 'append', default = [],
+                        help = 'how to join a column of a secondary table (with prefix) to the events: interpolate (default), previous, nearest ' +
+                               'or window:<seconds> for the mean of the values within the window around the event, may be repeated')
     parser.add_argument('file_1', help = 'HDF5 file with primary table')
     parser.add_argument('table_1', help = 'name of primary table (event table)')
-    parser.add_argument('file_2', help = 'HDF5 file with secondary table (may be the same as file_1)')
-    parser.add_argument('table_2', help = 'name of secondary table (weather table)')
+    parser.add_argument('file_2', nargs = '?', help = 'HDF5 file with secondary table (may be the same as file_1)')
+    parser.add_argument('table_2', nargs = '?', help = 'name of secondary table (weather table)')
 
 
     opts = parser.parse_args()
@@ -213,11 +370,40 @@ def main():
         if not out.endswith('.h5'):
             out = out + '.h5'
 
-        if not opts.force and os.path.exists(out):
+        if not opts.force and not opts.append and os.path.exists(out):
             raise RuntimeError('file \'{}\' already exists'.format(out))
 
-    merge(opts.file_1, opts.file_2, outfile = out, primary_table = opts.table_1, secondary_table = opts.table_2,
-          merge_on = opts.merge, max_inter = opts.maxint, quiet = opts.quiet)
+    secondaries = []
+    if opts.file_2 and not opts.table_2:
+        parser.error('no name of secondary table given')
+    if opts.table_2:
+        secondaries.append((opts.file_2, opts.table_2, opts.maxint, ''))
+    for s in opts.secondary:
+        s = s.split(':') + ['', '']
+        if len(s) < 4 or not s[1]:
+            parser.error('secondary table must be given as file:table[:maxint[:prefix]]')
+        secondaries.append((s[0], s[1], float(s[2]) if s[2] else opts.maxint, s[3]))
+    if not secondaries:
+        parser.error('no secondary table given')
+
+    joins = {}
+    for j in opts.join:
+        c, _, mode = j.partition('=')
+        try:
+            parse_join(mode)
+        except ValueError as e:
+            parser.error(str(e))
+        joins[c] = mode
+
+    if opts.virtual:
+        from sources import define_virtual
+        with t.openFile(out or opts.file_1, 'w' if out else 'a') as h5:
+            node = define_virtual(h5, '/merged', os.path.basename(opts.table_1), (opts.file_1, opts.table_1), secondaries, opts.merge, joins)
+            print 'defined virtual merged table', node._v_pathname
+        return
+
+    merge(opts.file_1, outfile = out, primary_table = opts.table_1, merge_on = opts.merge, quiet = opts.quiet,
+          secondaries = secondaries, append = opts.append, joins = joins)
 
 
 if __name__ == '__main__':
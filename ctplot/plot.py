@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import os, sys, re, json, tables, ticks, time, logging
+import os, sys, re, json, tables, ticks, time, logging, ast
+from multiprocessing import Pool
+from threading import Lock
 from tempfile import gettempdir
 from os import path
 from collections import OrderedDict, namedtuple
@@ -11,12 +13,16 @@ import numpy.ma as ma
 from scipy.optimize import curve_fit
 import matplotlib as mpl
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from utils import get_args_from, isseq, set_defaults, number_mathformat, number_format, hashargs, noop
 from itertools import product
 from locket import lock_file
 
 from i18n import _
 from safeeval import safeeval
+import statistics
+from sources import is_virtual, is_sharded, VirtualMergedTable, ShardedTable, open_source, blocks, source_files
 
 logging.basicConfig(level = logging.DEBUG, format = '%(filename)s:%(funcName)s:%(lineno)d:%(message)s')
 
@@ -25,6 +31,22 @@ log = logging.getLogger('plot')
 # override eval by safe version
 eval = safeeval()
 
+# each plot is drawn on its own figure, but the font and mathtext caches of matplotlib are shared,
+# so figures are drawn and saved one at a time, the data of plots is prepared in parallel
+draw_lock = Lock()
+
+# rows per task when histograms and profiles are computed in worker processes (see Plot._reduce)
+reduce_blocksize = 250000
+
+# the cost of preparing a plot is estimated in values evaluated, about a second per million (see Plot.cost),
+# rows averaged over a rate window are evaluated one by one, which costs window_cost values per row and expression,
+# drawing the rows of these diagram types costs about as much as evaluating some more values
+window_cost = 4
+draw_costs = {'xy':0.5, 'map':0.5, 'h2':0.5}
+
+# rows sampled to estimate the fraction of rows passing a cut, see Plot.explain
+explain_sample = 10000
+
 
 TableSpecs = namedtuple('TableSpecs', ('title', 'colnames', 'units', 'rows'))
 
@@ -42,16 +64,307 @@ def available_tables(d = os.path.dirname(__file__) + '/data'):
 
     for f in files:
         try:
-            h5 = tables.openFile(f, 'r')
-            for n in h5.walkNodes(classname = 'Table'):
-                tab = f[dirlen+1:] + ':' + n._v_pathname
-                tabs[tab] = TableSpecs(n._v_title, n.colnames, json.loads(n.attrs.units), int(n.nrows))
-            h5.close()
+            mtime = path.getmtime(f)
+            if f not in _catalog or _catalog[f][0] != mtime:  # only (re)read new or changed files
+                filetabs = OrderedDict()
+                h5 = tables.openFile(f, 'r')
+                for n in h5.walkNodes(classname = 'Table'):
+                    if 'dimension_key' in n.attrs or 'shard' in n.attrs:
+                        continue  # side table or shard, its columns are listed with the tables referencing it
+                    colnames, units = list(n.colnames), json.loads(n.attrs.units)
+                    dim = Dimension.of(n)
+                    if dim:
+                        colnames.extend(dim.colnames)
+                        units.extend(dim.units)
+                    filetabs[n._v_pathname] = TableSpecs(n._v_title, colnames, units, int(n.nrows))
+                for n in h5.walkNodes(classname = 'Group'):
+                    if is_virtual(n) or is_sharded(n):
+                        try:
+                            v = VirtualMergedTable(n) if is_virtual(n) else ShardedTable(n)
+                        except:
+                            log.warning('cannot open table %s in %s', n._v_pathname, f)
+                            continue
+                        colnames, units = list(v.colnames), json.loads(v.attrs.units)
+                        dim = Dimension.of(v)
+                        if dim:
+                            colnames.extend(dim.colnames)
+                            units.extend(dim.units)
+                        v.close()
+                        filetabs[n._v_pathname] = TableSpecs(v._v_title, colnames, units, int(v.nrows))
+                h5.close()
+                _catalog[f] = mtime, filetabs
+            for n, specs in _catalog[f][1].iteritems():
+                tabs[f[dirlen+1:] + ':' + n] = specs
         except:
             pass
 
     return tabs
 
+_catalog = {}  # filename --> (mtime, tables in file)
+
+
+def column_units(table):
+    'return a dict column --> unit of table, including the columns of its dimension'
+    units = OrderedDict(zip(table.colnames, json.loads(table.attrs.units)))
+    dim = Dimension.of(table)
+    if dim:
+        units.update(zip(dim.colnames, dim.units))
+    return units
+
+
+class Dimension(object):
+    'columns of a dimension table (see rawdata.create_dimension), looked up by the key column of the referencing table'
+
+    def __init__(self, table, key):
+        self.key = key
+        self.colnames = [c for c in table.colnames if c != key]
+        units = json.loads(table.attrs.units)
+        self.units = [u for c, u in zip(table.colnames, units) if c != key]
+
+        # dense lookup arrays indexed by key, the last element is nan for unknown keys
+        keys = table.col(key).astype(int)
+        n = keys.max() + 2 if len(keys) else 1
+        self.lookup = {}
+        for c in self.colnames:
+            a = np.empty(n)
+            a.fill(np.nan)
+            a[keys] = table.col(c)
+            self.lookup[c] = a
+
+    @staticmethod
+    def of(table):
+        'return the Dimension referenced by table or None'
+        if 'dimension' not in table.attrs:
+            return None
+        spec = json.loads(table.attrs.dimension)
+        return Dimension(table._v_file.getNode(spec['table']), spec['key'])
+
+    def __call__(self, column, key):
+        'look up column for key, key may be a number or an array'
+        a = self.lookup[column]
+        return a[np.clip(np.asarray(key).astype(int), -1, len(a) - 1)]
+
+
+def compile_expression(x, colnames, dim = None, used = None):
+    """
+    compile the expression x to a function of a row, the columns in colnames (and rate, count, weight)
+    are mapped to row["name"], the columns of dim (a Dimension) are looked up by its key,
+    the names of the columns used are added to the set used
+    """
+    fields = set(colnames)
+    fields.add('rate')
+    fields.add('count')
+    fields.add('weight')
+
+    def repl(m):  # map T_a --> row['T_a'], h --> dim('h', row['stat']), etc.
+        v = m.group(0)
+        if used is not None:
+            used.add(dim.key if dim and v in dim.lookup else v)
+        if dim and v in dim.lookup:
+            return 'dim("{}", row["{}"])'.format(v, dim.key)
+        return 'row["' + v + '"]'
+
+    fields = sorted(fields, key = len, reverse = True)  # longest match first
+    x = re.sub('(?<!\\w)(' + '|'.join(map(re.escape, fields)) + ')(?!\\w)', repl, x)
+    return eval('lambda dim: lambda row: ({})'.format(x))(dim)
+
+
+def time_bounds(cut, column = 'time'):
+    """
+    return (lower, upper) bounds of column that follow from the cut expression,
+    comparisons of column with constant expressions are combined by and, or, &, |,
+    (-inf, inf) if there are no bounds or they cannot be determined
+    """
+    unbounded = (-np.inf, np.inf)
+
+    def is_column(node):
+        return isinstance(node, ast.Name) and node.id == column
+
+    def bounds(node):
+        if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr)):
+            node = ast.BoolOp(ast.And() if isinstance(node.op, ast.BitAnd) else ast.Or(), [node.left, node.right])
+        if isinstance(node, ast.BoolOp):
+            b = [bounds(v) for v in node.values]
+            if isinstance(node.op, ast.And):
+                return max(l for l, u in b), min(u for l, u in b)
+            return min(l for l, u in b), max(u for l, u in b)
+        if isinstance(node, ast.Compare):
+            lower, upper = unbounded
+            operands = [node.left] + node.comparators
+            for a, op, b in zip(operands, node.ops, operands[1:]):
+                if is_column(b):  # 5 < time --> time > 5
+                    a, b = b, a
+                    op = {ast.Lt:ast.Gt(), ast.LtE:ast.GtE(), ast.Gt:ast.Lt(), ast.GtE:ast.LtE()}.get(type(op), op)
+                if not is_column(a):
+                    continue
+                try:  # constant, like since04('2012-01-01')
+                    v = float(eval(compile(ast.Expression(b), '<cut>', 'eval')))
+                except:
+                    continue
+                if isinstance(op, (ast.Gt, ast.GtE, ast.Eq)):
+                    lower = max(lower, v)
+                if isinstance(op, (ast.Lt, ast.LtE, ast.Eq)):
+                    upper = min(upper, v)
+            return lower, upper
+        return unbounded
+
+    if not cut:
+        return unbounded
+    try:
+        return bounds(ast.parse(cut.strip(), mode = 'eval').body)
+    except SyntaxError:
+        return unbounded
+
+
+def compile_scan(table, exprs, cut = None):
+    'return the functions of the expressions exprs and of cut (or None) for rows of table, and the set of columns they use'
+    colnames = list(table.colnames)
+    dim = Dimension.of(table)
+    if dim:
+        colnames.extend(dim.colnames)
+    used = set()
+    functions = [compile_expression(e, colnames, dim, used) for e in exprs]
+    cut = compile_expression(cut, colnames, dim, used) if cut else None
+    return functions, cut, used
+
+
+def evaluate_columns(rows, functions, cut = None):
+    'evaluate functions on whole columns of the rows (a structured array) that pass cut, return a list of arrays, fails if they use \'and\', \'if\', etc.'
+    with np.errstate(all = 'ignore'):
+        mask = np.ones(len(rows), dtype = bool)
+        if cut:
+            mask &= np.asarray(cut(rows)).astype(bool)
+        return [np.broadcast_arrays(np.asarray(f(rows)), mask)[0][mask] for f in functions]
+
+
+def evaluate(rows, functions, cut = None):
+    """
+    evaluate functions for the rows (a structured array) that pass cut, return a list of arrays,
+    the functions are evaluated on whole columns, row by row if that fails (if they use 'and', 'if', etc.)
+    """
+    try:
+        return evaluate_columns(rows, functions, cut)
+    except Exception:
+        log.debug('evaluating row by row')
+
+    data = [[] for f in functions]
+    for row in rows:
+        if cut is None or cut(row):
+            for d, f in zip(data, functions):
+                d.append(f(row))
+    return [np.array(d) for d in data]
+
+
+def scan_table(table, exprs, cut = None):
+    'evaluate the expressions exprs for the rows of table that pass cut block by block, return a list of arrays'
+    functions, cut, used = compile_scan(table, exprs, cut)
+    data = [evaluate(rows, functions, cut) for rows in blocks(table, columns = used)]
+    if not data:
+        return [np.array([]) for e in exprs]
+    return [np.concatenate(d) for d in zip(*data)]
+
+
+def sample_ranges(nrows, n, runs = 100):
+    'return (start, stop) of up to runs evenly spaced runs of rows, n rows in total, a sample of the rows of a table stratified by position'
+    if n >= nrows:
+        return [(0, nrows)]
+    size = max(1, n // runs)
+    starts = np.linspace(0, nrows - size, min(runs, n // size)).astype(int)
+    return [(b, b + size) for b in starts]
+
+
+def sample_table(table, exprs, cut, n):
+    'like scan_table, but only for a sample of about n rows of table, see sample_ranges'
+    functions, cut, used = compile_scan(table, exprs, cut)
+    data = [evaluate(rows, functions, cut) for start, stop in sample_ranges(table.nrows, n)
+            for rows in blocks(table, start, stop, columns = used)]
+    if not data:
+        return [np.array([]) for e in exprs]
+    return [np.concatenate(d) for d in zip(*data)]
+
+
+def _scan_shard(args):
+    'scan_table for a shard, run in worker processes'
+    filename, node, exprs, cut = args
+    with tables.openFile(filename, 'r') as h5:
+        return scan_table(h5.getNode(node), exprs, cut)
+
+
+def reduce_block(data, mode, edges = None):
+    """
+    return the partial result of a histogram (mode h1, h2), profile (p) or xy plot/map of data, the arrays of x, y (and z),
+    with the binning edges (one per axis), merged by merge_partials,
+    for xy plots and maps edges is (accumulator type, arguments), the points are aggregated per cell (GridAccumulator)
+    or the line is decimated (LineAccumulator),
+    without edges the # of values, their ranges and the lowest positive values (for log axes) are returned
+    """
+    if edges is None:
+        n = len(data[0])
+        lower = [np.nanmin(d) if n else np.nan for d in data]
+        upper = [np.nanmax(d) if n else np.nan for d in data]
+        with np.errstate(invalid = 'ignore'):
+            positive = [np.min(d[d > 0]) if np.any(d > 0) else np.nan for d in data]
+        return n, np.array(lower, dtype = float), np.array(upper, dtype = float), np.array(positive, dtype = float)
+
+    if mode in ('xy', 'map'):
+        accumulator, args = edges
+        return accumulator(*args).fill(*data)
+
+    if mode in ('h1', 'h2'):
+        return HistogramAccumulator(edges).fill(*data)
+
+    if mode == 'p':
+        return ProfileAccumulator(edges[0]).fill(*data)
+
+    raise RuntimeError('unknow mode ' + mode)
+
+
+def merge_partials(mode, a, b):
+    'merge the partial results a and b (either may be None) of reduce_block, mode None for the ranges'
+    if a is None or b is None:
+        return b if a is None else a
+    if mode is None:
+        return a[0] + b[0], np.fmin(a[1], b[1]), np.fmax(a[2], b[2]), np.fmin(a[3], b[3])
+    return a.merge(b)
+
+
+def reduce_rows(rowsize, nexprs, workers, budget):
+    """
+    rows per block reduced by _reduce_block for rows of rowsize bytes and nexprs expressions of all plots reduced,
+    the blocks of all workers and the values evaluated from them must fit in the memory budget (bytes, 0 for none)
+    """
+    if budget <= 0:
+        return reduce_blocksize
+    rowsize += 16 * nexprs
+    return int(min(reduce_blocksize, max(1000, budget / 2 / workers / rowsize)))
+
+
+def _reduce_block(args):
+    """
+    reduce_block for each spec (mode, exprs, cut, edges) for the rows start to stop of a source,
+    read and merged in blocks of blocksize rows, run in worker processes
+    """
+    filename, node, start, stop, blocksize, specs = args
+    with open_source(filename, node) as table:
+        compiled = [compile_scan(table, exprs, cut) for mode, exprs, cut, edges in specs]
+        used = set().union(*[c[2] for c in compiled])
+        merged = [None for spec in specs]
+        for rows in blocks(table, start, stop, used, blocksize):
+            for k, ((mode, exprs, cut, edges), (functions, cutf, u)) in enumerate(zip(specs, compiled)):
+                partial = reduce_block(evaluate(rows, functions, cutf), mode, edges)
+                merged[k] = merge_partials(mode if edges is not None else None, merged[k], partial)
+        return merged
+
+
+def data_mtime(d):
+    'latest modification time of the HDF5 files in d'
+    mtime = 0
+    for p, d, f in os.walk(d):
+        for ff in f:
+            if ff.lower().endswith('.h5'):
+                mtime = max(mtime, path.getmtime(path.join(p, ff)))
+    return mtime
+
 
 def _get(d, k, default = None):
     v = d.get(k)
@@ -74,6 +387,173 @@ def get_binning(bins, data):
     return edges, centers, widths
 
 
+class HistogramAccumulator(object):
+    """
+    histogram with the bin edges given for each axis (one or two), filled chunk by chunk,
+    bins of uniform binnings are computed directly, other binnings are searched,
+    like numpy.histogram the bins include their lower edge, the last bin also its upper edge,
+    values below and above the edges are counted per axis in uflow and oflow,
+    the sums of the powers 1-4 (and of the products of the axes) of the values in the histogram
+    relative to the center of the edges are kept for their moments, partial accumulators are merged by merge
+    """
+
+    def __init__(self, edges):
+        self.edges = [np.asarray(e, dtype = float) for e in edges]
+        self.shape = tuple(len(e) - 1 for e in self.edges)
+        self.uniform = []
+        for e in self.edges:
+            d = np.diff(e)
+            self.uniform.append(len(d) > 0 and d[0] > 0 and np.all(np.abs(d - d[0]) <= 1e-9 * d[0]))
+        self.centers = np.array([(e[0] + e[-1]) / 2 for e in self.edges])
+        self.contents = np.zeros(self.shape, dtype = int)
+        self.uflow = np.zeros(len(edges), dtype = int)
+        self.oflow = np.zeros(len(edges), dtype = int)
+        self.sums = np.zeros((len(edges), 5))  # sum of weight * (value - center) ** k
+        self.cross = 0.0  # sum of weight * products of the values - center of the axes
+
+    def _bins(self, axis, x):
+        'return the bin indices of the values x along axis, and the mask of the values inside the edges'
+        e = self.edges[axis]
+        n = len(e) - 1
+        with np.errstate(invalid = 'ignore'):
+            inside = (e[0] <= x) & (x <= e[-1])
+        k = np.zeros(len(x), dtype = int)
+        x = x[inside]
+        if self.uniform[axis]:
+            ki = np.minimum(((x - e[0]) * (n / (e[-1] - e[0]))).astype(int), n - 1)
+            ki[x < e[ki]] -= 1  # correct rounding errors, like numpy.histogram
+            ki[(x >= e[ki + 1]) & (ki != n - 1)] += 1
+        else:
+            ki = np.minimum(np.searchsorted(e, x, 'right') - 1, n - 1)
+        k[inside] = ki
+        return k, inside
+
+    def fill(self, *data, **kwargs):
+        'add the values data, an array per axis, with the weights given as keyword argument (default: 1)'
+        weights = kwargs.get('weights')
+        data = [np.asarray(d, dtype = float).ravel() for d in data]
+        if weights is not None:
+            weights = np.broadcast_arrays(np.asarray(weights, dtype = float).ravel(), data[0])[0]
+            if self.contents.dtype.kind != 'f':
+                self.contents = self.contents.astype(float)
+                self.uflow, self.oflow = self.uflow.astype(float), self.oflow.astype(float)
+
+        def total(m):
+            return np.count_nonzero(m) if weights is None else np.sum(weights[m])
+
+        index = 0
+        valid = np.ones(len(data[0]), dtype = bool)
+        for a, (x, e) in enumerate(zip(data, self.edges)):
+            k, inside = self._bins(a, x)
+            with np.errstate(invalid = 'ignore'):
+                self.uflow[a] += total(x < e[0])
+                self.oflow[a] += total(x > e[-1])
+            index = index * self.shape[a] + k
+            valid &= inside
+
+        w = None if weights is None else weights[valid]
+        counts = np.bincount(np.asarray(index)[valid], w, minlength = self.contents.size)
+        self.contents += counts.reshape(self.shape).astype(self.contents.dtype)
+
+        u = [x[valid] - c for x, c in zip(data, self.centers)]
+        for a, ua in enumerate(u):
+            p = np.ones(len(ua)) if w is None else w
+            for k in xrange(5):
+                self.sums[a, k] += np.sum(p)
+                p = p * ua
+        if len(u) == 2:
+            self.cross += np.sum(u[0] * u[1] * (1 if w is None else w))
+        return self
+
+    def merge(self, other):
+        'add the contents of the accumulator other with the same edges'
+        if self.contents.dtype != other.contents.dtype:
+            self.contents, self.uflow, self.oflow = [a.astype(float) for a in (self.contents, self.uflow, self.oflow)]
+        self.contents += other.contents
+        self.uflow += other.uflow
+        self.oflow += other.oflow
+        self.sums += other.sums
+        self.cross += other.cross
+        return self
+
+    def moments(self, axis = 0):
+        'return (mean, std, skewness, kurtosis) of the values in the histogram along axis'
+        w, s1, s2, s3, s4 = self.sums[axis]
+        with np.errstate(all = 'ignore'):
+            m = s1 / w
+            m2 = s2 / w - m ** 2
+            m3 = s3 / w - 3 * m * s2 / w + 2 * m ** 3
+            m4 = s4 / w - 4 * m * s3 / w + 6 * m ** 2 * s2 / w - 3 * m ** 4
+            std = np.sqrt(max(m2, 0))
+            return self.centers[axis] + m, std, m3 / std ** 3, m4 / std ** 4
+
+    def cov(self):
+        'return the covariance of the values of the two axes in the histogram'
+        w = self.sums[0, 0]
+        with np.errstate(all = 'ignore'):
+            return self.cross / w - (self.sums[0, 1] / w) * (self.sums[1, 1] / w)
+
+
+class ProfileAccumulator(object):
+    """
+    profile of y in the bins of x given by edges (l <= x < u), filled chunk by chunk,
+    keeps the # of values, their mean and sum of squared deviations per bin,
+    partial accumulators are merged by merge (pairwise update of mean and squared deviations)
+    """
+
+    def __init__(self, edges):
+        self.edges = np.asarray(edges, dtype = float)
+        n = max(len(self.edges) - 1, 0)
+        self.count = np.zeros(n, dtype = int)
+        self._mean = np.zeros(n)
+        self._m2 = np.zeros(n)
+
+    def fill(self, x, y):
+        'add the values y at x'
+        x = np.asarray(x, dtype = float).ravel()
+        y = np.broadcast_arrays(np.asarray(y, dtype = float).ravel(), x)[0]
+        n = len(self.count)
+        k = np.digitize(x, self.edges) - 1  # nan is beyond the last edge
+        m = (0 <= k) & (k < n)
+        k, y = k[m], y[m]
+        count = np.bincount(k, minlength = n)
+        with np.errstate(all = 'ignore'):
+            mean = np.bincount(k, y, minlength = n) / count
+            m2 = np.bincount(k, (y - mean[k]) ** 2, minlength = n)
+        return self._add(count, mean, m2)
+
+    def _add(self, count, mean, m2):
+        total = self.count + count
+        with np.errstate(all = 'ignore'):
+            delta = mean - self._mean
+            f = count / total.astype(float)
+            self._mean = np.where(count > 0, self._mean + delta * f, self._mean)
+            self._m2 = np.where(count > 0, self._m2 + m2 + delta ** 2 * self.count * f, self._m2)
+        self.count = total
+        return self
+
+    def merge(self, other):
+        'add the values of the accumulator other with the same edges'
+        return self._add(other.count, other._mean, other._m2)
+
+    @property
+    def mean(self):
+        'mean of y per bin, nan for empty bins'
+        return np.where(self.count > 0, self._mean, np.nan)
+
+    @property
+    def std(self):
+        'standard deviation of y per bin, nan for empty bins'
+        with np.errstate(all = 'ignore'):
+            return np.where(self.count > 0, np.sqrt(self._m2 / self.count), np.nan)
+
+    @property
+    def sem(self):
+        'standard error of the mean of y per bin, nan for empty bins'
+        with np.errstate(all = 'ignore'):
+            return self.std / np.sqrt(self.count)
+
+
 def get_cumulative(bincontents, binerrors, cumulative = 0, binwidths = 1):
     cumulative = float(cumulative)
     if cumulative > 0:
@@ -113,17 +593,196 @@ def get_step_points(bincontents, binedges):
     return x, y
 
 
-def adjust_limits(xy, data, limits = None, marl = 0.05, maru = 0.05):
+def adjust_limits(ax, xy, data, limits = None, marl = 0.05, maru = 0.05):
     assert xy in ('x', 'y')
-    lim = getattr(plt, xy + 'lim')
     if limits is None:
-        limits = lim()
+        limits = getattr(ax, 'get_' + xy + 'lim')()
     mi, ma = limits
     data = data[np.isfinite(data)]
     mind = np.min(data)
     maxd = np.max(data)
     span = maxd - mind
-    lim(min(mi, min(data) - marl * span), max(ma, max(data) + maru * span))
+    getattr(ax, 'set_' + xy + 'lim')(min(mi, min(data) - marl * span), max(ma, max(data) + maru * span))
+
+def decimate(x, y, columns, lower = None, upper = None, log = False):
+    """
+    return x, y reduced to the first, last, minimum and maximum point of each of the columns intervals of x
+    between lower and upper (default: range of x), points outside are reduced into one interval on either side,
+    x must be ordered, the intervals are the pixel columns of the axes so the line drawn looks the same,
+    points with y nan are kept as they break the line, the intervals are logarithmic if log
+    """
+    n = len(x)
+    if n <= 4 * columns:
+        return x, y
+    t = np.log10(x) if log else np.asarray(x, dtype = float)
+    lower = t[0] if lower is None else (np.log10(lower) if log else lower)
+    upper = t[-1] if upper is None else (np.log10(upper) if log else upper)
+    if not upper > lower:
+        return x, y
+
+    k = np.clip(np.floor((t - lower) * (columns / (upper - lower))), -1, columns).astype(int)
+    starts = np.flatnonzero(np.concatenate(([True], k[1:] != k[:-1])))  # first point of each interval
+    ends = np.concatenate((starts[1:], [n])) - 1
+    group = np.repeat(np.arange(len(starts)), ends - starts + 1)
+
+    def first(match):  # index of the first match in each interval that has one
+        i = np.flatnonzero(match)
+        return i[np.unique(group[i], return_index = True)[1]]
+
+    with np.errstate(invalid = 'ignore'):
+        counts = ends - starts + 1
+        ymin = first(y == np.repeat(np.fmin.reduceat(y, starts), counts))
+        ymax = first(y == np.repeat(np.fmax.reduceat(y, starts), counts))
+    keep = np.unique(np.concatenate((starts, ends, ymin, ymax, np.flatnonzero(np.isnan(y)))))
+    return x[keep], y[keep]
+
+
+def grid_cells(x, y, columns, rows, xrange, yrange):
+    'return the cells (row * columns + column, row 0 at ylower) of the points x, y in the rectangle xrange x yrange, and the mask of the points inside'
+    (x0, x1), (y0, y1) = xrange, yrange
+    with np.errstate(invalid = 'ignore'):
+        inside = (x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)
+    x, y = x[inside], y[inside]
+    # points on the upper edges go into the last cell
+    cells = (np.minimum(np.floor((y - y0) * (rows / (y1 - y0))), rows - 1).astype(int) * columns
+             + np.minimum(np.floor((x - x0) * (columns / (x1 - x0))), columns - 1).astype(int))
+    return cells, inside
+
+
+def cell_max(cells, z, size):
+    'return the maximum of z in each of size cells, nan if empty'
+    image = np.full(size, np.nan)
+    if len(cells):
+        order = np.argsort(cells, kind = 'mergesort')
+        cells = cells[order]
+        starts = np.flatnonzero(np.concatenate(([True], cells[1:] != cells[:-1])))  # first point of each cell
+        image[cells[starts]] = np.maximum.reduceat(z[order], starts)
+    return image
+
+
+def aggregate(x, y, z, columns, rows, xrange, yrange, mode = 'mean'):
+    """
+    return the image (rows x columns, row 0 at ylower) of the points x, y in cells of the rectangle xrange x yrange,
+    the count of points (mode count), the mean or the maximum of z (mode mean or max) in each cell, nan if empty
+    """
+    cells, inside = grid_cells(x, y, columns, rows, xrange, yrange)
+    if mode != 'count':
+        z = z[inside]
+        with np.errstate(invalid = 'ignore'):
+            finite = np.isfinite(z)
+        cells, z = cells[finite], z[finite]
+
+    n = np.bincount(cells, minlength = rows * columns).astype(float)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        if mode == 'count':
+            image = n
+        elif mode == 'mean':
+            image = np.bincount(cells, weights = z, minlength = rows * columns) / n
+        elif mode == 'max':
+            image = cell_max(cells, z, rows * columns)
+        else:
+            raise ValueError('unknown density mode ' + mode)
+    image[n == 0] = np.nan
+    return image.reshape(rows, columns)
+
+
+class GridAccumulator(object):
+    """
+    the points x, y aggregated in a grid of columns x rows cells over xrange x yrange (see aggregate), filled chunk by chunk,
+    the axes are divided logarithmically if log, the ranges are given in log10 of the values then,
+    keeps the # of points and the # of finite z, their sum and maximum per cell, n counts all points, also those outside,
+    partial accumulators are merged by merge
+    """
+
+    def __init__(self, columns, rows, xrange, yrange, log = (False, False)):
+        self.columns, self.rows = columns, rows
+        self.ranges = xrange, yrange
+        self.log = log
+        size = columns * rows
+        self.n = 0
+        self.count = np.zeros(size, dtype = int)
+        self.zcount = np.zeros(size, dtype = int)
+        self.sum = np.zeros(size)
+        self.max = np.full(size, np.nan)
+
+    def fill(self, x, y, z = None):
+        'add the points x, y with the values z (if given)'
+        self.n += len(x)
+        t = []
+        for v, logscale in zip((x, y), self.log):
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                t.append(np.log10(v) if logscale else np.asarray(v, dtype = float))
+        size = len(self.count)
+        cells, inside = grid_cells(t[0], t[1], self.columns, self.rows, *self.ranges)
+        self.count += np.bincount(cells, minlength = size)
+        if z is not None:
+            z = np.asarray(z, dtype = float)[inside]
+            with np.errstate(invalid = 'ignore'):
+                finite = np.isfinite(z)
+            cells, z = cells[finite], z[finite]
+            self.zcount += np.bincount(cells, minlength = size)
+            self.sum += np.bincount(cells, weights = z, minlength = size)
+            self.max = np.fmax(self.max, cell_max(cells, z, size))
+        return self
+
+    def merge(self, other):
+        'add the points of the accumulator other with the same grid'
+        self.n += other.n
+        self.count += other.count
+        self.zcount += other.zcount
+        self.sum += other.sum
+        self.max = np.fmax(self.max, other.max)
+        return self
+
+    def image(self, mode = 'mean'):
+        'return the image like aggregate: the count of points, the mean or the maximum of z in each cell, nan if empty'
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            if mode == 'count':
+                image = np.where(self.count > 0, self.count, np.nan)
+            elif mode == 'mean':
+                image = np.where(self.zcount > 0, self.sum / self.zcount, np.nan)
+            elif mode == 'max':
+                image = self.max.copy()
+            else:
+                raise ValueError('unknown density mode ' + mode)
+        return image.reshape(self.rows, self.columns)
+
+    def centers(self, z = False):
+        'return x, y of the centers of the cells with points and the mean z of their points if z (else None)'
+        cells = np.flatnonzero(self.count)
+        (x0, x1), (y0, y1) = self.ranges
+        x = x0 + (cells % self.columns + 0.5) * ((x1 - x0) / self.columns)
+        y = y0 + (cells // self.columns + 0.5) * ((y1 - y0) / self.rows)
+        if self.log[0]: x = np.power(10, x)
+        if self.log[1]: y = np.power(10, y)
+        if not z:
+            return x, y, None
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            return x, y, self.sum[cells] / self.zcount[cells]
+
+
+class LineAccumulator(object):
+    """
+    the points of a line decimated to those that make a difference in each of the columns intervals of x (see decimate),
+    filled chunk by chunk in the order of the points, partial accumulators are merged by merge in the order of their points,
+    the points kept are those decimate keeps of all points at once
+    """
+
+    def __init__(self, columns, lower, upper, log = False):
+        self.args = columns, lower, upper, log
+        self.x = self.y = np.empty(0)
+
+    def fill(self, x, y):
+        'append the points x, y'
+        x = np.concatenate((self.x, np.asarray(x, dtype = float)))
+        y = np.concatenate((self.y, np.asarray(y, dtype = float)))
+        self.x, self.y = decimate(x, y, *self.args)
+        return self
+
+    def merge(self, other):
+        'append the points of the accumulator other, which follow these'
+        return self.fill(other.x, other.y)
+
 
 def sproduct(a, b):
     for x, y in product(a, b):
@@ -135,7 +794,7 @@ def sproduct(a, b):
 
 text_poss = map(np.array, [(1, -1), (-1, -1), (-1, 1), (1, 1), (0.5, -1), (-1, 0.5), (0.5, 1), (1, 0.5)])
 text_algn = [('left', 'top'), ('right', 'top'), ('right', 'bottom'), ('left', 'bottom'), ('center', 'top'), ('right', 'center'), ('center', 'bottom'), ('left', 'center')]
-stats_abrv = {'n':'N', 'u':'uflow', 'o':'oflow', 'm':'mean', 's':'std', 'p':'mode', 'e':'median', 'w':'skew', 'k':'kurtos', 'x':'excess', 'c':'cov'}
+stats_abrv = statistics.fields
 
 
 
@@ -216,6 +875,11 @@ class Plot(object):
         self.progress = 0  # reaching from 0 to 1
 
         self.axes = OrderedDict()
+        self.sample = int(config.get('sample') or 0)  # read only a sample of this many rows per source, see sample_table
+        self.drawn = None  # settings f, w, h as given once the data is prepared, see plot
+        self.figure = None
+        self.ax = None  # the axes plotted to, see selectAxes
+        self.interactive = False  # draw in a pyplot window, see show
 
 
 
@@ -237,12 +901,15 @@ class Plot(object):
 
 
     def _prepare_data(self):
+        # histograms and profiles of large tables are reduced blockwise in worker processes, their data is not kept
+        reducible = self._reducible()
+
         # create dict: source --> all expr for this source
         # prefilled with empty lists
         expr_data = {}
         joined_cuts = {}  # OR of all cuts
         for n, s in enumerate(self.sr):
-            if s:
+            if s and n not in reducible:
                 if s not in expr_data:
                     expr_data[s] = {}  #  add dict for every unique source s (plot n)
                 for v in ['x', 'y', 'z', 'c', 'xa', 'ya', 'za']:
@@ -265,14 +932,21 @@ class Plot(object):
         # loop over tables and fill data lists in expr_data
         units = {}
         self._get_data(expr_data, joined_cuts, units)
+        self._reduce(reducible, units)
+        self.progress = 1
         log.debug(units)
 
 
         # assing data arrays to x/y/z/c-data fields
         for v in ['x', 'y', 'z', 'c', 'xa', 'ya', 'za']:
-            setattr(self, v + 'data', [(expr_data[self.sr[i]][x] if x and self.sr[i] else None) for i, x in enumerate(getattr(self, v))])
+            setattr(self, v + 'data', [(expr_data[self.sr[i]][x] if x and self.sr[i] and i not in reducible else None) for i, x in enumerate(getattr(self, v))])
             setattr(self, v + 'unit', [(units[self.sr[i]][x] if x and self.sr[i] else None) for i, x in enumerate(getattr(self, v))])
 
+        # decimated lines of the xy plots and maps computed by _reduce, their aggregated points are drawn from the grid (see _aggregated)
+        for i, (edges, partial) in self.reduced.iteritems():
+            if isinstance(partial, LineAccumulator):
+                self.xdata[i], self.ydata[i] = partial.x, partial.y
+
         log.debug('source={}'.format(self.s))
         log.debug('srcavg={}'.format(self.sr))
         for v in ['x', 'y', 'z', 'c', 'xa', 'ya', 'za']:
@@ -294,50 +968,66 @@ class Plot(object):
             # source s has form 'filename:/path/to/table'
             # open HDF5 table
             ss = s.strip().split(':')
-            with tables.openFile(ss[0], 'r') as h5:
-                table = h5.getNode(ss[1])
+            with open_source(ss[0], ss[1]) as table:
                 window = float(eval(ss[2])) if ss[2] != 'None' else None
                 shift = float(ss[3]) if ss[3] != 'None' else 1
                 weight = ss[4] if ss[4] != 'None' else None
 
                 progr_factor = 1.0 / table.nrows / len(expr_data)
 
-                table_units = tuple(json.loads(table.attrs.units))
+                table_units = json.loads(table.attrs.units)
+                table_colnames = list(table.colnames)
+                dim = Dimension.of(table)
+                if dim:
+                    table_units.extend(dim.units)
+                    table_colnames.extend(dim.colnames)
+
+                source_files = table.filenames if isinstance(table, (VirtualMergedTable, ShardedTable)) else [ss[0]]
 
                 def unit(var):
                     try:
-                        return table_units[table.colnames.index(var.strip())]
+                        return table_units[table_colnames.index(var.strip())]
                     except:
                         return '?'
 
                 units[s] = dict([(e, unit(e)) for e in exprs.keys()])
 
 
+                used = set()  # columns used by the expressions
+
                 def compile_function(x):
-                    fields = set(table.colnames)
-                    fields.add('rate')
-                    fields.add('count')
-                    fields.add('weight')
-                    for v in fields:  # map T_a --> row['T_a'], etc.
-                        x = re.sub('(?<!\\w)' + re.escape(v) + '(?!\\w)',
-                                    'row["' + v + '"]', x)
-                    return eval('lambda row: ({})'.format(x))
+                    return compile_expression(x, table_colnames, dim, used)
+
+                reader = self._reader(table, window)
+
+                if reader == 'sample':
+                    keys = exprs.keys()
+                    for k, d in zip(keys, sample_table(table, keys, filters.get(s), self.sample)):
+                        exprs[k] = d
+                    continue
 
+                if reader == 'shards':
+                    self._scan_shards(table, exprs, filters.get(s), progr_prev, 1.0 / len(expr_data))
+                    continue
+
+                if reader == 'blocks':
+                    self._scan(table, exprs, filters.get(s), progr_prev, progr_factor)
+                    continue
 
                 # compile the expressions
                 exprs = dict([(compile_function(e), d) for e, d in exprs.iteritems()])
 
                 def average():
                     # look if there is data for this source in the cache
-                    cachedir = self.config['cachedir'] or gettempdir()
-                    cachefile = os.path.join(cachedir, 'avg{}.h5'.format(hashargs(s)))
-                    cachefile = os.path.abspath(cachefile)
+                    cachefile = self._average_cachefile(s)
                     log.debug('cachefile %s', cachefile)
 
 
                     def average_cached():
                         if not self.config['cachedir']:
                             raise  # always fail it cache is disabled
+                        if path.getmtime(cachefile) < max(path.getmtime(f) for f in source_files):
+                            raise RuntimeError('cache outdated')
                         with tables.openFile(cachefile) as cacheh5:
                             cachetable = cacheh5.getNode('/data')
                             progr_factor = 1.0 / cachetable.nrows / len(expr_data)
@@ -433,7 +1123,6 @@ class Plot(object):
 
 
                 def prefilter(data, filterexpr):
-                    filterexpr = compile_function(filterexpr)
                     for row in data:
                         if filterexpr(row):
                             yield row
@@ -442,14 +1131,14 @@ class Plot(object):
                 def updateProgress(row, fac):
                     self.progress = progr_prev + row.nrow * fac
 
-                if window:
-                    tableiter = average()
-                    updateProgress = noop  # progress update is done inside average()
-                else:
-                    tableiter = table.iterrows()
+                if s in filters:
+                    filterexpr = compile_function(filters[s])
+
+                tableiter = average()
+                updateProgress = noop  # progress update is done inside average()
 
                 if s in filters:
-                    tableiter = prefilter(tableiter, filters[s])
+                    tableiter = prefilter(tableiter, filterexpr)
 
                 for row in tableiter:
                     for expr, data in exprs.iteritems():
@@ -461,22 +1150,406 @@ class Plot(object):
                 for k in d.keys():
                     d[k] = np.array(d[k])
 
-        # done with getting data
-        self.progress = 1
+
+    def _reader(self, table, window):
+        """
+        return how _get_data reads the rows of table: 'sample' of the rows, 'shards' in parallel, 'blocks' of rows
+        (evaluated on whole columns, row by row only if that fails, see evaluate) or 'window' (averaged row by row)
+        """
+        if window:  # the rates of averaged rows need all rows
+            return 'window'
+        if self.sample:
+            return 'sample'
+        if isinstance(table, ShardedTable):
+            return 'shards'
+        return 'blocks'
+
+
+    def _scan(self, table, exprs, cut, progr_prev, progr_factor):
+        'fill the data lists in exprs with the data of the rows of table that pass cut, block by block'
+        keys = exprs.keys()
+        functions, cut, used = compile_scan(table, keys, cut)
+        data = [[] for k in keys]
+        done = 0
+        for rows in blocks(table, columns = used):
+            for d, r in zip(data, evaluate(rows, functions, cut)):
+                d.append(r)
+            done += len(rows)
+            self.progress = progr_prev + done * progr_factor
+
+        for k, d in zip(keys, data):
+            exprs[k] = np.concatenate(d) if d else np.array([])
+
+
+    def _imap(self, function, tasks, progr_prev, progr_share):
+        'yield function(task) for each of tasks in order, computed by a pool of worker processes if configured'
+        workers = min(int(self.config.get('workers') or 1), len(tasks))
+        pool = Pool(workers) if workers > 1 else None
+        try:
+            results = pool.imap(function, tasks) if pool else (function(t) for t in tasks)
+            for i, result in enumerate(results):
+                self.progress = progr_prev + (i + 1.0) / len(tasks) * progr_share
+                yield result
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+
+    def _scan_shards(self, table, exprs, cut, progr_prev, progr_share):
+        'fill the data lists in exprs with the data of the shards of table in the time range of cut, in parallel'
+        lower, upper = time_bounds(cut)
+        shards = table.select(lower, upper)
+        log.debug('scanning %d of %d shards, %s <= time <= %s', len(shards), len(table.shards), lower, upper)
+
+        keys = exprs.keys()
+        tasks = [(f, n, keys, cut) for f, n in shards]
+        data = [[] for k in keys]
+        for result in self._imap(_scan_shard, tasks, progr_prev, progr_share):
+            for d, r in zip(data, result):
+                d.append(r)
+
+        # concatenate the data of the shards (in time order)
+        for k, d in zip(keys, data):
+            exprs[k] = np.concatenate(d) if d else np.array([])
+
+
+    def _reducible(self):
+        """
+        return the indices of the plots that are computed by _reduce: histograms and profiles of large tables
+        if there are several workers, all plots if holding the data would exceed the memory budget (config memory, MB),
+        plots of sources averaged over a rate window are always computed from the data held in memory, as are samples
+        """
+        if self.sample:
+            return []
+        workers = int(self.config.get('workers') or 1)
+        budget = float(self.config.get('memory') or 0) * 2 ** 20
+
+        sources = {}  # source --> (# of rows, expressions)
+        for i, m in enumerate(self.m):
+            if m and self.s[i]:
+                s = self.sr[i]
+                if s not in sources:
+                    filename, node = s.split(':')[:2]
+                    with open_source(filename, node) as table:
+                        sources[s] = table.nrows, set()
+                sources[s][1].update(e for e in (getattr(self, v)[i] for v in ['x', 'y', 'z', 'c', 'xa', 'ya', 'za']) if e)
+
+        # the data is evaluated into arrays of 8 byte values, block by block
+        size = sum(n * len(exprs) * 8 for n, exprs in sources.values())
+        streaming = budget > 0 and size > budget
+        if streaming:
+            log.info('data of %.0f MB exceeds the memory budget, streaming', size / 2.0 ** 20)
+
+        reducible = []
+        for i, m in enumerate(self.m):
+            if not (m and self.s[i] and self.x[i]) or self.rw[i]:
+                continue
+            if m in ('h1', 'h2', 'p') and (m == 'h1' or self.y[i]):
+                if streaming or (workers > 1 and sources[self.sr[i]][0] > reduce_blocksize):
+                    reducible.append(i)
+            elif m in ('xy', 'map') and self.y[i] and streaming:
+                reducible.append(i)
+        return reducible
+
+
+    def _average_cachefile(self, s):
+        'the file caching the rows of source s averaged over its rate window'
+        cachedir = self.config['cachedir'] or gettempdir()
+        return os.path.abspath(os.path.join(cachedir, 'avg{}.h5'.format(hashargs(s))))
+
+
+    def _cached_rows(self, s):
+        'the # of rows of source s averaged over its rate window in the cache, None if they are not cached or outdated'
+        cachefile = self._average_cachefile(s)
+        filename, node = s.split(':')[:2]
+        try:
+            if not self.config['cachedir'] or path.getmtime(cachefile) < max(path.getmtime(f) for f in source_files(filename, node)):
+                return None
+            with tables.openFile(cachefile) as h5:
+                return h5.getNode('/data').nrows
+        except:
+            return None
+
+
+    def cost(self, catalog = None):
+        """
+        estimate the cost of preparing the data in values evaluated (see window_cost and draw_costs) before any is read,
+        from the rows of the sources, taken from catalog (see available_tables) if given, the expressions per source,
+        the rate windows and their cached averages, the diagram types and the sample size
+        """
+        sources = OrderedDict()  # source --> [rows, expressions, draw cost per row]
+        for i, m in enumerate(self.m):
+            if not (m and self.s[i]):
+                continue
+            s = self.sr[i]
+            if s not in sources:
+                if catalog is not None and self.s[i] in catalog:
+                    rows = catalog[self.s[i]].rows
+                else:
+                    filename, node = s.split(':')[:2]
+                    with open_source(filename, node) as table:
+                        rows = table.nrows
+                sources[s] = [rows, set(), 0]
+            sources[s][1].update(e for e in (getattr(self, v)[i] for v in ['x', 'y', 'z', 'c', 'xa', 'ya', 'za']) if e)
+            sources[s][2] += draw_costs.get(m, 0)
+
+        cost = 0
+        for s, (rows, exprs, draw) in sources.iteritems():
+            window = s.split(':')[2] != 'None'
+            cached = self._cached_rows(s) if window else None
+            if self.sample and not window:
+                rows = min(rows, self.sample)
+            if cached is not None:  # the averaged rows are read from the cache
+                cost += cached * (len(exprs) + draw)
+            else:
+                cost += rows * (len(exprs) * (window_cost if window else 1) + draw)
+        return cost
+
+
+    def explain(self, catalog = None):
+        """
+        return the plan of preparing the data without reading more than a sample: for each source the files and table read,
+        the expressions, cut and columns, the rows read and the rows passing the cut (estimated from explain_sample rows),
+        whether the averages over a rate window are cached and how the rows are evaluated, and the estimated cost
+        """
+        workers = int(self.config.get('workers') or 1)
+        budget = float(self.config.get('memory') or 0) * 2 ** 20
+        datadir = self.config.get('datadir')
+        reducible = self._reducible()
+
+        def relative(f):
+            return path.relpath(f, datadir) if datadir else f
+
+        sources = OrderedDict()  # source --> plot indices
+        for i, m in enumerate(self.m):
+            if m and self.s[i]:
+                sources.setdefault(self.sr[i], []).append(i)
+
+        plan = OrderedDict()
+        plan['cost'] = self.cost(catalog)
+        plan['sources'] = []
+        for s, plots in sources.iteritems():
+            filename, node, window = s.split(':')[:3]
+            window = window != 'None'
+            exprs = []
+            for i in plots:
+                for v in ['x', 'y', 'z', 'c', 'xa', 'ya', 'za']:
+                    e = getattr(self, v)[i]
+                    if e and e not in exprs:
+                        exprs.append(e)
+            cuts = [self.c[i] for i in plots]
+            cut = ' or '.join('({})'.format(c) for c in cuts) if all(cuts) else None  # as joined by _prepare_data
+
+            entry = OrderedDict()
+            entry['source'] = self.s[plots[0]]
+            entry['plots'] = plots
+            entry['expressions'] = exprs
+            entry['cut'] = cut
+
+            with open_source(filename, node) as table:
+                entry['table'] = 'virtual merged' if isinstance(table, VirtualMergedTable) else 'sharded' if isinstance(table, ShardedTable) else 'table'
+                files = table.filenames if isinstance(table, (VirtualMergedTable, ShardedTable)) else [filename]
+                rows = table.nrows
+                reader = self._reader(table, window)
+                if reader == 'shards' and any(i not in reducible for i in plots):
+                    # the shards outside the time range of the cut are skipped
+                    shards = table.select(*time_bounds(cut))
+                    files = files[:1] + [f for f, n in shards]
+                    rows = sum(r for f, n, tmin, tmax, r in table.shards if (f, n) in shards)
+                    entry['shards'] = '{} of {}'.format(len(shards), len(table.shards))
+                entry['files'] = [relative(f) for f in files]
+
+                if reader == 'window':
+                    entry['columns'] = list(table.colnames)  # averaging reads all columns
+                    cachefile = self._average_cachefile(s)
+                    cached = self._cached_rows(s)
+                    entry['cache'] = '{} {}'.format('hit' if cached is not None else 'miss', path.basename(cachefile))
+                    entry['rows read'] = cached if cached is not None else rows
+                    entry['rows after cut'] = None  # the cut applies to the averaged rows
+                    entry['evaluation'] = 'averaged rows read from the cache, row by row' if cached is not None \
+                        else 'averaged over the rate window row by row'
+                else:
+                    functions, cutf, used = compile_scan(table, exprs or ['1'], cut)
+                    entry['columns'] = sorted(used)
+                    entry['rows read'] = min(rows, self.sample) if self.sample else rows
+                    sample = [b for start, stop in sample_ranges(table.nrows, explain_sample) for b in blocks(table, start, stop, columns = used)]
+                    sampled = sum(len(b) for b in sample)
+                    try:
+                        passed = sum(len(evaluate_columns(b, functions, cutf)[0]) for b in sample)
+                        vectorized = True
+                    except Exception:
+                        passed = sum(len(evaluate(b, functions, cutf)[0]) for b in sample)
+                        vectorized = False
+                    total = min(table.nrows, self.sample) if self.sample else table.nrows  # the sample is spread over all shards
+                    entry['rows after cut'] = int(round(float(passed) / sampled * total)) if sampled else 0
+
+                    how = 'vectorized' if vectorized else 'row by row'
+                    entry['evaluation'] = {'sample':'sample of about {} rows, {}'.format(self.sample, how),
+                                           'shards':'shards scanned by {} workers, {}'.format(workers, how),
+                                           'blocks':'scanned block by block, {}'.format(how)}[reader]
+                    reduced = [i for i in plots if i in reducible]
+                    if reduced:
+                        blocksize = reduce_rows(table.dtype.itemsize, sum(len(self._reduced_exprs(i)) + 1 for i in reduced), workers, budget)
+                        entry['evaluation'] += ', plots {} reduced in blocks of {} rows by {} workers'.format(reduced, blocksize, workers)
+
+            plan['sources'].append(entry)
+        return plan
+
+
+    def _reduced_exprs(self, i):
+        'the expressions of plot i evaluated by _reduce: x, y unless a 1D histogram and z of xy plots and maps'
+        exprs = [self.xa[i] or self.x[i]]
+        if self.m[i] != 'h1':
+            exprs.append(self.ya[i] or self.y[i])
+        if self.m[i] in ('xy', 'map') and self.z[i]:
+            exprs.append(self.za[i] or self.z[i])
+        return exprs
+
+
+    def _pixels(self):
+        'the width and height of the figure in pixels'
+        w = self._get('w', 25, float)
+        h = self._get('h', w / np.sqrt(2), float)
+        dpi = mpl.rcParams['figure.dpi']
+        return w / 2.54 * dpi, h / 2.54 * dpi
+
+
+    def _accumulator(self, i, ranges):
+        """
+        return (type, arguments) of the accumulator of the xy plot or map i computed by _reduce (see reduce_block),
+        ranges are the ranges of its data, lines are decimated in two intervals per pixel column like in _xy (LineAccumulator),
+        points are aggregated in one cell per pixel (GridAccumulator) and drawn like in _density, over the limits of the axes
+        or the range of the data
+        """
+        n, lower, upper, positive = ranges
+        w, h = self._pixels()
+        if self.m[i] == 'map':  # the map spans the data
+            limits = [(None, None, False), (None, None, False)]
+        else:
+            limits = [self._limits(i, 'x'), self._limits(i, 'y')]
+
+        kwargs = self.opts(i)
+        if not self.z[i] and kwargs.get('linestyle', '-') not in ('none', 'None', '', ' '):
+            l, u, logx = limits[0]
+            l = (positive[0] if logx else lower[0]) if l is None else l
+            u = upper[0] if u is None else u
+            return LineAccumulator, (int(2 * w), l, u, logx)
+
+        grid = []
+        for k, (l, u, logscale) in enumerate(limits):
+            l = (positive[k] if logscale else lower[k]) if l is None else l
+            u = upper[k] if u is None else u
+            if logscale:
+                with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                    l, u = np.log10(l), np.log10(u)
+            if not u > l:
+                l, u = l - 0.5, u + 0.5
+            grid.append((float(l), float(u)))
+        # the axes take the share of the figure given by the subplot parameters, before a colorbar takes its share
+        sp = mpl.rcParams
+        columns = max(1, int(sp['figure.subplot.right'] * w - sp['figure.subplot.left'] * w))
+        rows = max(1, int(sp['figure.subplot.top'] * h - sp['figure.subplot.bottom'] * h))
+        return GridAccumulator, (columns, rows, grid[0], grid[1], (limits[0][2], limits[1][2]))
+
+
+    def _reduce(self, plots, units):
+        """
+        compute the histograms, profiles, xy plots and maps of plots (map-reduce):
+        ranges of rows are evaluated block by block by worker processes, which return only partial results
+        (bin contents, the points aggregated per pixel, the decimated lines, see reduce_block), these are merged into self.reduced,
+        if the binning or grid depends on the data, the ranges of the data are determined in a first pass
+        """
+        self.reduced = {}  # plot index --> (edges, merged partial result)
+        sources = OrderedDict()
+        for i in plots:
+            sources.setdefault(self.sr[i], []).append(i)
+
+        workers = int(self.config.get('workers') or 1)
+        budget = float(self.config.get('memory') or 0) * 2 ** 20
+        progr_prev = self.progress
+        progr_share = (1.0 - progr_prev) / max(len(sources), 1)
+        for s, plots in sources.iteritems():
+            filename, node = s.split(':')[:2]
+            with open_source(filename, node) as table:
+                nrows = table.nrows
+                rowsize = table.dtype.itemsize
+                table_units = column_units(table)
+                # merging is sequential, the rows of a virtual merged table depend on the rows before
+                sequential = isinstance(table, VirtualMergedTable)
+
+            specs = OrderedDict()  # plot index --> (mode, expressions, cut, axes)
+            for i in plots:
+                for v in ['x', 'y', 'z', 'c', 'xa', 'ya', 'za']:
+                    expr = getattr(self, v)[i]
+                    if expr:
+                        units.setdefault(s, {})[expr] = table_units.get(expr.strip(), '?')
+                specs[i] = self.m[i], self._reduced_exprs(i), self.c[i], {'h1':'x', 'h2':'xy', 'p':'x'}.get(self.m[i], '')
+
+            blocksize = reduce_rows(rowsize, sum(len(spec[1]) + 1 for spec in specs.values()), workers, budget)
+            if sequential:
+                ranges = [(0, nrows)]
+            else:
+                ranges = [(b, min(b + reduce_blocksize, nrows)) for b in xrange(0, nrows, reduce_blocksize)]
+
+            def map_reduce(specs, progr_prev, progr_share):
+                tasks = [(filename, node, start, stop, blocksize, specs) for start, stop in ranges]
+                merged = [None for spec in specs]
+                for partials in self._imap(_reduce_block, tasks, progr_prev, progr_share):
+                    merged = [merge_partials(spec[0] if spec[3] is not None else None, a, b)
+                              for spec, a, b in zip(specs, merged, partials)]
+                return merged
+
+            # first pass: # of values and ranges for binnings given by the # of bins only and for xy plots and maps
+            ranged = [i for i in plots if not specs[i][3] or any(np.isscalar(self.bins(i, a)) for a in specs[i][3])]
+            ranges_of = {}
+            share = progr_share
+            if ranged:
+                ranges_of = dict(zip(ranged, map_reduce([(None, specs[i][1], specs[i][2], None) for i in ranged],
+                                                        progr_prev, 0.2 * share)))
+                progr_prev += 0.2 * share
+                share *= 0.8
+
+            edges = []
+            for i in plots:
+                mode, exprs, cut, axes = specs[i]
+                if not axes:  # xy plot or map
+                    e = self._accumulator(i, ranges_of[i])
+                    log.debug('plot %d reduced by %s%s', i, e[0].__name__, e[1])
+                else:
+                    e = []
+                    for k, a in enumerate(axes):
+                        bins = self.bins(i, a)
+                        if np.isscalar(bins):
+                            n, lower, upper = ranges_of[i][:3]
+                            if bins == 0 and mode != 'p':
+                                bins = int(1 + np.log2(n))
+                            e.append(get_binning(bins, np.array([lower[k], upper[k]]))[0])
+                        else:
+                            e.append(get_binning(bins, None)[0])
+                edges.append((mode, exprs, cut, e))
+
+            # second pass: partial histograms, profiles, grids and lines
+            partials = map_reduce(edges, progr_prev, share)
+            for i, spec, partial in zip(plots, edges, partials):
+                if partial is None:  # no rows
+                    partial = reduce_block([np.array([]) for e in spec[1]], spec[0], spec[3])
+                self.reduced[i] = spec[3], partial
+            progr_prev += share
 
 
     __tick_density = 1.5
 
 
     def _configure_pre(self):
-        # configure plotlib
-        plt.clf()
-        plt.close('all')
+        # configure plotlib, the figure is not managed by pyplot, so plots can be drawn in threads
+        if self.interactive:
+            self.figure = plt.figure()
+        else:
+            self.figure = Figure()
+            FigureCanvasAgg(self.figure)
         self.f = self._get('f', 10, float)
         if 'map' in self.m: self.f *= 0.8  # smaller font if plotting map
-        plt.rc('font', **{'family':'sans-serif', 'sans-serif':['Dejavu Sans'], 'size':self.f})
-        # plt.rc('axes', grid = True)
-        plt.rc('lines', markeredgewidth = 0)
         w = self._get('w', 25, float)
         h = self._get('h', w / np.sqrt(2), float)
         # convert cm to inches
@@ -484,66 +1557,66 @@ class Plot(object):
         h = h / 2.54
         self.w = w
         self.h = h
-        plt.gcf().set_size_inches([w, h], forward = True);
+        self.figure.set_size_inches([w, h], forward = True);
 #        f = 0.09
 #        if 'map' in self.m: f = 0.06 # more margin if plotting map
 #        plt.gca().set_position([f, f, 1 - 2 * f, 1 - 2 * f])
 #        plt.subplots_adjust(left = f, bottom = f, right = 1 - f, top = 1 - f, wspace = 0, hspace = 0)
-        ticks.set_extended_locator(self.__tick_density)
-        self.axes[''] = plt.gca()
+        self.axes[''] = self.ax = self.figure.add_subplot(111)
+        ticks.set_extended_locator(self.__tick_density, axes = self.ax)
 
 
 
     def _configure_post(self):
-        plt.axes(self.axes[''])  # activate main axes
+        self.ax = self.axes['']  # main axes
 
         # title
-        if self.t: plt.title(self.t, fontsize = 1.4 * self.f)
+        if self.t: self.ax.set_title(self.t, fontsize = 1.4 * self.f)
 
-        if 'map' in self.m: return
+        if 'map' in self.m:
+            self._set_fontsize()
+            return
 
         # settings for main and twin axes
         for v, ax in self.axes.iteritems():
-            plt.axes(ax)
-
             # grid
-            plt.grid(which = 'major', axis = v or 'both', linestyle = '--' if v else '-', color = 'k', alpha = 0.4)
-            plt.grid(which = 'minor', axis = v or 'both', linestyle = '-.' if v else ':', color = 'k', alpha = 0.4)
+            ax.grid(which = 'major', axis = v or 'both', linestyle = '--' if v else '-', color = 'k', alpha = 0.4)
+            ax.grid(which = 'minor', axis = v or 'both', linestyle = '-.' if v else ':', color = 'k', alpha = 0.4)
 
             # set labels, scales and ranges
             for a in 'xy':
                 if v and a != v: continue  # on twins, set only axis
-                getattr(plt, '{}label'.format(a))(self.alabel(a, v))  # label
+                getattr(ax, 'set_{}label'.format(a))(self.alabel(a, v))  # label
                 s = getattr(self, a + 's' + ('tw' if a == v else ''))
                 if s:  # scale
-                    getattr(plt, '{}scale'.format(a))(s)
+                    getattr(ax, 'set_{}scale'.format(a))(s)
                 r = getattr(self, a + 'r' + ('tw' if a == v else ''))
                 if r:  # range (limits)
                     rmin, rmax = r.split(',')
-                    rlim = getattr(plt, '{}lim'.format(a))
                     # defaults
-                    rmind, rmaxd = rlim()
+                    rmind, rmaxd = getattr(ax, 'get_{}lim'.format(a))()
                     # set range
                     try:
                         rmin = rmind if rmin == '' else float(rmin)
                         rmax = rmaxd if rmax == '' else float(rmax)
                         log.debug('rmin={}, rmax={}'.format(rmin, rmax))
-                        rlim(rmin, rmax)
+                        getattr(ax, 'set_{}lim'.format(a))(rmin, rmax)
                     except ValueError:
                         # ignore if input is no float
                         pass
 
         # legend
-        plt.axes(self.axes.values()[-1])  # activate last added axes
+        self.ax = self.axes.values()[-1]  # last added axes
         if self.l != 'none' and 'map' not in self.m :
             lines = [v[0] for v in self.legend]
             labels = [v[1] for v in self.legend]
-            leg = plt.legend(lines, labels, loc = self.l or 'best', fancybox = True, numpoints = 1)
-            plt.setp(leg.get_texts(), fontsize = self.f)
+            leg = self.ax.legend(lines, labels, loc = self.l or 'best', fancybox = True, numpoints = 1, prop = {'size':self.f})
             leg.get_frame().set_alpha(0.8)
 
+        self._set_fontsize()
+
         # get plot size to position textboxes
-        fig = plt.gcf()
+        fig = self.figure
         sx, sy = fig.get_size_inches() * fig.dpi
 
         # draw textboxes
@@ -566,8 +1639,8 @@ class Plot(object):
 
         cy = sy
         for i, t in enumerate(self.textboxes):
-            label = plt.annotate(t, (cx, cy), xycoords = 'axes pixels',
-                family = 'monospace', size = 'small',
+            label = self.ax.annotate(t, (cx, cy), xycoords = 'axes pixels',
+                family = 'monospace', size = 0.833 * self.f,
                 horizontalalignment = 'left', verticalalignment = 'top',
                 bbox = dict(facecolor = 'w', alpha = 0.8, boxstyle = "round,pad=0.5"),
                 annotation_clip = False)
@@ -581,13 +1654,21 @@ class Plot(object):
         cx = cxw + cx + 50 if len(self.textboxes) else cx
         cy = sy
         for i, t in enumerate(self.fitboxes):
-            plt.annotate(t, (cx, cy), xycoords = 'axes pixels',
-                family = 'monospace', size = 'small',
+            self.ax.annotate(t, (cx, cy), xycoords = 'axes pixels',
+                family = 'monospace', size = 0.833 * self.f,
                 horizontalalignment = 'left', verticalalignment = 'top',
                 bbox = dict(facecolor = 'w', alpha = 0.8, boxstyle = "round,pad=0.5"),
                 annotation_clip = False)
             cy -= sy * 0.25
 
+    def _set_fontsize(self):
+        'set the font size of the tick labels, axis labels and offsets of all axes (colorbars too) to f'
+        for ax in self.figure.axes:
+            ax.tick_params(which = 'both', labelsize = self.f)
+            for a in (ax.xaxis, ax.yaxis):
+                a.label.set_fontsize(self.f)
+                a.get_offset_text().set_fontsize(self.f)
+
 
     def data(self, i):
         x, y, z, c = self.xdata[i], self.ydata[i], self.zdata[i], self.cdata[i]
@@ -666,58 +1747,68 @@ class Plot(object):
 
 
     def plot(self):
-        self._prepare_data()
-        self._configure_pre()
-        for i, m in enumerate(self.m):
-            if m and self.s[i]:
-                self.selectAxes(i)
-                if m == 'xy':
-                    self._xy(i)
-                elif m == 'h1':
-                    self._hist1d(i)
-                elif m == 'h2':
-                    self._hist2d(i)
-                elif m == 'p':
-                    self._profile(i)
-                elif m == 'map':
-                    self._map(i)
-                else:
-                    raise RuntimeError('unknow mode ' + m)
-        self._configure_post()
+        'draw the plot on a new figure, the data is prepared once, so the plot can be drawn again (e.g. interactively)'
+        if self.drawn is None:
+            self._prepare_data()
+        else:  # _configure_pre converts f, w, h
+            self.f, self.w, self.h = self.drawn
+            self.legend, self.textboxes, self.fitboxes = [], [], []
+            self.axes = OrderedDict()
+        self.drawn = self.f, self.w, self.h
+        with draw_lock:
+            self._configure_pre()
+            for i, m in enumerate(self.m):
+                if m and self.s[i]:
+                    self.selectAxes(i)
+                    if m == 'xy':
+                        self._xy(i)
+                    elif m == 'h1':
+                        self._hist1d(i)
+                    elif m == 'h2':
+                        self._hist2d(i)
+                    elif m == 'p':
+                        self._profile(i)
+                    elif m == 'map':
+                        self._map(i)
+                    else:
+                        raise RuntimeError('unknow mode ' + m)
+            self._configure_post()
 
 
     def show(self):
         log.debug('showing plot in interactive mode')
-        if not any(self.legend):
+        if not self.interactive:
+            self.interactive = True
             self.plot()
         plt.show()
 
 
-    def save(self, name = 'fig', extensions = ('png', 'pdf', 'svg')):
-        plt.ioff()
-        if not any(self.legend):
+    def save(self, name = 'fig', extensions = ('png', 'pdf', 'svg'), dpi = None):
+        'save the plot as name.ext for each of the extensions (with dpi, default: of the figure), draw it if it is not drawn yet'
+        if self.figure is None:
             self.plot()
         names = []
         for ext in extensions:
             n = name + '.' + ext
             log.debug('saving plot to %s', n)
-            plt.savefig(n, bbox_inches = 'tight', pad_inches = 0.5 if 'map' in self.m else 0.1, transparent = False)
+            with draw_lock:
+                self.figure.savefig(n, dpi = dpi, bbox_inches = 'tight', pad_inches = 0.5 if 'map' in self.m else 0.1, transparent = False)
             names.append(n)
 
         return dict(zip(extensions, names))
 
 
-    __twin = {'x':plt.twiny, 'y':plt.twinx}
+    __twin = {'x':'twiny', 'y':'twinx'}
 
     def selectAxes(self, i):
-        plt.axes(self.axes[''])  # activate main axes
+        self.ax = self.axes['']  # main axes
         v = self.tw[i]
         if v and v in 'xy':
             if v in self.axes:
-                plt.axes(self.axes[v])  # activate twin x/y axes
+                self.ax = self.axes[v]  # twin x/y axes
             else:
-                self.axes[v] = self.__twin[v]()  # create twin x/y axes
-                ticks.set_extended_locator(self.__tick_density)  # add tick locator
+                self.axes[v] = self.ax = getattr(self.axes[''], self.__twin[v])()  # create twin x/y axes
+                ticks.set_extended_locator(self.__tick_density, axes = self.ax)  # add tick locator
             return
 
 
@@ -753,7 +1844,7 @@ class Plot(object):
             yfit = fitfunc(xfit, *p)
             args = [xfit, yfit]
             if self.fl[i]: args.append(self.fl[i])
-            l, = plt.plot(*args)
+            l, = self.ax.plot(*args, markeredgewidth = 0)
 
             N = len(x)
             chi2 = fitfunc(x, *p) - y
@@ -776,13 +1867,102 @@ class Plot(object):
             self.legend.append((l, ll))
 
 
+    def _limits(self, i, a):
+        'return lower, upper (None if not set) and if the scale is log of axis a (x or y) of plot i, see _configure_post'
+        tw = 'tw' if self.tw[i] == a else ''
+        try:
+            lower, upper = [float(v) if v.strip() else None for v in getattr(self, a + 'r' + tw).split(',')]
+        except:  # not set or invalid
+            lower = upper = None
+        return lower, upper, getattr(self, a + 's' + tw) == 'log'
+
+
+    def _density_mode(self, density, n):
+        """
+        return how n points are aggregated (count, mean or max of z) or None to draw them as markers,
+        density is the setting o#density, if not set points are aggregated (mean) if there are more than config['density']
+        """
+        if density is None or density == '':
+            limit = int(float(self.config.get('density') or 0))
+            return 'mean' if limit and n > limit else None
+        if density in (0, 'none'):
+            return None
+        if density == 1:
+            return 'mean'
+        return density
+
+
+    def _density(self, x, y, z, mode, o, xlimits, ylimits, **kwargs):
+        """
+        draw the points x, y aggregated in one cell per pixel of the axes (see aggregate) as one image with a colorbar,
+        xlimits and ylimits are (lower, upper, log) of the axes, return a handle for the legend or None if no point is finite
+        """
+        ax = self.ax
+        bbox = ax.bbox  # px, without the padding for the ticks get_window_extent adds
+        shape = max(1, int(bbox.width)), max(1, int(bbox.height))
+
+        data, ranges = [], []
+        for v, (lower, upper, logscale) in ((x, xlimits), (y, ylimits)):
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                t = np.log10(v) if logscale else np.asarray(v, dtype = float)
+                f = t[np.isfinite(t)]
+            if not len(f):
+                return None
+            lower = f.min() if lower is None else (np.log10(lower) if logscale else lower)
+            upper = f.max() if upper is None else (np.log10(upper) if logscale else upper)
+            if not upper > lower:
+                lower, upper = lower - 0.5, upper + 0.5
+            data.append(t)
+            ranges.append((lower, upper))
+
+        image = aggregate(data[0], data[1], z, shape[0], shape[1], ranges[0], ranges[1], mode)
+        log.debug('aggregated %d points into %dx%d cells (%s)', len(x), shape[0], shape[1], mode)
+        return self._image(image, ranges, (xlimits[2], ylimits[2]), mode, o, **kwargs)
+
+
+    def _image(self, image, ranges, logscale, mode, o, project = None, **kwargs):
+        """
+        draw the image of aggregated points (rows x columns cells over the ranges, see aggregate) with a colorbar,
+        the ranges are in log10 of the values on axes with logscale set, project maps the corners of the cells to the axes (maps),
+        return a handle for the legend
+        """
+        ax = self.ax
+        image = ma.array(image, mask = np.isnan(image))
+        p = dict((k, kwargs[k]) for k in ('cmap', 'alpha', 'vmin', 'vmax', 'zorder') if k in kwargs)
+
+        if logscale[0] or logscale[1] or project is not None:  # imshow cannot draw on log axes or follow a projection
+            xedges, yedges = [np.linspace(r[0], r[1], n + 1) for r, n in zip(ranges, image.shape[::-1])]
+            if logscale[0]: xedges = np.power(10, xedges)
+            if logscale[1]: yedges = np.power(10, yedges)
+            if project is not None:
+                xedges, yedges = project(*np.meshgrid(xedges, yedges))
+            l = ax.pcolormesh(xedges, yedges, image, rasterized = True, **p)
+        else:
+            l = ax.imshow(image, origin = 'lower', extent = ranges[0] + ranges[1], aspect = ax.get_aspect(), interpolation = 'nearest', **p)
+
+        m = 6.0
+        dmin, dmax = np.nanmin(image.filled(np.nan)), np.nanmax(image.filled(np.nan))
+        cticks = ticks.get_ticks(dmin, dmax, m, only_inside = 1)
+        formatter = mpl.ticker.FuncFormatter(func = lambda x, i:number_mathformat(x))
+        cb = self.figure.colorbar(l, ax = ax, fraction = o.cbfrac, pad = 0.01, aspect = 40, ticks = cticks, format = formatter)
+        cb.set_label('count' if mode == 'count' else o.cblabel)
 
+        return mpl.patches.Rectangle((0, 0), 1, 1, facecolor = l.cmap(0.5), edgecolor = 'none')  # images have no legend handles
+
+
+    def _aggregated(self, i):
+        'the points of the xy plot or map i aggregated per cell by _reduce (a GridAccumulator), None if its data is held'
+        if i in self.reduced and isinstance(self.reduced[i][1], GridAccumulator):
+            return self.reduced[i][1]
 
 
     def _xy(self, i):
         log.debug('xy plot of {}'.format([getattr(self, v)[i] for v in 'sxyzc']))
         kwargs = self.opts(i)
         x, y, z = self.data(i)
+        grid = self._aggregated(i)
+        if grid is not None:  # the points are at the centers of the cells with points
+            x, y, z = grid.centers(self.z[i])
 
         if x is not None:
             args = (x, y)
@@ -790,50 +1970,74 @@ class Plot(object):
             args = (y,)
 
         if z is None:
-            l, = plt.plot(*args, **kwargs)
+            o = get_args_from(kwargs, decimate = True)
+            line = kwargs.get('linestyle', '-') not in ('none', 'None', '', ' ') and kwargs.get('marker', 'none') in ('none', 'None', '', ' ')
+            if o.decimate and line and x is not None and len(x) > 1 and np.all(x[1:] >= x[:-1]):
+                # draw only the points that make a difference: first, last, min and max per pixel column
+                lower, upper, logx = self._limits(i, 'x')
+                if not logx or x[0] > 0:
+                    # two intervals per pixel of the figure width, so antialiasing looks the same
+                    args = decimate(x, y, int(2 * self.w * self.figure.dpi), lower, upper, logx)
+                    log.debug('decimated %d to %d points', len(x), len(args[0]))
+            l, = self.ax.plot(*args, **set_defaults(kwargs, markeredgewidth = 0))
         else:
             # linestyle must not be 'none' when plotting 3D
             if 'linestyle' in kwargs and kwargs['linestyle'] == 'none':
                 kwargs['linestyle'] = ':'
 
-            o = get_args_from(kwargs, markersize = 2, cbfrac = 0.04, cblabel = self.alabel('z'))
-            l = plt.scatter(x, y, c = z, s = o.markersize ** 2, edgecolor = 'none', **kwargs)
-
-            m = 6.0
-            dmin, dmax = np.nanmin(z), np.nanmax(z)
-            cticks = ticks.get_ticks(dmin, dmax, m, only_inside = 1)
-            formatter = mpl.ticker.FuncFormatter(func = lambda x, i:number_mathformat(x))
-            cb = plt.colorbar(fraction = o.cbfrac, pad = 0.01, aspect = 40, ticks = cticks, format = formatter)
-            cb.set_label(o.cblabel)
+            o = get_args_from(kwargs, markersize = 2, cbfrac = 0.04, cblabel = self.alabel('z'), density = None)
+            mode = self._density_mode(o.density, len(z) if grid is None else grid.n)
+            if mode and grid is not None:
+                l = self._image(grid.image(mode), grid.ranges, grid.log, mode, o, **kwargs)
+            elif mode:  # too many markers to draw them one by one
+                l = self._density(x, y, z, mode, o, self._limits(i, 'x'), self._limits(i, 'y'), **kwargs)
+            if not mode or l is None:
+                l = self._scatter(x, y, z, o, **kwargs)
 
         self.legend.append((l, self.llabel(i)))
 
         # fit
         self.fit(i, x, y)
 
+    def _scatter(self, x, y, z, o, **kwargs):
+        'draw the points x, y as markers colored by z with a colorbar, return the handle'
+        l = self.ax.scatter(x, y, c = z, s = o.markersize ** 2, edgecolor = 'none', **kwargs)
+
+        m = 6.0
+        dmin, dmax = np.nanmin(z), np.nanmax(z)
+        cticks = ticks.get_ticks(dmin, dmax, m, only_inside = 1)
+        formatter = mpl.ticker.FuncFormatter(func = lambda x, i:number_mathformat(x))
+        cb = self.figure.colorbar(l, ax = self.ax, fraction = o.cbfrac, pad = 0.01, aspect = 40, ticks = cticks, format = formatter)
+        cb.set_label(o.cblabel)
+        return l
+
     def _hist1d(self, i):
         self.plotted_lines = []
         log.debug('1D histogram of {}'.format([getattr(self, v)[i] for v in 'sxyzc']))
         kwargs = self.opts(i)
         x, y, z = self.data(i)
 
-        o = get_args_from(kwargs, density = False, cumulative = 0)
+        o = get_args_from(kwargs, density = False, cumulative = 0, unbinned = False)
         o.update(get_args_from(kwargs, style = 'histline' if o.density else 'hist'))
         err = 0  # o.style.startswith('s')
         o.update(get_args_from(kwargs, xerr = err, yerr = err, capsize = 3 if err else 0))
 
-        bins = self.bins(i, 'x')
-        if  bins == 0:
-            bins = int(1 + np.log2(len(x)))
-        binedges, bincenters, binwidths = get_binning(bins, x)
+        if i in self.reduced:  # computed by _reduce
+            (binedges,), h = self.reduced[i]
+            bincenters, binwidths = (binedges[1:] + binedges[:-1]) / 2, np.diff(binedges)
+        else:
+            bins = self.bins(i, 'x')
+            if  bins == 0:
+                bins = int(1 + np.log2(len(x)))
+            binedges, bincenters, binwidths = get_binning(bins, x)
+            h = HistogramAccumulator([binedges]).fill(x)
 
-        bincontents, _d1 = np.histogram(x, binedges)
-        assert np.all(binedges == _d1)
+        bincontents, uflow, oflow = h.contents, h.uflow[0], h.oflow[0]
         binerrors = np.sqrt(bincontents)
         binerrors[binerrors == 0] = 1
 
         # statsbox
-        self.stats_fields1d(i, x, bincontents, binerrors, binedges)
+        self.stats_fields1d(i, bincontents, binedges, uflow, oflow, h.moments(0) if o.unbinned else None)
 
         if o.density:
             bincontents, binerrors = get_density(bincontents, binerrors, binwidths)
@@ -848,14 +2052,14 @@ class Plot(object):
             x, y = get_step_points(bincontents, binedges)
 
         if 'fill' in o.style:
-            l, = plt.fill(x, y, **kwargs)
+            l, = self.ax.fill(x, y, **kwargs)
 
         elif 'hist' in o.style:
-            l, = plt.plot(x, y, **kwargs)
+            l, = self.ax.plot(x, y, **set_defaults(kwargs, markeredgewidth = 0))
 
         elif 'scat' in o.style:
-            pargs = set_defaults(kwargs, linestyle = '', marker = '.')
-            l, = plt.plot(bincenters, bincontents, **pargs)
+            pargs = set_defaults(kwargs, linestyle = '', marker = '.', markeredgewidth = 0)
+            l, = self.ax.plot(bincenters, bincontents, **pargs)
 
         else:
             raise ValueError('unknown style: ' + o.style)
@@ -864,11 +2068,11 @@ class Plot(object):
             pargs = set_defaults(kwargs, capsize = o.capsize, ecolor = 'k' if 'fill' in o.style else l.get_c())
             xerr = 0.5 * binwidths if o.xerr else None
             yerr = binerrors if o.yerr else None
-            plt.errorbar(bincenters, bincontents, yerr, xerr, fmt = None, **pargs)
+            self.ax.errorbar(bincenters, bincontents, yerr, xerr, fmt = None, **pargs)
 
 
-        adjust_limits('x', binedges)
-        adjust_limits('y', bincontents + binerrors, marl = 0)
+        adjust_limits(self.ax, 'x', binedges)
+        adjust_limits(self.ax, 'y', bincontents + binerrors, marl = 0)
 
         self.legend.append((l, self.llabel(i)))
 
@@ -878,28 +2082,34 @@ class Plot(object):
         log.debug('2D histogram of {}'.format([getattr(self, v)[i] for v in 'sxyzc']))
         kwargs = self.opts(i)
         x, y, z = self.data(i)
-        o = get_args_from(kwargs, style = 'color', density = False, log = False, cbfrac = 0.04, cblabel = 'bincontent', levels = 10)
+        o = get_args_from(kwargs, style = 'color', density = False, log = False, cbfrac = 0.04, cblabel = 'bincontent', levels = 10, unbinned = False)
         filled = 'color' in o.style or ('fill' in o.style)
         o.update(get_args_from(kwargs, hidezero = o.log or filled, colorbar = filled, clabels = not filled))
 
-        # make binnings
-        bins = self.bins(i, 'x')
-        if  bins == 0:
-            bins = int(1 + np.log2(len(x)))
-        xedges, xcenters, xwidths = get_binning(bins, x)
+        if i in self.reduced:  # computed by _reduce
+            (xedges, yedges), h = self.reduced[i]
+            xcenters, xwidths = (xedges[1:] + xedges[:-1]) / 2, np.diff(xedges)
+            ycenters, ywidths = (yedges[1:] + yedges[:-1]) / 2, np.diff(yedges)
+        else:
+            # make binnings
+            bins = self.bins(i, 'x')
+            if  bins == 0:
+                bins = int(1 + np.log2(len(x)))
+            xedges, xcenters, xwidths = get_binning(bins, x)
 
-        bins = self.bins(i, 'y')
-        if  bins == 0:
-            bins = int(1 + np.log2(len(y)))
-        yedges, ycenters, ywidths = get_binning(bins, y)
+            bins = self.bins(i, 'y')
+            if  bins == 0:
+                bins = int(1 + np.log2(len(y)))
+            yedges, ycenters, ywidths = get_binning(bins, y)
+            h = HistogramAccumulator([xedges, yedges]).fill(x, y)
 
-        bincontents, _d1, _d2 = np.histogram2d(x, y, [xedges, yedges])
-        bincontents = np.transpose(bincontents)
-        assert np.all(_d1 == xedges)
-        assert np.all(_d2 == yedges)
+        bincontents = np.transpose(h.contents).astype(float)
 
         # statsbox
-        self.stats_fields2d(i, bincontents, xcenters, ycenters)
+        if o.unbinned:
+            self.stats_fields2d(i, bincontents, xcenters, ycenters, (h.moments(0), h.moments(1)), h.cov())
+        else:
+            self.stats_fields2d(i, bincontents, xcenters, ycenters)
 
         if o.density:
             bincontents = get_density2d(bincontents, xwidths, ywidths)
@@ -914,8 +2124,13 @@ class Plot(object):
             formatter = mpl.ticker.FuncFormatter(func = lambda x, i:number_mathformat(x))
 
         if 'color' in o.style:
-            pargs = set_defaults(kwargs, cmap = 'jet', edgecolor = 'none')
-            plt.pcolor(xedges, yedges, ma.array(bincontents, mask = np.isnan(bincontents)), **kwargs)
+            image = ma.array(bincontents, mask = np.isnan(bincontents))
+            if all(h.uniform) and not self._limits(i, 'x')[2] and not self._limits(i, 'y')[2]:
+                # one image instead of a polygon per bin
+                cs = self.ax.imshow(image, origin = 'lower', extent = (xedges[0], xedges[-1], yedges[0], yedges[-1]),
+                                    aspect = self.ax.get_aspect(), interpolation = 'nearest', **kwargs)
+            else:  # imshow cannot draw non-uniform bins or log axes, rasterized in vector output
+                cs = self.ax.pcolormesh(xedges, yedges, image, rasterized = True, **kwargs)
 
         elif 'box' in o.style:
             pargs = set_defaults(kwargs, color = (1, 1, 1, 0), marker = 's', edgecolor = 'k')
@@ -923,7 +2138,7 @@ class Plot(object):
             s = bincontents.reshape(n)
             s = s / np.nanmax(s) * (72. / 2. * self.w / max(len(xcenters), len(ycenters))) ** 2
             xcenters, ycenters = np.meshgrid(xcenters, ycenters)
-            plt.scatter(xcenters.reshape(n), ycenters.reshape(n), s = s, **pargs)
+            cs = self.ax.scatter(xcenters.reshape(n), ycenters.reshape(n), s = s, **pargs)
 
         elif 'contour' in o.style:
             pargs = set_defaults(kwargs, cmap = 'jet')
@@ -931,11 +2146,11 @@ class Plot(object):
                 pargs['cmap'] = mpl.cm.get_cmap(pargs['cmap'])
 
             if filled:
-                cs = plt.contourf(xcenters, ycenters, bincontents, o.levels, **pargs)
+                cs = self.ax.contourf(xcenters, ycenters, bincontents, o.levels, **pargs)
             else:
-                cs = plt.contour(xcenters, ycenters, bincontents, o.levels, **pargs)
+                cs = self.ax.contour(xcenters, ycenters, bincontents, o.levels, **pargs)
                 if o.clabels:
-                    plt.clabel(cs, inline = 1)
+                    self.ax.clabel(cs, inline = 1, fontsize = self.f)
 
         else:
             raise ValueError('unknown style ' + o.style)
@@ -950,7 +2165,7 @@ class Plot(object):
             else:
                 cticks = ticks.get_ticks(dmin, dmax, m, only_inside = 1)
 
-            cb = plt.colorbar(fraction = o.cbfrac, pad = 0.01, aspect = 40, ticks = cticks, format = formatter)
+            cb = self.figure.colorbar(cs, ax = self.ax, fraction = o.cbfrac, pad = 0.01, aspect = 40, ticks = cticks, format = formatter)
             cb.set_label(o.cblabel)
 
 
@@ -960,23 +2175,25 @@ class Plot(object):
         x, y, z = self.data(i)
         o = get_args_from(kwargs, xerr = 0, yerr = 0)
 
-        # make x binning
-        xedges, xcenters, xwidths = get_binning(self.bins(i, 'x'), x)
-
-        # compute avg and std for each x bin
-        xx = xcenters
-        xerr = 0.5 * xwidths if o.xerr else None
-        yy = []
-        yerr = []
-        for l, u in zip(xedges[:-1], xedges[1:]):
-            bindata = y[(l <= x) & (x < u)]
-            yy.append(np.mean(bindata))
-            yerr.append(np.std(bindata))
-        if not o.yerr:
-            yerr = None
-
-        pargs = set_defaults(kwargs, capsize = 3, marker = '.', linestyle = 'none')
-        l, _d, _d = plt.errorbar(xx, yy, yerr, xerr, **pargs)
+        if i in self.reduced:  # computed by _reduce
+            (xedges,), prof = self.reduced[i]
+        else:
+            # make x binning, compute avg and std for each x bin
+            xedges = get_binning(self.bins(i, 'x'), x)[0]
+            prof = ProfileAccumulator(xedges).fill(x, y)
+        xcenters, xwidths = (xedges[1:] + xedges[:-1]) / 2, np.diff(xedges)
+
+        # empty bins have no average, they are not drawn
+        filled = prof.count > 0
+        xx = xcenters[filled]
+        yy = prof.mean[filled]
+        xerr = 0.5 * xwidths[filled] if o.xerr else None
+        yerr = None
+        if o.yerr:  # std, or the error of the mean if yerr is sem
+            yerr = (prof.sem if o.yerr == 'sem' else prof.std)[filled]
+
+        pargs = set_defaults(kwargs, capsize = 3, marker = '.', linestyle = 'none', markeredgewidth = 0)
+        l, _d, _d = self.ax.errorbar(xx, yy, yerr, xerr, **pargs)
 
         self.legend.append((l, self.llabel(i)))
 
@@ -991,55 +2208,41 @@ class Plot(object):
         o = get_args_from(kwargs, margin = 0.05, width = 10e6, height = None, boundarylat = 50, projection = 'cyl',
                           drawcoastline = 1, drawgrid = 1, drawspecgrid = 1, drawcountries = 0, bluemarble = 0, nightshade = None)
 
-        m = maps.drawmap(y, x, **o)
+        grid = self._aggregated(i)
+        if grid is None:
+            m = maps.drawmap(y, x, ax = self.ax, fontsize = self.f, **o)
+        else:  # the map spans the grid, the points are at the centers of the cells with points
+            m = maps.drawmap(np.array(grid.ranges[1]), np.array(grid.ranges[0]), ax = self.ax, fontsize = self.f, **o)
+            x, y, z = grid.centers(self.z[i])
         x, y = m(x, y)
 
         if z is None:
-            l, = plt.plot(x, y, **kwargs)
+            l, = self.ax.plot(x, y, **set_defaults(kwargs, markeredgewidth = 0))
         else:
             # linestyle must not be 'none' when plotting 3D
             if 'linestyle' in kwargs and kwargs['linestyle'] == 'none':
                 kwargs['linestyle'] = ':'
 
-            o = get_args_from(kwargs, markersize = 6, cbfrac = 0.04, cblabel = self.alabel('z'))
+            o = get_args_from(kwargs, markersize = 6, cbfrac = 0.04, cblabel = self.alabel('z'), density = None)
             p = set_defaults(kwargs, zorder = 100)
-            l = plt.scatter(x, y, c = z, s = o.markersize ** 2, edgecolor = 'none', **p)
-
-            m = 6.0
-            dmin, dmax = np.nanmin(z), np.nanmax(z)
-            cticks = ticks.get_ticks(dmin, dmax, m, only_inside = 1)
-            formatter = mpl.ticker.FuncFormatter(func = lambda x, i:number_mathformat(x))
-            cb = plt.colorbar(fraction = o.cbfrac, pad = 0.01, aspect = 40, ticks = cticks, format = formatter)
-            cb.set_label(o.cblabel)
+            mode = self._density_mode(o.density, len(z) if grid is None else grid.n)
+            if mode and grid is not None:
+                l = self._image(grid.image(mode), grid.ranges, grid.log, mode, o, project = m, **p)
+            elif mode:  # too many markers to draw them one by one
+                l = self._density(x, y, z, mode, o, (m.llcrnrx, m.urcrnrx, False), (m.llcrnry, m.urcrnry, False), **p)
+            if not mode or l is None:
+                l = self._scatter(x, y, z, o, **p)
 
         self.legend.append((l, self.llabel(i)))
 
 
-    def stats_fields1d(self, i, data, contents, errors, edges):
-        centers = (edges[1:] + edges[:-1]) / 2
-        widths = np.diff(edges)
-
-        stats = {}
-        stats['N'] = N = np.sum(contents)
-        stats['uflow'] = np.sum(data < edges[0])
-        stats['oflow'] = np.sum(edges[-1] < data)
-        stats['mean'] = mean = np.sum(centers * contents) / N
-        stats['std'] = std = np.sqrt(np.sum((centers - mean) ** 2 * contents) / N)
-        stats['mode'] = centers[np.argmax(contents)]
-        bc, be = get_density(contents, errors, widths)
-        bc, be = get_cumulative(bc, be, 1, widths)
-        median_i = np.minimum(len(centers)-1, np.searchsorted(bc, 0.5, side = 'right'))
-        stats['median'] = median = centers[median_i]
-        if len(centers) % 2 == 0:  # even # of s
-            stats['median'] = median = (median + centers[median_i - 1]) / 2
-        stats['skew'] = np.sum(((centers - mean) / std) ** 3 * contents) / N
-        stats['kurtos'] = kurtosis = np.sum(((centers - mean) / std) ** 4 * contents) / N
-        stats['excess'] = kurtosis - 3
+    def stats_fields1d(self, i, contents, edges, uflow, oflow, moments = None):
+        stats = statistics.stats1d(contents, edges, uflow, oflow, statistics.selected(self.sb[i]), moments)
         log.debug(stats)
 
         text = '{:6} {}'.format('hist', self.llabel(i))
         sb = self.sb[i]
-        if 'a' in sb: sb = 'nmscpewx'
+        if 'a' in sb: sb = statistics.all_fields
         if 'uflow' in stats and stats['uflow']: sb += 'u'
         if 'oflow' in stats and stats['oflow']: sb += 'o'
         for k in sb:
@@ -1048,22 +2251,13 @@ class Plot(object):
                 text += '\n{:6} {}'.format(_(k), number_mathformat(stats[k]))
         self.textboxes.append(text)
 
-    def stats_fields2d(self, i, contents, xcenters, ycenters):
-        stats = {}
-        stats['N'] = N = contents.sum()
-        stats['mean'] = mean = np.array([ (contents.sum(axis = 0) * xcenters).sum(),
-                         (contents.sum(axis = 1) * ycenters).sum()]) / N
-        stats['std'] = np.sqrt(np.array([(contents.sum(axis = 0) * (xcenters - mean[0]) ** 2).sum(),
-                                  (contents.sum(axis = 1) * (ycenters - mean[1]) ** 2).sum()]) / N)
-        cov = 0
-        for k, l in product(xrange(contents.shape[1]), xrange(contents.shape[0])):
-            cov += contents[l, k] * (xcenters[k] - mean[0]) * (ycenters[l] - mean[1])
-        stats['cov'] = cov / N
+    def stats_fields2d(self, i, contents, xcenters, ycenters, moments = None, cov = None):
+        stats = statistics.stats2d(contents, xcenters, ycenters, statistics.selected(self.sb[i]), moments, cov)
         log.debug(stats)
 
         text = '{:6} {}'.format('hist', self.llabel(i))
         sb = self.sb[i]
-        if 'a' in sb: sb = 'nmscpewx'
+        if 'a' in sb: sb = statistics.all_fields
         if 'uflow' in stats and stats['uflow']: sb += 'u'
         if 'oflow' in stats and stats['oflow']: sb += 'o'
         for k in sb:
@@ -1153,6 +2347,14 @@ def main():
     parser.add_argument('-v', '--verbose', action = 'store_true', help = 'set logging level to DEBUG')
     parser.add_argument('-q', '--quiet', action = 'store_true', help = 'set logging level to ERROR')
     parser.add_argument('-c', '--cache', metavar = 'dir', help = 'dir where to store cached HDF5 tables, cache is deactivated if not set')
+    parser.add_argument('-j', '--jobs', metavar = 'n', type = int, default = 1, help = 'scan sharded and large tables in n processes (default: 1)')
+    parser.add_argument('-M', '--memory', metavar = 'MB', type = float, default = 0,
+                        help = 'stream the data if holding it would need more memory, histograms are accumulated, xy plots and maps aggregated per pixel (default: no limit)')
+    parser.add_argument('-D', '--density', metavar = 'n', type = int, default = 100000,
+                        help = 'draw xy plots and maps with z of more than n points as density image, 0 to disable (default: 100000)')
+    parser.add_argument('-S', '--sample', metavar = 'n', type = int, default = 0,
+                        help = 'plot only a sample of about n rows of each table, spread over the table (default: all rows)')
+    parser.add_argument('-E', '--explain', action = 'store_true', help = 'print the plan of reading the data (files, columns, rows, cache, evaluation) instead of plotting')
     parser.add_argument('settings', metavar = 'K=V', nargs = '+', type = key_value_pair, help = 'plot settings, given as key value pairs')
 
     settings = {"t":"", "w":"", "h":"", "experiment0":"neutron-mon-neumayer",
@@ -1186,12 +2388,16 @@ def main():
     log.debug(args)
 
 
-    config = {'cachedir':''}
+    config = {'datadir':'', 'cachedir':'', 'workers':args.jobs, 'memory':args.memory, 'density':args.density, 'sample':args.sample}
     if args.cache:
         config['cachedir'] = args.cache
 
     p = Plot(config, **args.settings)
 
+    if args.explain:
+        print json.dumps(p.explain(), indent = 2)
+        return
+
     if not args.quiet:
         display_progress(p)
 
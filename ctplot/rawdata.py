@@ -7,21 +7,74 @@ import datetime as dt
 import dateutil.parser as dp
 import os
 import os.path as path
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from cStringIO import StringIO
+import io, gzip, bz2
 import pytz
 import re
+import json
 import tables as t
 from progressbar import ProgressBar, Bar, Percentage, ETA
 import math
+import numpy as np
 from utils import set_attrs
 from pkg_resources import resource_stream
 
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:  # .xz files cannot be read
+        lzma = None
 
 NaN = float('NaN')
 
+read_buffer = 1 << 20  # bytes
+
+def open_datafile(filename, buffering = read_buffer):
+    'open a data file for reading, files ending with .gz, .bz2 or .xz are decompressed while reading'
+    ext = path.splitext(filename)[1].lower()
+    if ext == '.gz':
+        return io.BufferedReader(gzip.open(filename, 'rb'), buffering)
+    elif ext == '.bz2':
+        return bz2.BZ2File(filename, 'r', buffering)
+    elif ext == '.xz':
+        if lzma is None:
+            raise RuntimeError('reading {} requires the lzma module (backports.lzma)'.format(filename))
+        return io.BufferedReader(lzma.LZMAFile(filename, 'rb'), buffering)
+    else:
+        return open(filename, 'r', buffering)
+
+def _read(filename):
+    with open_datafile(filename) as datafile:
+        return datafile.read()
+
+def prefetch(filenames, jobs):
+    """
+    yield (filename, file like object with the whole content) for each file,
+    up to jobs files are read (and decompressed) ahead in parallel threads
+    (zlib, bz2 and lzma release the GIL while decompressing)
+    """
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(jobs)
+    try:
+        pending = deque()
+        for f in filenames:
+            pending.append((f, pool.apply_async(_read, (f,))))
+            if len(pending) > jobs:
+                f, result = pending.popleft()
+                yield f, StringIO(result.get())
+        while pending:
+            f, result = pending.popleft()
+            yield f, StringIO(result.get())
+    finally:
+        pool.terminate()
+
 def filescaniter(filename, validator = None):
     'returns iterator yielding tuples with data from each line'
-    datafile = open(filename)
+    datafile = open_datafile(filename)
 
     try:
         scanner = utils.get_scanner()
@@ -46,10 +99,14 @@ def filescaniter(filename, validator = None):
     finally:
         datafile.close()
 
-def fileiter(filename, linehandler, skip_on_assert = False, print_failures = True, ignore_errors = False):
-    'returns iterator yielding objects created by linehandler from each line'
+@contextmanager
+def _given(lines):
+    yield lines
+
+def _numbered(filename, linehandler, skip_on_assert = False, print_failures = True, ignore_errors = False, lines = None):
+    'returns iterator yielding (line number, object created by linehandler) for each line (of lines instead of the file, if given)'
     if verbose > 1: print 'reading', filename
-    with open(filename) as datafile:
+    with open_datafile(filename) if lines is None else _given(lines) as datafile:
         try:
             for i, line in enumerate(datafile, 1):
                 try:
@@ -57,7 +114,7 @@ def fileiter(filename, linehandler, skip_on_assert = False, print_failures = Tru
                     data = linehandler(line)
                     if verbose > 2: print 'data', i, ':', data, '\n'
                     if data is not None:
-                        yield data
+                        yield i, data
 
                 except AssertionError as e:
                     if not skip_on_assert:
@@ -75,9 +132,88 @@ def fileiter(filename, linehandler, skip_on_assert = False, print_failures = Tru
         except Exception as e:
             raise RuntimeError("Error parsing line %d in %s" % (i, filename), e)
 
+def fileiter(filename, linehandler, skip_on_assert = False, print_failures = True, ignore_errors = False, lines = None):
+    'returns iterator yielding objects created by linehandler from each line (of lines instead of the file, if given)'
+    for i, data in _numbered(filename, linehandler, skip_on_assert, print_failures, ignore_errors, lines):
+        yield data
 
+def blockiter(filename, linehandler, t0 = None, skip_on_assert = False, print_failures = True, ignore_errors = False, lines = None,
+              blocksize = 10000):
+    """
+    returns iterator yielding Blocks of up to blocksize valid rows created by linehandler from the lines,
+    the blocks are sanitized and verified by the linehandler, invalid rows are handled like in fileiter
+    """
+    records = []
 
+    def block():
+        block, failures = make_block(linehandler, records, t0)
+        for i, e in failures:
+            if not skip_on_assert:
+                raise RuntimeError("Error parsing line %d in %s" % (i, filename), AssertionError(e))
+            elif print_failures:
+                print >> sys.stderr, "%s:%d '%s'" % (filename, i, e)
+        return block
 
+    for record in _numbered(filename, linehandler, skip_on_assert, print_failures, ignore_errors, lines):
+        records.append(record)
+        if len(records) >= blocksize:
+            yield block()
+            records = []
+
+    if records:
+        yield block()
+
+
+epoch = dt.datetime(1970, 1, 1, tzinfo = pytz.utc)
+
+class Block(OrderedDict):
+    """
+    a block of rows created by a LineHandler as columns: column name --> numpy array (float),
+    datetimes are converted to seconds since t0, lines holds the line number of each row
+    """
+    def __init__(self, handler, records, t0 = None):
+        OrderedDict.__init__(self)
+        self.t0 = t0 or epoch
+        self.lines = np.array([i for i, r in records], dtype = int)
+        ncols = len(handler.col_names)
+        for i, r in records:
+            assert len(r) == ncols, 'line %d has %d fields, expected %d' % (i, len(r), ncols)
+        rows = [[(v - self.t0).total_seconds() if isinstance(v, dt.datetime) else v for v in r] for i, r in records]
+        data = np.array(rows, dtype = float).reshape(len(rows), ncols)
+        for j, k in enumerate(handler.col_names):
+            self[k] = data[:, j].copy()
+
+    nrows = property(lambda self: len(self.lines))
+
+    def seconds(self, time):
+        'time (datetime) as seconds since t0'
+        return (time - self.t0).total_seconds()
+
+    def select(self, mask):
+        'return a block with the rows selected by mask'
+        block = Block.__new__(Block)
+        OrderedDict.__init__(block, [(k, v[mask]) for k, v in self.iteritems()])
+        block.t0 = self.t0
+        block.lines = self.lines[mask]
+        return block
+
+    def torecords(self, dtype):
+        'return the rows as numpy record array with dtype (of a table)'
+        records = np.empty(self.nrows, dtype = dtype)
+        for k in dtype.names:
+            records[k] = self[k]
+        return records
+
+
+def make_block(handler, records, t0 = None):
+    """
+    convert records (line number, tuple created by handler) into a Block, sanitize and verify it,
+    return (Block of the valid rows, list of (line number, error message) of the invalid rows)
+    """
+    block = Block(handler, records, t0)
+    handler.sanitize_block(block)
+    valid, errors = handler.verify_block(block)
+    return block.select(valid), [(block.lines[j], e) for j, e in errors]
 
 
 
@@ -94,6 +230,7 @@ class LineHandler:
     col_units = property(lambda self: tuple(self.cols_and_units.values()))
     col_names = property(lambda self: tuple(self.cols_and_units.keys()))
     table_title = '(unnamed table)'
+    context = ('lastdt',)  # attributes carrying the parsing state from line to line, saved by ingest to resume files
 
     def __init__(self):
         self.lastdt = None
@@ -150,11 +287,58 @@ class LineHandler:
         self.lastdt = time
 
     def sanitize(self, data):
+        'modify the data of one line, transformations that need the whole line or python objects (datetimes)'
         pass
 
     def verify(self, data):
+        'verify the data of one line, things that need the whole line or python objects (time order)'
         pass
 
+    # declarative cleanup and validation of the values, applied to whole Blocks of rows
+    nan_values = ()  # (columns, value), value means 'no data' in these columns and is replaced by nan
+    nan_ranges = ()  # (column, lower, upper), values outside [lower, upper] are replaced by nan
+    ranges = ()  # (name, lower, upper, nan_allowed), rows with values outside [lower, upper] are rejected,
+                 # name is a column or a key of derived, lower, upper and nan_allowed may be functions of the block
+    derived = {}  # name --> function of the block, quantities to be verified that are no columns
+
+    # columns that only depend on a key column are not stored with every row but once per key in a side table
+    dimension = None  # (key column, table name, OrderedDict of column --> unit)
+
+    def dimension_rows(self):
+        'return the rows (key, values...) of the dimension table'
+        return []
+
+    def sanitize_block(self, block):
+        'modify the values in block according to nan_values and nan_ranges'
+        for columns, value in self.nan_values:
+            for c in columns:
+                block[c][block[c] == value] = nan
+
+        with np.errstate(invalid = 'ignore'):
+            for c, lower, upper in self.nan_ranges:
+                x = block[c]
+                x[~((lower <= x) & (x <= upper))] = nan
+
+    def verify_block(self, block):
+        """
+        verify the values in block according to ranges,
+        return (mask of valid rows, list of (row index, error message) of invalid rows),
+        a row is rejected by the first check it fails
+        """
+        valid = np.ones(block.nrows, dtype = bool)
+        errors = []
+        with np.errstate(invalid = 'ignore'):
+            for name, lower, upper, nan_allowed in self.ranges:
+                x = block[name] if name in block else self.derived[name](block)
+                lower, upper, nan_allowed = [v(block) if callable(v) else v for v in (lower, upper, nan_allowed)]
+                failed = valid & ~(((lower <= x) & (x <= upper)) | (nan_allowed & np.isnan(x)))
+                for j in np.flatnonzero(failed):
+                    errors.append((j, '%s out of range: %s' % (name, x[j])))
+                valid &= ~failed
+
+        errors.sort()
+        return valid, errors
+
 nan = float('nan')
 inf = float('inf')
 
@@ -162,6 +346,13 @@ def verifyrange(name, value, lower = -inf, upper = +inf, nan_allowed = False):
     if not (lower <= value <= upper or (nan_allowed and math.isnan(value))):
         raise AssertionError('%s out of range: %s' % (name, value))
 
+def _before06(block):
+    'rows of pre 2006 weather data'
+    return block['time'] < block.seconds(WeatherHandler.start06)
+
+def _sum(*columns):
+    return lambda block: sum(block[c] for c in columns)
+
 
 
 class WeatherHandler(LineHandler):
@@ -174,52 +365,51 @@ class WeatherHandler(LineHandler):
 
     start06 = dp.parse('2006-01-01 00:00:00 +0100')
 
+    # replace -1 by nan, -1 means 'no data'
+    nan_values = ((('H_i', 'H_a', 'v_wind', 'd_wind', 'gust', 'chill', 'rain', 'p'), -1.0),)
+
+    # there may be nan values in pre 2006 weather
+    ranges = (('T_i', -50 , 50, _before06),
+              ('T_a', -50 , 50, False),
+              ('T_dew', -50 , lambda b: b['T_a'] - 1e-15, _before06),
+              ('H_i', 0 , 100, True),
+              ('H_a', 0 , 100, True),
+              ('v_wind', 0 , 60, True),
+              ('d_wind', 0, 360, True),
+              ('gust', 0 , 120, True),
+              ('rain', 0, inf, True),
+              ('p', 800, 1200, False),
+              ('clouds', 1 , 6, True))
+
     def sanitize(self, data):
         time = data[0]
         data.append(nan)  # clouds, only present in pre 2006 weather data
 
-        # replace -1 by nan, -1 means 'no data'
-        for i in [4, 5, 6, 7, 8, 9, 10, 11]:
-            if data[i] == -1.0:
-                data[i] = nan
-
         # check for T_a < 0 in summer
         if 4 < time.month < 10 and data[2] == -1.0:
             data[2] = nan
 
+    def sanitize_block(self, block):
+        LineHandler.sanitize_block(self, block)
+        T_a, T_dew = block['T_a'], block['T_dew']
+
         # check for invalid T_dew
-        if not data[3] < data[2] and data[3] == -1.0:
-            data[3] = nan
+        with np.errstate(invalid = 'ignore'):
+            T_dew[~(T_dew < T_a) & (T_dew == -1.0)] = nan
 
         # transform data in pre 2006 weather
-        if time < WeatherHandler.start06:
-            # replace -1 by nan, -1 means 'no data'
-            for i in [1, 3]:
-                if data[i] == -1.0:
-                    data[i] = nan
-            data[12] = data[5]  # set clouds if < 2006
-            data[4] = data[5] = nan  # clear humidity
+        old = _before06(block)
+        # replace -1 by nan, -1 means 'no data'
+        for c in ('T_i', 'T_dew'):
+            block[c][old & (block[c] == -1.0)] = nan
+        block['clouds'][old] = block['H_a'][old]  # set clouds if < 2006
+        block['H_i'][old] = block['H_a'][old] = nan  # clear humidity
 
     def verify(self, data):
         # 0    1    2     3     4    5      6       7     8      9     10   11   12
         time, T_i, T_a, T_dew, H_i, H_a, v_wind, d_wind, gust, chill, rain, p, clouds = data
         self._verify_time(time)
 
-        # there may be nan values in pre 2006 weather
-        allow_nan = time < WeatherHandler.start06
-
-        verifyrange('T_i', T_i, -50 , 50, allow_nan)
-        verifyrange('T_a', T_a, -50 , 50)
-        verifyrange('T_dew', T_dew, -50 , T_a - 1e-15, allow_nan)
-        verifyrange('H_i', H_i, 0 , 100, True)
-        verifyrange('H_a', H_a, 0 , 100, True)
-        verifyrange('v_wind', v_wind, 0 , 60, True)
-        verifyrange('d_wind', d_wind , 0, 360, True)
-        verifyrange('gust', gust, 0 , 120, True)
-        verifyrange('rain', rain, 0, nan_allowed = True)
-        verifyrange('p', p , 800, 1200)
-        verifyrange('clouds', clouds, 1 , 6, True)
-
 
     def _col_descriptor(self):
         return OrderedDict([(k, t.FloatCol(dflt = nan, pos = i)) for i, k in enumerate(self.col_names)])
@@ -234,15 +424,21 @@ class CTEventHandler(LineHandler):
                                   ('b1', ''), ('b2', ''), ('b3', ''), ('b4', ''),
                                   ('c1', ''), ('c2', ''), ('c3', ''), ('c4', '')])
 
+    derived = {'multiplicity': _sum('a1', 'a2', 'a3', 'a4', 'b1', 'b2', 'b3', 'b4', 'c1', 'c2', 'c3', 'c4'),
+               'multiplicity in level a': _sum('a1', 'a2', 'a3', 'a4'),
+               'multiplicity in level b': _sum('b1', 'b2', 'b3', 'b4'),
+               'multiplicity in level c': _sum('c1', 'c2', 'c3', 'c4')}
+
+    ranges = (('multiplicity', 3 , 12, False),
+              ('multiplicity in level a', 1 , 4, False),
+              ('multiplicity in level b', 1 , 4, False),
+              ('multiplicity in level c', 1 , 4, False))
+
     def verify(self, data):
         time = data[0]
         self._verify_time(time)
         triggered = data[1:]
         verifyrange('number of detector segments', len(triggered), 12 , 12)
-        verifyrange('multiplicity', sum(triggered) , 3 , 12)
-        verifyrange('multiplicity in level a', sum(triggered[0:4]) , 1 , 4)
-        verifyrange('multiplicity in level b', sum(triggered[4:8]) , 1 , 4)
-        verifyrange('multiplicity in level c', sum(triggered[8:12]) , 1 , 4)
 
     def _col_descriptor(self):
         descriptor = OrderedDict([(k, t.BoolCol(dflt = False, pos = i)) for i, k in enumerate(self.col_names)])
@@ -260,6 +456,7 @@ class ITTEventHandler(LineHandler):
                                   ('b1', ''), ('b2', ''), ('b3', ''), ('b4', '')])
 
     _leading_int = re.compile('(^[+-]?\\d+)\\s+(.*)')
+    context = ('lastdt', 'expecting_second_part', 'run', 'i', 'data')
 
     def __init__(self):
         LineHandler.__init__(self)
@@ -336,21 +533,22 @@ class ITTEventHandler(LineHandler):
                 raise AssertionError('time has no tzinfo: %s' % (time.isoformat(),))
         self.lastdt = time
 
+    ranges = (('dom1', 0, inf, False),
+              ('dom2', 0, inf, False),
+              ('run', 1, inf, False),
+              ('a1', 0, inf, False),
+              ('a2', 0, inf, False),
+              ('a3', 0, inf, False),
+              ('a4', 0, inf, False),
+              ('b1', 0, inf, False),
+              ('b2', 0, inf, False),
+              ('b3', 0, inf, False),
+              ('b4', 0, inf, False))
+
     def verify(self, data):
         time, dom1, dom2, run, time2, a1, a2, a3, a4, b1, b2, b3, b4 = data
         self._verify_time(time)
         self._verify_time(time2)
-        verifyrange('dom1', dom1, 0)
-        verifyrange('dom2', dom2, 0)
-        verifyrange('run', run, 1)
-        verifyrange('a1', a1, 0)
-        verifyrange('a2', a2, 0)
-        verifyrange('a3', a3, 0)
-        verifyrange('a4', a4, 0)
-        verifyrange('b1', b1, 0)
-        verifyrange('b2', b2, 0)
-        verifyrange('b3', b3, 0)
-        verifyrange('b4', b4, 0)
 
     def _col_descriptor(self):
         return OrderedDict([(k, t.FloatCol(dflt = nan, pos = i)) for i, k in enumerate(self.col_names)])
@@ -380,13 +578,19 @@ class DWDTageswerteHandler(LineHandler):
     table_name = 'dwd_daily_weather'
     table_title = 'DWD Tageswerte'
     cols_and_units = OrderedDict([('time', ''), ('stat', ''), ('qn', ''), ('tg', ''), ('tn', ''), ('tm', ''), ('tx', ''),
-                                  ('rfm', ''), ('fm', ''), ('fx', ''), ('so', ''), ('nm', ''), ('rr', ''), ('pm', ''), ('h', ''), ('lat', ''), ('lon', '')])
+                                  ('rfm', ''), ('fm', ''), ('fx', ''), ('so', ''), ('nm', ''), ('rr', ''), ('pm', '')])
 #   (pos,len) time    stat    qn       tg       tn       tm       tx       rfm      fm       fx       so       nm       rr       pm
     fields = [(7, 8), (1, 5), (16, 2), (19, 6), (26, 6), (33, 6), (40, 6), (47, 6), (54, 6), (61, 6), (68, 6), (75, 6), (82, 6), (89, 6)]
 
+    dimension = ('stat', 'dwd_stations', OrderedDict([('h', 'm'), ('lat', '°'), ('lon', '°')]))
+
     def __init__(self):
+        LineHandler.__init__(self)
         self.stations = stations()
 
+    def dimension_rows(self):
+        return [(stat, s[0], s[1], s[2]) for stat, s in sorted(self.stations.iteritems())]
+
     def __call__(self, line):
         'parse line and return tuple with data or None if line was skipped (comment/empty)'
         line = line.strip()
@@ -411,11 +615,6 @@ class DWDTageswerteHandler(LineHandler):
             else:
                 data.append(float(field))
 
-        stat = data[1]
-        pos = self.stations[stat][0:3] if stat in self.stations else 3 * [nan]
-        data.extend(pos)  # append height, lat, lon
-
-
         self.sanitize(data)  # modify data (perform cleanup, transformations, etc.)
         data = tuple(data)  # freeze data (tuples are immutable)
 
@@ -485,15 +684,16 @@ class PolarsternHandler(LineHandler):
     def sanitize(self, data):
         data[0] = self._timezone.localize(data[0])
 
+    ranges = (('lat', -90, 90, False),
+              ('lon', -180, 180, False),
+              ('T', -50 , 50, False),
+              ('H', 0 , 100, False),
+              ('p', 800, 1200, False),
+              ('rate', 0, 5000, False))
+
     def verify(self, data):
         time, lat, lon, p, T, H, rate = data
         self._verify_time(time)
-        verifyrange('lat', lat, -90, 90)
-        verifyrange('lon', lon, -180, 180)
-        verifyrange('T', T, -50 , 50)
-        verifyrange('H', H, 0 , 100)
-        verifyrange('p', p , 800, 1200)
-        verifyrange('rate', rate, 0, 5000)
 
     def _col_descriptor(self):
         descriptor = OrderedDict([(k, t.FloatCol(dflt = nan, pos = i)) for i, k in enumerate(self.col_names)])
@@ -539,35 +739,40 @@ class PolarsternHandler2(LineHandler):
 
     _timezone = pytz.timezone('UTC')
 
-    def sanitize(self, data):
-        # 0    1   2   3    4    5    6  7   8     9     10   11  12    13
-        time, mjd, Ts, ps , lat, lon, p, T, ceil, radi, rain, H, visi, events = data
-        data[0] = self._timezone.localize(time)
-        if not (-50 <= Ts <= 50): data[2] = NaN
-        if not (800 <= ps <= 1200): data[3] = NaN
+    nan_ranges = (('T_s', -50, 50),
+                  ('p_s', 800, 1200),
+                  ('p', 800, 1200),
+                  ('T', -50, 50),
+                  ('ceil', 0, 99999),
+                  ('radi', 0, 9999),
+                  ('rain', 0, 9999),
+                  ('H', 0, 100),
+                  ('visi', 0, 999999999))
+
+    derived = {'events': lambda b: b['rate']}
+
+    ranges = (('lat', -90, 90, True),
+              ('lon', -180, 180, True),
+              ('T', -50 , 50, True),
+              ('H', 0 , 100, True),
+              ('p', 800, 1200, True),
+              ('events', 0, 10000, False))
 
-        if not (-90 <= lat <= 90) or not (-180 <= lon <= 180):
-            data[4] = data[5] = NaN
+    def sanitize(self, data):
+        data[0] = self._timezone.localize(data[0])
 
-        if not (800 <= p <= 1200): data[6] = NaN
-        if not (-50 <= T <= 50): data[7] = NaN
-        if not (0 <= ceil <= 99999): data[8] = NaN
-        if not (0 <= radi <= 9999): data[9] = NaN
-        if not (0 <= rain <= 9999): data[10] = NaN
-        if not (0 <= H <= 100): data[11] = NaN
-        if not (0 <= visi <= 999999999): data[12] = NaN
+    def sanitize_block(self, block):
+        LineHandler.sanitize_block(self, block)
+        lat, lon = block['lat'], block['lon']
+        with np.errstate(invalid = 'ignore'):
+            invalid = ~((-90 <= lat) & (lat <= 90)) | ~((-180 <= lon) & (lon <= 180))
+        lat[invalid] = lon[invalid] = NaN
 
     def verify(self, data):
         # 0    1   2   3    4    5    6  7   8     9     10   11  12    13
         time, mjd, Ts, ps , lat, lon, p, T, ceil, radi, rain, H, visi, events = data
         assert abs((time - mjd_epoch).total_seconds() / 3600 - 24 * mjd) < 1. / 60, "MJD does not match time"  # mjd-time < 1 minute
         self._verify_time(time)
-        verifyrange('lat', lat, -90, 90, True)
-        verifyrange('lon', lon, -180, 180, True)
-        verifyrange('T', T, -50 , 50, True)
-        verifyrange('H', H, 0 , 100, True)
-        verifyrange('p', p , 800, 1200, True)
-        verifyrange('events', events, 0, 10000)
 
     def _col_descriptor(self):
         descriptor = OrderedDict([(k, t.FloatCol(dflt = nan, pos = i)) for i, k in enumerate(self.col_names)])
@@ -580,6 +785,7 @@ class NeutronHandler(LineHandler):
     table_title = 'Neutron Monitor Data'
     cols_and_units = OrderedDict([('time', 's'), ('N', ''), ('HV', 'V'), ('T', '°C'),
                                   ('p', 'mbar'), ('lat', ''), ('lon', '')])
+    context = ('lastdt', 'day')
 
     def __call__(self, line):
         'parse line and return tuple with data or None if line was skipped (comment/empty)'
@@ -616,25 +822,25 @@ class NeutronHandler(LineHandler):
 
     _timezone = pytz.timezone('UTC')
 
-    def sanitize(self, data):
-        # 0   1  2   3  4   5    6
-        time, N, HV, T, p, lat, lon = data
-        if not (1 <= HV <= 1e4): data[2] = NaN
-        if not (-50 <= T <= 50): data[3] = NaN
-        if not (800 <= p <= 1200): data[4] = NaN
-        if not (-90 <= lat <= 90): data[5] = NaN
-        if not (-180 <= lon <= 180): data[6] = NaN
+    nan_ranges = (('HV', 1, 1e4),
+                  ('T', -50, 50),
+                  ('p', 800, 1200),
+                  ('lat', -90, 90),
+                  ('lon', -180, 180))
+
+    derived = {'count': lambda b: b['N']}
+
+    ranges = (('count', 0, 500, False),
+              ('HV', 1, 1e4, True),
+              ('T', -50 , 50, True),
+              ('p', 800, 1200, True),
+              ('lat', -90, 90, True),
+              ('lon', -180, 180, True))
 
     def verify(self, data):
         # 0   1  2   3  4   5    6
         time, N, HV, T, p, lat, lon = data
         self._verify_time(time)
-        verifyrange('count', N, 0, 500)
-        verifyrange('HV', HV, 1, 1e4, True)
-        verifyrange('T', T, -50 , 50, True)
-        verifyrange('p', p , 800, 1200, True)
-        verifyrange('lat', lat, -90, 90, True)
-        verifyrange('lon', lon, -180, 180, True)
 
     def _col_descriptor(self):
         descriptor = OrderedDict([(k, t.FloatCol(dflt = nan, pos = i)) for i, k in enumerate(self.col_names)])
@@ -647,6 +853,7 @@ class NeutronHandler2(LineHandler):
     table_name = 'neutron_events2'
     table_title = 'Neutron Monitor Data 2'
     cols_and_units = OrderedDict([('time', 's'), ('N', ''), ('T', '°C'), ('HV', 'V'), ('p', 'mbar')])
+    context = ('lastdt', 'day')
 
     def __call__(self, line):
         'parse line and return tuple with data or None if line was skipped (comment/empty)'
@@ -682,21 +889,21 @@ class NeutronHandler2(LineHandler):
 
     _timezone = pytz.timezone('UTC')
 
-    def sanitize(self, data):
-        # 0   1  2   3  4
-        time, N, T, HV, p = data
-        if not (1 <= HV <= 1e4): data[2] = NaN
-        if not (-50 <= T <= 50): data[3] = NaN
-        if not (800 <= p <= 1200): data[4] = NaN
+    nan_ranges = (('HV', 1, 1e4),
+                  ('T', -50, 50),
+                  ('p', 800, 1200))
+
+    derived = {'count': lambda b: b['N']}
+
+    ranges = (('count', 0, 5000, False),
+              ('HV', 1, 1e4, True),
+              ('T', -50 , 50, True),
+              ('p', 800, 1200, True))
 
     def verify(self, data):
         # 0   1  2   3  4
         time, N, T, HV, p = data
         self._verify_time(time)
-        verifyrange('count', N, 0, 5000)
-        verifyrange('HV', HV, 1, 1e4, True)
-        verifyrange('T', T, -50 , 50, True)
-        verifyrange('p', p , 800, 1200, True)
 
     def _col_descriptor(self):
         descriptor = OrderedDict([(k, t.FloatCol(dflt = nan, pos = i)) for i, k in enumerate(self.col_names)])
@@ -707,13 +914,14 @@ class NeutronHandler2(LineHandler):
 available_handlers = (WeatherHandler, CTEventHandler, ITTEventHandler, DWDTageswerteHandler, PolarsternHandler, PolarsternHandler2, NeutronHandler, NeutronHandler2)
 
 
-def autodetect(filename, handlers = available_handlers):
+def autodetect(filename, handlers = available_handlers, open_lines = None):
     """
     try to parse file (filename) with the given handlers (types, not instances).
     if the first 10 lines of the file can be parsed by a handler
     without error and there is only one handler that successfully
     parses the file (unique match) return this handler (type, not instance), 
-    else raise RuntimeError
+    else raise RuntimeError,
+    if open_lines is given, it is called to get the lines instead of reading the file
     """
     matched_handlers = []
     # try each handler
@@ -721,13 +929,18 @@ def autodetect(filename, handlers = available_handlers):
         try:  # try to parse the file
             if verbose > 0:
                 print 'trying', h
-            datalines = []
-            for i, data in enumerate(fileiter(filename, h())):
-                datalines.append(data)
-                if i > 10: break  # stop after 10 lines
+            handler = h()
+            records = []
+            for record in _numbered(filename, handler, lines = open_lines and open_lines()):
+                records.append(record)
+                if len(records) > 11: break  # stop after 10 lines
+
+            block, failures = make_block(handler, records)
+            if failures:
+                raise AssertionError('line %d: %s' % failures[0])
 
             # if parsing was successful (no exception), add this handler
-            if len(datalines) > 5:  # require at least 5 table rows to be read
+            if block.nrows > 5:  # require at least 5 table rows to be read
                 matched_handlers.append(h)
 
         except Exception as e:  # ignore errors, try next handler
@@ -743,14 +956,14 @@ def autodetect(filename, handlers = available_handlers):
         raise RuntimeError(('could not autodetect handler for {} \nmatching handlers: \n{}'.format(filename, matched_handlers)))
 
 
-def starttime(filename, handler):
+def starttime(filename, handler, lines = None):
     """
-    get the first time stamp in the file using the given LineHandler,
+    get the first time stamp in the file (of lines instead of the file, if given) using the given LineHandler,
     assuming the handler produces a 'time' column
     """
     time_idx = handler.col_names.index('time')
 
-    first_record = fileiter(filename, handler).next()
+    first_record = fileiter(filename, handler, lines = lines).next()
     return first_record[time_idx]
 
 
@@ -786,17 +999,163 @@ def detect_and_sort(filenames, skip_unhandled):
     return sorted_files
 
 
+def create_table(h5, handler, t0, expectedrows = 10000):
+    'create the table for handler (an instance) in group /raw of h5, return the table'
+    try:
+        raw = h5.getNode('/raw')
+    except t.NoSuchNodeError:
+        raw = h5.createGroup(h5.root, 'raw', 'raw data')
+
+    table = h5.createTable(raw, handler.table_name, handler.col_descriptor,
+                           handler.table_title, expectedrows = expectedrows)
+    set_attrs(table, t0, handler.col_units)
+
+    if handler.dimension:
+        dimension = create_dimension(h5, raw, handler)
+        table.attrs.dimension = json.dumps({'key':handler.dimension[0], 'table':dimension._v_pathname})
+
+    return table
+
+
+def create_dimension(h5, group, handler):
+    'create (or replace) the dimension table of handler (an instance) in group, return the table'
+    key, name, cols_and_units = handler.dimension
+    try:
+        h5.removeNode(group, name)
+    except t.NoSuchNodeError:
+        pass
+
+    descriptor = OrderedDict([(key, t.IntCol(dflt = -1, pos = 0))])
+    for c in cols_and_units.keys():
+        descriptor[c] = t.FloatCol(dflt = nan, pos = len(descriptor))
+
+    table = h5.createTable(group, name, descriptor, handler.table_title + ' ' + key)
+    table.append(handler.dimension_rows())
+    table.attrs.units = json.dumps([''] + cols_and_units.values())
+    table.attrs.dimension_key = key
+    table.flush()
+    return table
+
+
+def write_blocks(table, blocks):
+    'append blocks (see blockiter) to table, return # of rows'
+    n = 0
+    for block in blocks:
+        table.append(block.torecords(table.dtype))
+        n += block.nrows
+
+    return n
+
+
+shard_periods = ('year', 'month', 'day')
+
+def period(time, length):
+    'return (start, end, label) of the period of length (year, month or day) containing the datetime time, periods are in UTC'
+    time = time.astimezone(pytz.utc)
+    if length == 'year':
+        start = dt.datetime(time.year, 1, 1, tzinfo = pytz.utc)
+        return start, start.replace(year = start.year + 1), '{:%Y}'.format(start)
+    if length == 'month':
+        start = dt.datetime(time.year, time.month, 1, tzinfo = pytz.utc)
+        return start, (start + dt.timedelta(days = 32)).replace(day = 1), '{:%Y-%m}'.format(start)
+    if length == 'day':
+        start = dt.datetime(time.year, time.month, time.day, tzinfo = pytz.utc)
+        return start, start + dt.timedelta(days = 1), '{:%Y-%m-%d}'.format(start)
+    raise ValueError('unknown shard period ' + length)
+
+
+class ShardWriter(object):
+    """
+    writes the rows of the table of handler (an instance) into one file per period (see period) in shardsdir,
+    like a table (see write_blocks), flush writes the manifest, a group in h5 in place of the table (see sources.ShardedTable)
+    """
+
+    def __init__(self, h5, handler, t0, length, shardsdir, filters = None):
+        self.h5 = h5
+        self.handler = handler
+        self.t0 = t0
+        self.length = length
+        self.shardsdir = shardsdir
+        self.filters = filters
+        self.dtype = t.Description(handler.col_descriptor)._v_dtype
+        self.shards = OrderedDict()  # label --> [filename, node, tmin, tmax, nrows]
+        self.current = None  # (start, end, label, open file, table) of the current shard
+
+        if not path.isdir(shardsdir):
+            os.makedirs(shardsdir)
+
+    def _open(self, time):
+        'make the shard of the period containing time (seconds since t0) the current one'
+        self._close()
+        start, end, label = period(self.t0 + dt.timedelta(seconds = time), self.length)
+        filename = path.join(self.shardsdir, '{}-{}.h5'.format(self.handler.table_name, label))
+        if label in self.shards:  # continue shard
+            h5 = t.openFile(filename, 'a')
+            table = h5.getNode('/raw/' + self.handler.table_name)
+        else:
+            h5 = t.openFile(filename, 'w', 'shard {} of {}'.format(label, self.handler.table_name), filters = self.filters)
+            table = create_table(h5, self.handler, self.t0)
+            table.attrs.shard = label  # not listed on its own, but as part of the sharded table
+            self.shards[label] = [filename, table._v_pathname, None, None, 0]
+        self.current = ((start - self.t0).total_seconds(), (end - self.t0).total_seconds(), label, h5, table)
+
+    def _close(self):
+        if self.current:
+            self.current[3].close()
+            self.current = None
+
+    def append(self, records):
+        'append records to the shards of their periods'
+        while len(records) > 0:
+            time = records['time']
+            if not self.current or not (self.current[0] <= time[0] < self.current[1]):
+                self._open(time[0])
+            start, end, label, h5, table = self.current
+            inside = (start <= time) & (time < end)
+            table.append(records[inside])
+
+            shard = self.shards[label]
+            tmin, tmax = time[inside].min(), time[inside].max()
+            shard[2] = tmin if shard[2] is None else min(shard[2], tmin)
+            shard[3] = tmax if shard[3] is None else max(shard[3], tmax)
+            shard[4] += np.count_nonzero(inside)
+            records = records[~inside]
+
+    def flush(self):
+        'close the current shard and write the manifest'
+        self._close()
+        if not self.shards:
+            return
+
+        try:
+            raw = self.h5.getNode('/raw')
+        except t.NoSuchNodeError:
+            raw = self.h5.createGroup(self.h5.root, 'raw', 'raw data')
+
+        relto = path.dirname(path.abspath(self.h5.filename))
+        manifest = self.h5.createGroup(raw, self.handler.table_name, self.handler.table_title)
+        manifest._v_attrs.shards = json.dumps([[path.relpath(path.abspath(f), relto), n, float(tmin), float(tmax), int(rows)]
+                                               for f, n, tmin, tmax, rows in self.shards.values()])
+        manifest._v_attrs.period = self.length
+
+
 def raw_to_h5(filenames, out = "out.h5", handlers = available_handlers,
-              t0 = dp.parse('2004-01-01 00:00:00 +0000'), skip_on_assert = False, show_progress = True, ignore_errors = False, skip_unhandled = False):
+              t0 = dp.parse('2004-01-01 00:00:00 +0000'), skip_on_assert = False, show_progress = True, ignore_errors = False, skip_unhandled = False,
+              jobs = 1, shard = None):
     """
     converts ASCII data to HDF5 tables
-        filenames : iterable, filenames of all data files (events, weather, etc.) in any order
+        filenames : iterable, filenames of all data files (events, weather, etc.) in any order,
+                    files ending with .gz, .bz2 or .xz are decompressed while reading
               out : string, filename of outputfile (default='out.h5')
          handlers : iterable of LineHandlers for parsing the data files (default=available_handlers)
                t0 : datetime, reference time for 'time' column,
                     time is stored as 'time since t0' (default='2004-01-01 00:00:00 +0100')
-    skip_on_assert: if True, skip lines that are invalid (if LineHandler.verify() raises AssertionError)
+    skip_on_assert: if True, skip lines that are invalid (if LineHandler.verify() raises AssertionError
+                    or LineHandler.verify_block() rejects them)
                     (default=False, exception is raised)
+             jobs : int, # of files read and decompressed ahead in parallel (default=1, read while parsing)
+            shard : string, year, month or day, store the tables in one file per period in the directory
+                    <out without .h5>.shards, out lists the files (default=None, store the tables in out)
     """
 
     _filenames = []
@@ -821,20 +1180,14 @@ def raw_to_h5(filenames, out = "out.h5", handlers = available_handlers,
         print "reference time t0 =", t0
         print 'autodetecting file types...'
 
-    def read_files(files, row, handler):
-        for f in files:
-            for entry in fileiter(f, handler, skip_on_assert, show_progress, ignore_errors):
-                try:
-                    for k, v in zip(handler.col_names, entry):
-                        if isinstance(v, dt.datetime):
-                            row[k] = (v - t0).total_seconds()
-                        else:
-                            row[k] = v
-
-                    row.append()
+    def read_files(files, table, handler):
+        if jobs > 1:
+            files = prefetch(files, jobs)
+        else:
+            files = ((f, None) for f in files)
 
-                except StopIteration:
-                    pass
+        for f, lines in files:
+            write_blocks(table, blockiter(f, handler, t0, skip_on_assert, show_progress, ignore_errors, lines))
 
             if show_progress:
                 pb.update(pb.currval + 1)
@@ -851,7 +1204,6 @@ def raw_to_h5(filenames, out = "out.h5", handlers = available_handlers,
     filters = t.Filters(complevel = 1, complib = 'zlib')
     with t.openFile(out, 'w', 'datafile created with raw_to_h5', filters = filters) as h5:
         h5.root._v_attrs.creationdate = dt.datetime.now(pytz.utc).isoformat()
-        raw = h5.createGroup(h5.root, 'raw', 'raw data')
 
         # create and fill raw data tables
         for handler, files in files_dict.iteritems():
@@ -859,10 +1211,11 @@ def raw_to_h5(filenames, out = "out.h5", handlers = available_handlers,
             title = handler.table_title
             if show_progress:
                 print 'creating table: %s (%s)' % (handler.table_name, title)
-            table = h5.createTable(raw, handler.table_name, handler.col_descriptor,
-                                   title, expectedrows = 10000 * len(files))
-            set_attrs(table, t0, handler.col_units)
-            read_files(files, table.row, handler)
+            if shard:
+                table = ShardWriter(h5, handler, t0, shard, path.splitext(out)[0] + '.shards', filters)
+            else:
+                table = create_table(h5, handler, t0, 10000 * len(files))
+            read_files(files, table, handler)
             table.flush()
 
     if show_progress:
@@ -883,6 +1236,7 @@ def main():
     parser = ArgumentParser(description = 'convert raw ASCII data tables into tables in one HDF5 file',
                                epilog = ctplot.__epilog__ + ', raw data can be in the following formats: ' + formats +
                                '. The program tries to autodetect the file format and sorts the input files by time automatically. ' +
+                               'Files ending with .gz, .bz2 or .xz are decompressed on the fly. ' +
                                'Times are stored as double as seconds since reference time t0.')
 
     parser.add_argument('-V', '--version', action = 'version', version = '%(prog)s {} build {}'.format(ctplot.__version__, ctplot.__build_date__))
@@ -896,6 +1250,10 @@ def main():
     parser.add_argument('-v', '--verbose', action = 'count', help = 'show additional processing information')
     parser.add_argument('-k', '--keepgoing', action = 'store_true', help = 'keep going, do not stop on errors')
     parser.add_argument('-x', '--skip-unhandled', action = 'store_true', help = 'skip files with no handler')
+    parser.add_argument('-j', '--jobs', metavar = 'n', type = int, default = 1,
+                        help = 'read and decompress n files ahead in parallel, needs memory for n whole files (default: 1)')
+    parser.add_argument('--shard', choices = shard_periods,
+                        help = 'store the tables in one file per period in the directory <out without .h5>.shards, out lists the files')
     parser.add_argument('infiles', nargs = '+', help = 'input files, if a directory is given, all files in it and in its subdirectories are used')
 
     args = parser.parse_args()
@@ -912,7 +1270,8 @@ def main():
 
 
     raw_to_h5(args.infiles, out = out, skip_on_assert = not args.noskip, show_progress = not args.quiet,
-              t0 = args.reftime, ignore_errors = args.keepgoing, skip_unhandled = args.skip_unhandled)
+              t0 = args.reftime, ignore_errors = args.keepgoing, skip_unhandled = args.skip_unhandled, jobs = args.jobs,
+              shard = args.shard)
 
 
 if __name__ == '__main__':
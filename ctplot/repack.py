@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys, os, time
+import os.path as path
+import tables as t
+from collections import OrderedDict
+from progressbar import ProgressBar, Bar, ETA, Percentage
+from ingest import invalidate_caches
+
+
+complibs = ['blosc:lz4', 'blosc:zstd', 'blosc:lz4hc', 'blosc', 'zlib']
+shuffles = ['byte', 'bit', 'none']
+
+
+def filters(complib = 'blosc:lz4', complevel = 5, shuffle = 'byte'):
+    'return the tables.Filters for complib, complevel and shuffle (byte, bit or none), bit shuffling needs blosc'
+    kwargs = {}
+    if shuffle == 'bit':  # bitshuffle is only known to newer PyTables versions
+        if not complib.startswith('blosc'):
+            raise ValueError('bit shuffling needs blosc, not {}'.format(complib))
+        kwargs['bitshuffle'] = True
+    return t.Filters(complevel = complevel, complib = complib, shuffle = shuffle == 'byte', **kwargs)
+
+
+def descriptor(table, float32 = ()):
+    'return the column descriptor of table, float columns listed in float32 are stored with single precision'
+    descr = OrderedDict()
+    for k in table.colnames:
+        col = table.coldescrs[k]
+        if k in float32 and col.kind == 'float':
+            descr[k] = t.Float32Col(shape = col.shape, dflt = col.dflt, pos = col._v_pos)
+        else:
+            descr[k] = col.copy()
+    return descr
+
+
+def chunkrows(descr, chunksize = 1 << 20):
+    'return the # of rows that fit in a chunk of about chunksize bytes'
+    rowsize = sum(col.dtype.itemsize for col in descr.values())
+    return max(1, chunksize // rowsize)
+
+
+def repack_table(table, group, filters, float32 = (), chunksize = 1 << 20, quiet = False):
+    'copy table to group (may be in another file), return the new table'
+    descr = descriptor(table, float32)
+    rows = chunkrows(descr, chunksize)
+    h5 = group._v_file
+    new = h5.createTable(group, table.name, descr, table._v_title, filters = filters,
+                         expectedrows = max(table.nrows, 1), chunkshape = (rows,))
+    table.attrs._f_copy(new)  # t0, units, ...
+
+    if not quiet:
+        print 'repacking %s, %d rows, %d rows per chunk' % (table._v_pathname, table.nrows, rows)
+        pb = ProgressBar(maxval = max(table.nrows, 1),
+                         widgets = [Bar(), ' ', Percentage(), ' ', ETA()], fd = sys.stdout)
+        pb.start()
+
+    step = 16 * rows
+    for start in xrange(0, table.nrows, step):
+        data = table.read(start, start + step)
+        if data.dtype != new.dtype:
+            data = data.astype(new.dtype)
+        new.append(data)
+        if not quiet:
+            pb.update(min(start + step, table.nrows))
+
+    if not quiet:
+        pb.finish()
+    new.flush()
+    return new
+
+
+def repack(infile, outfile = None, complib = 'blosc:lz4', complevel = 5, shuffle = 'byte', float32 = (),
+           chunksize = 1 << 20, quiet = False):
+    """
+    rewrite all tables in infile with the given compression and chunk size, other nodes are copied,
+    the file is replaced if outfile is None
+    """
+    if 'time' in float32:
+        raise ValueError('single precision is not sufficient for time')
+
+    out = outfile or infile + '.repack'
+    f = filters(complib, complevel, shuffle)
+    with t.openFile(infile, 'r') as src:
+        with t.openFile(out, 'w', src.title, filters = f) as dst:
+            src.root._v_attrs._f_copy(dst.root)
+            for group in src.walkGroups('/'):
+                if group is not src.root:
+                    new = dst.createGroup(group._v_parent._v_pathname, group._v_name, group._v_title)
+                    group._v_attrs._f_copy(new)
+
+            for node in src.walkNodes('/'):
+                if isinstance(node, t.Table):
+                    repack_table(node, dst.getNode(node._v_parent._v_pathname), f, float32, chunksize, quiet)
+                elif isinstance(node, t.Leaf):
+                    node._f_copy(dst.getNode(node._v_parent._v_pathname), filters = f)
+
+    if outfile is None:
+        os.rename(out, infile)
+
+
+def scan(filename):
+    'read all rows of all tables in filename chunk by chunk, return (# of rows, # of bytes, seconds)'
+    nrows = nbytes = 0
+    start = time.time()
+    with t.openFile(filename, 'r') as h5:
+        for table in h5.walkNodes('/', 'Table'):
+            step = 16 * table.chunkshape[0]
+            for i in xrange(0, table.nrows, step):
+                data = table.read(i, i + step)
+                nrows += len(data)
+                nbytes += data.nbytes
+    return nrows, nbytes, time.time() - start
+
+
+def report(filename):
+    'print size and scan throughput of filename'
+    nrows, nbytes, secs = scan(filename)
+    secs = max(secs, 1e-6)
+    print '%s: %.1f MB on disk, %.1f MB data, scan %.1f MB/s, %.0f rows/s' % (
+        filename, path.getsize(filename) / 1e6, nbytes / 1e6, nbytes / 1e6 / secs, nrows / secs)
+
+
+def main():
+    from argparse import ArgumentParser
+    import ctplot
+
+    parser = ArgumentParser(description = 'rewrite a HDF5 file with faster compression and larger chunks',
+                            epilog = ctplot.__epilog__)
+
+    parser.add_argument('-V', '--version', action = 'version', version = '%(prog)s {} build {}'.format(ctplot.__version__, ctplot.__build_date__))
+    parser.add_argument('-o', '--out', metavar = 'file', help = 'HDF5 output file (default: replace file)')
+    parser.add_argument('-f', '--force', action = 'store_true', help = 'overwrite existing file')
+    parser.add_argument('-l', '--complib', choices = complibs, default = 'blosc:lz4', help = 'compression library (default: blosc:lz4)')
+    parser.add_argument('-L', '--complevel', metavar = 'level', type = int, choices = range(10), default = 5, help = 'compression level 0-9 (default: 5)')
+    parser.add_argument('-s', '--shuffle', choices = shuffles, default = 'byte',
+                        help = 'shuffle filter, bit shuffling works best on slowly changing columns like time and needs blosc (default: byte)')
+    parser.add_argument('-k', '--chunksize', metavar = 'KiB', type = int, default = 1024, help = 'chunk size (default: 1024)')
+    parser.add_argument('-d', '--float32', metavar = 'columns', default = '',
+                        help = 'comma separated list of float columns to store with single precision')
+    parser.add_argument('-c', '--cache', metavar = 'dir', default = os.environ.get('CTPLOT_CACHEDIR'),
+                        help = 'cache dir of ctplot, cached data of the file is removed (default: $CTPLOT_CACHEDIR)')
+    parser.add_argument('-q', '--quiet', action = 'store_true', help = 'do not show progressbar')
+    parser.add_argument('file', help = 'HDF5 file to repack')
+
+    opts = parser.parse_args()
+
+    if opts.shuffle == 'bit' and not opts.complib.startswith('blosc'):
+        parser.error('bit shuffling needs blosc, not {}'.format(opts.complib))
+
+    out = opts.out
+    if out:
+        if not out.endswith('.h5'):
+            out = out + '.h5'
+
+        if not opts.force and os.path.exists(out):
+            raise RuntimeError('file \'{}\' already exists'.format(out))
+
+    float32 = [c.strip() for c in opts.float32.split(',') if c.strip()]
+
+    report(opts.file)
+    repack(opts.file, out, opts.complib, opts.complevel, opts.shuffle, float32, opts.chunksize * 1024, opts.quiet)
+    report(out or opts.file)
+
+    invalidate_caches(opts.cache, out or opts.file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os.path as path
+from contextlib import contextmanager
+import numpy as np
+import tables
+from merge import prepare_merge, merged_blocks
+from utils import AttrDict
+
+
+def is_virtual(node):
+    'True if node is the definition of a virtual merged table'
+    return isinstance(node, tables.Group) and 'merge' in node._v_attrs
+
+
+def is_sharded(node):
+    'True if node is the manifest of a sharded table'
+    return isinstance(node, tables.Group) and 'shards' in node._v_attrs
+
+
+def _ref(filename, node, relto):
+    'reference to node in filename as stored in a definition in file relto'
+    if path.abspath(filename) == path.abspath(relto):
+        return node
+    return path.relpath(path.abspath(filename), path.dirname(path.abspath(relto))) + ':' + node
+
+
+def _deref(ref, relto):
+    'return (filename, node) of a reference stored in a definition in file relto'
+    if ':' not in ref:
+        return relto, ref
+    f, node = ref.rsplit(':', 1)
+    return path.normpath(path.join(path.dirname(relto), f)), node
+
+
+def define_virtual(h5, where, name, primary, secondaries, merge_on = 'time', joins = {}):
+    """
+    create the definition of a virtual merged table in group where of the open file h5,
+    primary is (file, table), secondaries a list of (file, table, max_inter, column prefix), joins the join modes, see merge.merge,
+    the tables are merged when the virtual table is read
+    """
+    relto = h5.filename
+    spec = {'primary':_ref(primary[0], primary[1], relto),
+            'secondaries':[[_ref(f or primary[0], n, relto), m, p or ''] for f, n, m, p in secondaries],
+            'merge_on':merge_on,
+            'joins':joins}
+
+    node = h5.createGroup(where, name, 'virtual merged table', createparents = True)
+    node._v_attrs.merge = json.dumps(spec)
+    try:  # check the definition
+        VirtualMergedTable(node).close()
+    except:
+        node._f_remove()
+        raise
+    return node
+
+
+class Row(object):
+    'the current row of VirtualMergedTable.iterrows, like tables.Row'
+
+    def __init__(self):
+        self.nrow = -1
+        self.record = None
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.record.item()[key]
+        return self.record[key]
+
+
+class VirtualMergedTable(object):
+    """
+    a merged table (see merge.merge) that is not stored but computed when it is read,
+    it has the read only parts of the tables.Table interface that ctplot uses,
+    the rows are numbered in the order they are merged, nrows is the # of rows of the primary table
+    """
+
+    def __init__(self, node, blocksize = 100000):
+        self.node = node
+        self.name = node._v_name
+        self._v_pathname = node._v_pathname
+        self.blocksize = blocksize
+
+        spec = json.loads(node._v_attrs.merge)
+        relto = node._v_file.filename
+        self.merge_on = spec['merge_on']
+        self.joins = dict((str(c), str(m)) for c, m in spec.get('joins', {}).iteritems())
+
+        self.files = {path.abspath(relto):node._v_file}  # filename --> open file
+
+        def table(ref):
+            f, n = _deref(ref, relto)
+            f = path.abspath(f)
+            if f not in self.files:
+                self.files[f] = tables.openFile(f, 'r')
+            return self.files[f].getNode(n)
+
+        try:
+            self.pri_table = table(spec['primary'])
+            self.sec_tables = [table(s[0]) for s in spec['secondaries']]
+            self.specs = [(s[1], str(s[2])) for s in spec['secondaries']]
+            t0, self.toff, self.secs, self.coldescrs, units = prepare_merge(self.pri_table, self.sec_tables, self.specs, self.merge_on, self.joins)
+        except:
+            self.close()
+            raise
+
+        self.colnames = self.coldescrs.keys()
+        self.dtype = tables.Description(self.coldescrs)._v_dtype
+        self.nrows = self.pri_table.nrows
+        self._v_title = self.pri_table._v_title + ' merged with ' + ', '.join(s._v_title for s in self.sec_tables)
+        self.attrs = AttrDict(TITLE = self._v_title, t0 = t0.isoformat(), units = json.dumps(units),
+                              time_info = 'time contains the number of seconds since t0')
+
+    @property
+    def filenames(self):
+        'names of the files with the tables merged'
+        return self.files.keys()
+
+    def close(self):
+        'close the files opened for the merged tables'
+        for f in self.files.values():
+            if f is not self.node._v_file:
+                f.close()
+        self.files = {}
+
+    def blocks(self, start = 0, stop = None, columns = None):
+        """
+        yield structured arrays with the rows merged from the primary rows start to stop, only with the columns given,
+        the secondary tables are prepared once (see prepare_merge) and reset for each call, so iterate over one call at a time
+        """
+        dtype = self.dtype
+        if columns is not None:
+            dtype = np.dtype([(c, dtype[c]) for c in self.colnames if c in columns])
+        for sec in self.secs:
+            sec.reset()
+        for n, block in merged_blocks(self.pri_table, self.secs, dtype, self.merge_on, self.toff, self.blocksize, start, stop):
+            yield block
+
+    def read(self, start = None, stop = None, columns = None):
+        'return the merged rows of the primary rows start to stop as structured array'
+        blocks = list(self.blocks(start or 0, stop, columns))
+        if not blocks:
+            return np.empty(0, self.dtype)
+        return np.concatenate(blocks)
+
+    def iterrows(self, start = None, stop = None, columns = None):
+        'iterate over the merged rows of the primary rows start to stop, only the columns given are merged'
+        return _iterrows(self.blocks(start or 0, stop, columns))
+
+    def __iter__(self):
+        return self.iterrows()
+
+    def __getitem__(self, i):
+        """
+        return merged row i, rows of the primary table may be dropped by the merge,
+        so windows of primary rows growing from the start (from the end if i < 0) are merged until they hold row i
+        """
+        merged, size = 0, 16  # merged rows seen, primary rows in the next window
+        start, stop = (0, min(size, self.nrows)) if i >= 0 else (max(0, self.nrows - size), self.nrows)
+        while start < stop:
+            rows = self.read(start, stop)
+            if i >= 0:
+                if i < merged + len(rows):
+                    return rows[i - merged]
+                size *= 4
+                start, stop = stop, min(stop + size, self.nrows)
+            else:
+                if -i <= merged + len(rows):
+                    return rows[i + merged]
+                size *= 4
+                start, stop = max(0, start - size), start
+            merged += len(rows)
+        raise IndexError('row index out of range')
+
+
+def _iterrows(blocks):
+    'iterate over the rows of blocks (structured arrays)'
+    row = Row()
+    for block in blocks:
+        for record in block:
+            row.nrow += 1
+            row.record = record
+            yield row
+
+
+class ShardedTable(object):
+    """
+    a table stored in shards, one file per period (see rawdata.ShardWriter), listed in a manifest,
+    it has the read only parts of the tables.Table interface that ctplot uses,
+    the first shard is kept open, its attributes (units, t0, dimension) are those of the table
+    """
+
+    def __init__(self, node, blocksize = 100000):
+        self.node = node
+        self.name = node._v_name
+        self._v_pathname = node._v_pathname
+        self._v_title = node._v_title
+        self.blocksize = blocksize
+
+        relto = path.dirname(path.abspath(node._v_file.filename))
+        self.shards = [(path.normpath(path.join(relto, f)), n, tmin, tmax, rows)
+                       for f, n, tmin, tmax, rows in json.loads(node._v_attrs.shards)]
+        self.shards.sort(key = lambda s: s[2])
+        self.nrows = sum(s[4] for s in self.shards)
+
+        self._v_file = tables.openFile(self.shards[0][0], 'r')
+        first = self._v_file.getNode(self.shards[0][1])
+        self.colnames = list(first.colnames)
+        self.coldescrs = first.coldescrs
+        self.dtype = first.dtype
+        self.attrs = AttrDict((k, first.attrs[k]) for k in first.attrs._v_attrnamesuser if k != 'shard')
+        self.attrs['TITLE'] = self._v_title
+
+    @property
+    def filenames(self):
+        'names of the manifest and the shards'
+        return [self.node._v_file.filename] + [s[0] for s in self.shards]
+
+    def close(self):
+        self._v_file.close()
+
+    def select(self, lower = -np.inf, upper = np.inf):
+        'return (filename, node) of the shards with rows with lower <= time <= upper'
+        return [(f, n) for f, n, tmin, tmax, rows in self.shards if tmax >= lower and tmin <= upper]
+
+    def blocks(self, start = 0, stop = None):
+        'yield structured arrays with the rows start to stop'
+        stop = self.nrows if stop is None else min(stop, self.nrows)
+        offset = 0  # of the current shard
+        for f, n, tmin, tmax, rows in self.shards:
+            if offset + rows > start and offset < stop:
+                with tables.openFile(f, 'r') as h5:
+                    table = h5.getNode(n)
+                    for b in xrange(max(start - offset, 0), min(stop - offset, rows), self.blocksize):
+                        yield table.read(b, min(b + self.blocksize, stop - offset, rows))
+            offset += rows
+
+    def read(self, start = None, stop = None):
+        'return the rows start to stop as structured array'
+        blocks = list(self.blocks(start or 0, stop))
+        if not blocks:
+            return np.empty(0, self.dtype)
+        return np.concatenate(blocks)
+
+    def iterrows(self, start = None, stop = None):
+        'iterate over the rows start to stop'
+        return _iterrows(self.blocks(start or 0, stop))
+
+    def __iter__(self):
+        return self.iterrows()
+
+    def __getitem__(self, i):
+        'return row i'
+        if i < 0:
+            i += self.nrows
+        return self.read(i, i + 1)[0]
+
+
+@contextmanager
+def open_source(filename, node):
+    'open node in filename, yield the table, the VirtualMergedTable or the ShardedTable'
+    with tables.openFile(filename, 'r') as h5:
+        n = h5.getNode(node)
+        if is_virtual(n) or is_sharded(n):
+            v = VirtualMergedTable(n) if is_virtual(n) else ShardedTable(n)
+            try:
+                yield v
+            finally:
+                v.close()
+        else:
+            yield n
+
+
+def iterrows(table, columns = None):
+    'iterate over the rows of table, a VirtualMergedTable merges only the columns given'
+    if isinstance(table, VirtualMergedTable):
+        return table.iterrows(columns = columns)
+    return table.iterrows()
+
+
+def blocks(table, start = 0, stop = None, columns = None, blocksize = 100000):
+    'yield the rows start to stop of table as structured arrays of up to blocksize rows, a VirtualMergedTable merges only the columns given'
+    if isinstance(table, (VirtualMergedTable, ShardedTable)):
+        table.blocksize = blocksize
+        args = (start, stop, columns) if isinstance(table, VirtualMergedTable) else (start, stop)
+        for b in table.blocks(*args):
+            yield b
+    else:
+        stop = table.nrows if stop is None else min(stop, table.nrows)
+        for b in xrange(start, stop, blocksize):
+            yield table.read(b, min(b + blocksize, stop))
+
+
+def source_files(filename, node):
+    'return the names of the files the data of node in filename comes from, from the definition or manifest, no table is opened'
+    try:
+        with tables.openFile(filename, 'r') as h5:
+            n = h5.getNode(node)
+            if is_virtual(n):
+                spec = json.loads(n._v_attrs.merge)
+                refs = [spec['primary']] + [s[0] for s in spec['secondaries']]
+                return sorted(set([path.abspath(filename)] + [path.abspath(_deref(r, filename)[0]) for r in refs]))
+            if is_sharded(n):
+                relto = path.dirname(path.abspath(filename))
+                return [filename] + [path.normpath(path.join(relto, s[0])) for s in json.loads(n._v_attrs.shards)]
+    except:
+        pass
+    return [filename]
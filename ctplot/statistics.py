@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+
+# statistics of a histogram, as selected by the letters of the statsbox setting (sb#)
+fields = {'n':'N', 'u':'uflow', 'o':'oflow', 'm':'mean', 's':'std', 'p':'mode', 'e':'median', 'w':'skew', 'k':'kurtos', 'x':'excess', 'c':'cov'}
+all_fields = 'nmscpewx'
+
+
+def selected(sb):
+    'return the names of the statistics selected by the letters in sb, a selects all'
+    if 'a' in sb:
+        sb = all_fields
+    return set(fields[k] for k in sb if k in fields)
+
+
+def stats1d(contents, edges, uflow = 0, oflow = 0, select = None, moments = None):
+    """
+    return a dict name --> value of the statistics of a histogram with contents and edges,
+    all (see fields) or only those in select, the mean, std, skew and kurtosis are computed from the bin centers
+    or taken from moments (mean, std, skewness, kurtosis) of the unbinned values if given
+    """
+    contents = np.asarray(contents)
+    centers = (edges[1:] + edges[:-1]) / 2
+
+    def want(*names):
+        return select is None or any(n in select for n in names)
+
+    stats = {}
+    stats['N'] = N = np.sum(contents)
+    stats['uflow'] = uflow
+    stats['oflow'] = oflow
+
+    with np.errstate(all = 'ignore'):
+        if moments is not None:
+            mean, std, skew, kurtosis = moments
+        elif want('mean', 'std', 'skew', 'kurtos', 'excess'):
+            mean = np.sum(centers * contents) / N
+            std = np.sqrt(np.sum((centers - mean) ** 2 * contents) / N)
+            if want('skew', 'kurtos', 'excess'):
+                z = (centers - mean) / std
+                skew = np.sum(z ** 3 * contents) / N
+                kurtosis = np.sum(z ** 4 * contents) / N
+
+        if want('mean', 'std', 'skew', 'kurtos', 'excess'):
+            stats['mean'] = mean
+            stats['std'] = std
+        if want('skew', 'kurtos', 'excess'):
+            stats['skew'] = skew
+            stats['kurtos'] = kurtosis
+            stats['excess'] = kurtosis - 3
+
+        if want('mode'):
+            stats['mode'] = centers[np.argmax(contents)]
+
+        if want('median'):
+            cumulative = np.cumsum(contents) / float(N)
+            median_i = np.minimum(len(centers) - 1, np.searchsorted(cumulative, 0.5, side = 'right'))
+            stats['median'] = median = centers[median_i]
+            if len(centers) % 2 == 0:  # even # of bins
+                stats['median'] = (median + centers[median_i - 1]) / 2
+
+    return stats
+
+
+def stats2d(contents, xcenters, ycenters, select = None, moments = None, cov = None):
+    """
+    return a dict name --> value of the statistics N, mean, std (arrays of x and y) and cov of a 2D histogram
+    with contents[y bin, x bin], all or only those in select, computed from the bin centers
+    or taken from moments ((mean, std, ...) of x and y) and cov of the unbinned values if given
+    """
+    contents = np.asarray(contents)
+
+    def want(*names):
+        return select is None or any(n in select for n in names)
+
+    stats = {}
+    stats['N'] = N = contents.sum()
+    with np.errstate(all = 'ignore'):
+        if moments is not None:
+            mean = np.array([moments[0][0], moments[1][0]])
+            std = np.array([moments[0][1], moments[1][1]])
+        else:
+            px, py = contents.sum(axis = 0), contents.sum(axis = 1)  # projections
+            mean = np.array([(px * xcenters).sum(), (py * ycenters).sum()]) / N
+            std = np.sqrt(np.array([(px * (xcenters - mean[0]) ** 2).sum(), (py * (ycenters - mean[1]) ** 2).sum()]) / N)
+        if want('mean', 'std'):
+            stats['mean'] = mean
+            stats['std'] = std
+        if want('cov'):
+            if cov is None:
+                cov = np.dot(ycenters - mean[1], np.dot(contents, xcenters - mean[0])) / N
+            stats['cov'] = cov
+
+    return stats
@@ -206,8 +206,8 @@ class ExtendedWilkinsonTickLocator(Locator):
 
         return get_ticks(vmin, vmax, nticks, only_inside = self.only_inside, Q = self.Q, w = self.w)
 
-def set_extended_locator(density = 1, per_inch = True, **kwargs):
-    'set the ExtendedWilkinsonTickLocator on current x- and y-axis'
-    ca = pyplot.gca()
+def set_extended_locator(density = 1, per_inch = True, axes = None, **kwargs):
+    'set the ExtendedWilkinsonTickLocator on x- and y-axis of axes, the current axes of pyplot if None'
+    ca = axes or pyplot.gca()
     ca.xaxis.set_major_locator(ExtendedWilkinsonTickLocator(target_density = density, per_inch = per_inch, **kwargs))
     ca.yaxis.set_major_locator(ExtendedWilkinsonTickLocator(target_density = density, per_inch = per_inch, **kwargs))
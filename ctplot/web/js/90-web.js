@@ -862,6 +862,34 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
                         .prepend('<i class="fa fa-file-image-o"></i>')
                         .appendTo(el);
 
+                    // plot of a sample, poll the job until the exact plot is made
+                    if (data.job) {
+                        var image = $('#plotImage'),
+                            pngLink = list.find('a').last(),
+                            status = $('<p class="text-centered">').html('Vorläufiger Plot aus einer Stichprobe der Daten, der genaue Plot wird erstellt&hellip;').insertAfter(image);
+
+                        (function poll() {
+                            $.ajax({
+                                data : { a : 'progress', job : data.job },
+                                success : function(job) {
+                                    if (job.errors) {
+                                        status.text('Der genaue Plot konnte nicht erstellt werden.');
+                                    } else if (job.png) {
+                                        image.attr('src', job.png + '?t=' + new Date().getTime());
+                                        pngLink.attr('href', job.png);
+                                        status.remove();
+                                    } else {
+                                        status.text('Vorläufiger Plot aus einer Stichprobe der Daten, der genaue Plot wird erstellt: ' + Math.round(100 * job.progress) + ' %');
+                                        setTimeout(poll, 1000);
+                                    }
+                                },
+                                error : function() {
+                                    setTimeout(poll, 5000);
+                                }
+                            });
+                        })();
+                    }
+
                     // save plot button
                     saveButton = $('<button>').attr('type', 'button')
                         .addClass('btn')
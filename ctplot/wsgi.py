@@ -1,22 +1,26 @@
 #!/usr/bin/env python
 # coding: utf8
 
-import os, json, random, string, logging
+import os, re, json, random, string, logging
 from numbers import Number
 from os.path import join, abspath, basename
 from mimetypes import guess_type
 from time import  time
 from cgi import FieldStorage
-from threading import Lock
+from threading import Lock, Thread
+from multiprocessing import cpu_count
 from pkg_resources import resource_string, resource_exists, resource_isdir, resource_listdir
 from itertools import product
+from collections import OrderedDict
 
 import matplotlib
 matplotlib.use('Agg')  # headless backend
 
 import plot
 import validation
+from sources import source_files
 from utils import hashargs
+from locket import lock_file
 from i18n import _
 
 logging.basicConfig(level = logging.DEBUG, format = '%(filename)s:%(funcName)s:%(lineno)d:%(message)s')
@@ -25,6 +29,8 @@ log = logging.getLogger('wsgi')
 
 _config = None
 
+numeric_settings = {'workers', 'memory', 'density', 'preview', 'progressive', 'heavy', 'queue'}  # read from the environment as int
+
 def get_config():
     global _config
 
@@ -39,12 +45,19 @@ def get_config():
     _config = {'cachedir':join(basedir, 'cache'),
                'datadir':join(basedir, 'data'),
                'plotdir':join(basedir, 'plots'),
-               'sessiondir':join(basedir, 'sessions')}
+               'sessiondir':join(basedir, 'sessions'),
+               'workers':cpu_count(),  # processes scanning sharded tables and large tables
+               'memory':1024,  # MB, plots needing more are computed in a streaming pass
+               'density':100000,  # points, xy plots and maps with z of more are drawn as density image
+               'preview':20000,  # rows per table sampled for previews and progressive plots
+               'heavy':1000000,  # values, plots estimated to cost more are made one at a time (see Plot.cost)
+               'queue':4,  # heavy plots admitted per process, more are rejected
+               'progressive':1}  # heavy plots show a sample until they are made
 
     for k in _config.keys():
-        ek = prefix + k.upper()
+        ek = (prefix + k).upper()
         if ek in env:
-            _config[k] = env[ek]
+            _config[k] = int(env[ek]) if k in numeric_settings else env[ek]
 
     _config['debug'] = True if (prefix + 'debug').upper() in env else False
 
@@ -123,14 +136,28 @@ def dynamic_content(environ, start_response):
     config = get_config()
 
     if path.startswith('/plots'):
-        return serve_plot(path, start_response, config)
+        try:
+            return serve_plot(path, start_response, config)
+        except Busy as e:
+            start_response('503 Service Unavailable', [content_type(), cc_nocache])
+            return [str(e)]
     else:
         return handle_action(environ, start_response, config)
 
 
 
 def serve_plot(path, start_response, config):
-    with open(join(config['plotdir'], basename(path))) as f:
+    filename = join(config['plotdir'], basename(path))
+    name, ext = os.path.splitext(filename)
+    if ext in ('.svg', '.pdf') and not rendered(filename) and os.path.isfile(name + '.json'):
+        # pending, render it from the settings stored with the png
+        with open(name + '.json') as f:
+            settings = json.load(f)
+        with plot_lock:
+            heavy = name not in retained
+        heavy = heavy and admit(settings, config)  # the data is read again
+        run_admitted(heavy, render, name, settings, config, [ext[1:]])
+    with open(filename) as f:
         start_response('200 OK', [content_type(path), cc_cache])
         return [f.read()]
 
@@ -146,9 +173,27 @@ def serve_plain(data, start_response):
 
 available_tables = None
 
-def validate_settings(settings):
+def get_available_tables(datadir):
+    'return the catalog of tables, rebuilt daily or if a data file has changed'
     global available_tables
+    if not available_tables or time() - available_tables[0] > 86400 or plot.data_mtime(datadir) > available_tables[0]:
+        available_tables = time(), plot.available_tables(datadir)
+    return available_tables[1]
+
+def sources_mtime(settings, config):
+    'latest modification time of the data files used by the plot'
+    mtime = 0
+    for k, v in settings.iteritems():
+        if re.match('s\\d+$', k) and v:
+            filename, node = (v.split(':') + [''])[:2]
+            try:
+                for f in source_files(join(config['datadir'], filename), node):
+                    mtime = max(mtime, os.path.getmtime(f))
+            except OSError:
+                pass
+    return mtime
 
+def validate_settings(settings):
     errors = { 'global': [], 'diagrams': {} }
     valid = True
 
@@ -165,8 +210,7 @@ def validate_settings(settings):
             errors['global'].append(_('no plots detected'))
             return [False, errors]
 
-    if not available_tables or time() - available_tables[0] > 86400:
-        available_tables = time(), plot.available_tables(get_config()['datadir'])
+    tables = get_available_tables(get_config()['datadir'])
 
     log.debug('settings to validate: {}'.format(settings))
 
@@ -242,7 +286,7 @@ def validate_settings(settings):
         # get permitted expression variables
         permitted_vars = None
         if 's' + n in settings:
-            for filename, dataset in available_tables[1].iteritems():
+            for filename, dataset in tables.iteritems():
                 if filename == settings['s' + n]:
                     permitted_vars = {}
                     # init dummy vars to 1
@@ -379,46 +423,231 @@ def validate_settings(settings):
     return [valid, errors]
 
 
-plot_lock = Lock()
+plot_lock = Lock()  # of retained and jobs
+
+retained = OrderedDict()  # name --> plot, the plots last made, to render their other formats
+retained_plots = 4
+
+jobs = {}  # name --> plot being made (None until it is created) or the exception it failed with, see render and make_plot
+
+heavy_slot = Lock()  # heavy plots are made one at a time, see admit
+heavy_jobs = 0  # heavy plots admitted and not yet made
+
+class Busy(RuntimeError):
+    'too many heavy plots are queued'
+
+def admit(settings, config):
+    """
+    estimate the cost of the plot before its data is read (see plot.Plot.cost), return True if it is heavy,
+    heavy plots are queued and made one at a time (see run_admitted), raise Busy if config['queue'] heavy plots are queued already
+    """
+    global heavy_jobs
+    cost = plot.Plot(config, **settings).cost(get_available_tables(config['datadir']))
+    log.debug('estimated cost %d', cost)
+    if cost <= config['heavy']:
+        return False
+    with plot_lock:
+        if heavy_jobs >= config['queue']:
+            log.warning('rejecting plot of estimated cost %d, %d heavy plots queued', cost, heavy_jobs)
+            raise Busy(_('server busy, try again later'))
+        heavy_jobs += 1
+    return True
+
+def release():
+    'a heavy plot admitted is made or failed, see admit'
+    global heavy_jobs
+    with plot_lock:
+        heavy_jobs -= 1
+
+def run_admitted(heavy, function, *args):
+    'call function with args, if the plot is heavy after the heavy plots admitted before, see admit'
+    if not heavy:
+        return function(*args)
+    try:
+        with heavy_slot:
+            return function(*args)
+    finally:
+        release()
+
+def rendered(filename):
+    'True if the plot filename (name.ext) has been rendered since its png'
+    png = os.path.splitext(filename)[0] + '.png'
+    return os.path.isfile(filename) and os.path.isfile(png) and os.path.getmtime(filename) >= os.path.getmtime(png)
+
+def render(name, settings, config, formats):
+    """
+    render the plot with settings as name.ext for the formats given, the png from the data, the others from the plot retained if possible,
+    plots are drawn on their own figures, so different plots are made in parallel threads, the same plot once at a time
+    """
+    with lock_file(name + '.lock'):  # lock long running plot creation
+        if 'png' not in formats:  # maybe rendered while waiting for the lock
+            formats = [e for e in formats if not rendered(name + '.' + e)]
+            if not formats:
+                return
+        with plot_lock:
+            p = retained.pop(name, None)
+        if p is None or 'png' in formats:
+            p = plot.Plot(config, **settings)
+            with open(name + '.json', 'w') as f:  # to render the pending formats
+                json.dump(settings, f)
+        with plot_lock:
+            jobs[name] = p  # for its progress
+        try:
+            p.save(name, formats)
+        finally:
+            with plot_lock:
+                jobs.pop(name, None)
+        with plot_lock:
+            retained[name] = p
+            while len(retained) > retained_plots:
+                retained.popitem(last = False)
 
-def make_plot(settings, config):
+def refine(name, settings, config, heavy):
+    'render the png of the plot in the background, see make_plot'
+    try:
+        run_admitted(heavy, render, name, settings, config, ['png'])
+    except Exception as e:
+        log.exception(e)
+        with plot_lock:
+            jobs[name] = e
+
+def make_plot(settings, config, formats = ('png',), progressive = False):
+    """
+    make the plot in the formats given, return [{format:filename}, errors],
+    the png is always made, svg and pdf only if requested, else they are pending and rendered on request, see serve_plot,
+    heavy plots are queued (see admit), if progressive the png of a heavy plot is made of a sample first (see make_preview)
+    and returned as name.sample.png with the job (the name), the exact png is made in the background, see job_progress
+    """
     basename = 'plot{}'.format(hashargs(settings))
     name = os.path.join(config['plotdir'], basename).replace('\\', '/')
+    png = name + '.png'
+
+    # try to get plot from cache, pending formats are rendered from the png's data
+    cached = os.path.isfile(png) and os.path.getmtime(png) >= sources_mtime(settings, config)
+    if 'png' in formats and (config['debug'] or not config['cachedir']):
+        cached = False
+    todo = [e for e in formats if e != 'png' and not (cached and rendered(name + '.' + e))]
+    if not cached:
+        todo.insert(0, 'png')
+
+    images = dict([(e, name + '.' + e) for e in ['png', 'svg', 'pdf']])
+
+    if todo:
+        valid, errors = validate_settings(settings)
+        if not valid:
+            return [None, errors]
 
-    # try to get plot from cache
-    if not config['debug'] and config['cachedir'] and os.path.isfile(name + '.png'):
-        return [dict([(e, name + '.' + e) for e in ['png', 'svg', 'pdf']]), None]
-    else:
-        # lock long running plot creation
         with plot_lock:
-            valid, errors = validate_settings(settings)
+            running = name in jobs
+            redraw = 'png' not in todo and name in retained  # from the data retained
+        heavy = not (running or redraw) and admit(settings, config)
+
+        if progressive and todo == ['png'] and config['progressive'] and (heavy or running):
+            with plot_lock:
+                running = name in jobs
+                if not running:
+                    jobs[name] = None
+            if running and heavy:  # started meanwhile
+                release()
+            if not running:
+                try:
+                    p = plot.Plot(dict(config, sample = config['preview']), **settings)
+                    p.save(name + '.sample', ['png'])
+                except:
+                    with plot_lock:
+                        jobs.pop(name, None)
+                    if heavy:
+                        release()
+                    raise
+                job = Thread(target = refine, args = (name, settings, config, heavy))
+                job.daemon = True
+                job.start()
+            images['png'] = name + '.sample.png'
+            images['job'] = basename
+        else:
+            run_admitted(heavy, render, name, settings, config, todo)
+
+    return [images, None]
+
+def explain(settings, config):
+    'return the plan of making the plot without making it, see plot.Plot.explain, and if its png is cached and it is heavy'
+    valid, errors = validate_settings(settings)
+    if not valid:
+        return {'errors':errors}
+    png = join(config['plotdir'], 'plot{}.png'.format(hashargs(settings)))
+    cached = config['cachedir'] and not config['debug'] and os.path.isfile(png) and os.path.getmtime(png) >= sources_mtime(settings, config)
+    plan = plot.Plot(config, **settings).explain(get_available_tables(config['datadir']))
+    plan['cache'] = '{} {}'.format('hit' if cached else 'miss', basename(png))
+    plan['heavy'] = plan['cost'] > config['heavy']
+    return plan
+
+def job_progress(name):
+    'return the state of the plot name made in the background: progress (0-1), errors or the png when it is made'
+    with plot_lock:
+        p = jobs.get(name)
+        running = name in jobs
+        if isinstance(p, Exception):
+            del jobs[name]
+    if isinstance(p, Exception):
+        return {'errors':{'global':[_('unknown error')]}}
+
+    # the job may run in another process, it is done when the png is newer than the sample
+    png, sample = name + '.png', name + '.sample.png'
+    if not running and os.path.isfile(png) and (not os.path.isfile(sample) or os.path.getmtime(png) >= os.path.getmtime(sample)):
+        return {'progress':1, 'png':'plots/' + basename(png)}
+    return {'progress':min(p.progress, 0.99) if isinstance(p, plot.Plot) else 0}
+
+
+preview_dpi = 40
+
+def make_preview(settings, config):
+    """
+    make a small png of the plot from a sample of config['preview'] rows per table (see plot.sample_table)
+    with a low resolution, cached apart from the plot, return [filename, errors]
+    """
+    basename = 'preview{}'.format(hashargs(settings))
+    name = os.path.join(config['plotdir'], basename).replace('\\', '/')
+    png = name + '.png'
 
-            if not valid:
-                return [None, errors]
+    # try to get preview from cache
+    if config['debug'] or not config['cachedir'] or not os.path.isfile(png) or os.path.getmtime(png) < sources_mtime(settings, config):
+        valid, errors = validate_settings(settings)
+        if not valid:
+            return [None, errors]
+        with lock_file(name + '.lock'):
+            p = plot.Plot(dict(config, sample = config['preview']), **settings)
+            p.save(name, ['png'], dpi = preview_dpi)
 
-            p = plot.Plot(config, **settings)
-            return [p.save(name), None]
+    return [png, None]
 
 
 def randomChars(n):
     return ''.join(random.choice(string.ascii_lowercase + string.ascii_uppercase + string.digits) for _ in range(n))
 
 def handle_action(environ, start_response, config):
-    global available_tables
     fields = FieldStorage(fp = environ['wsgi.input'], environ = environ)
     action = fields.getfirst('a')
     datadir = config['datadir']
     sessiondir = config['sessiondir']
 
-    if action in ['plot', 'png', 'svg', 'pdf']:
+    if action in ['plot', 'png', 'svg', 'pdf', 'preview', 'explain']:
 
         settings = {}
         for k in fields.keys():
             if k[0] in 'xyzcmsorntwhfglp' or k[:10] == 'experiment':
                 settings[k] = fields.getfirst(k).strip().decode('utf8', errors = 'ignore')
 
+        if action == 'explain':
+            return serve_json(explain(settings, config), start_response)
+
         try:
-            images, errors = make_plot(settings, config)
+            if action == 'preview':
+                images, errors = make_preview(settings, config)
+                images = {'preview':images}
+            else:
+                images, errors = make_plot(settings, config, ['png' if action == 'plot' else action], progressive = action == 'plot')
+        except Busy as e:
+            errors = { 'global': [str(e)] }
         except Exception as e:
             log.exception(e)
             errors = { 'global': [_('unknown error')] }
@@ -426,21 +655,27 @@ def handle_action(environ, start_response, config):
         if errors:
             return serve_json({ 'errors': errors }, start_response)
 
-        for k, v in images.items():
-            images[k] = 'plots/' + basename(v)
-
         if action == 'plot':
-            return serve_json(images, start_response)
-
-        elif action in ['png', 'svg', 'pdf']:
+            job = images.pop('job', None)
+            response = dict((k, 'plots/' + basename(v)) for k, v in images.items())
+            response['pending'] = [k for k, v in images.items() if k != 'png' and not rendered(v)]
+            if job:
+                response['job'] = job
+            return serve_json(response, start_response)
+
+        elif action in ['png', 'svg', 'pdf', 'preview']:
             return serve_plot(images[action], start_response, config)
 
 
 
+    elif action == 'progress':
+        job = basename(fields.getfirst('job', ''))
+        if not re.match('plot-?\\d+$', job):
+            raise RuntimeError('invalid job ' + job)
+        return serve_json(job_progress(join(config['plotdir'], job)), start_response)
+
     elif action == 'list':
-        if not available_tables or time() - available_tables[0] > 86400:
-            available_tables = time(), plot.available_tables(datadir)
-        return serve_json(available_tables[1], start_response)
+        return serve_json(get_available_tables(datadir), start_response)
 
     elif action == 'save':
         id = fields.getfirst('id').strip()
@@ -60,11 +60,14 @@ setup(
     long_description = readme('README.md'),
     install_requires = required_libs,
     extra_require = {
-                        'server': ['tornado']
+                        'server': ['tornado'],
+                        'ingest': ['pyinotify']
     },
     entry_points = {'console_scripts':[
                         'rawdata=ctplot.rawdata:main',
                         'mergedata=ctplot.merge:main',
+                        'ingestdata=ctplot.ingest:main',
+                        'repackdata=ctplot.repack:main',
                         'ctplot=ctplot.plot:main',
                         'ctserver=ctplot.webserver:main'
                    ]},